@@ -0,0 +1,4 @@
+"""
+Package: benchmarks
+Load benchmarks of the Recommendation service
+"""
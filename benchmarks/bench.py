@@ -0,0 +1,284 @@
+"""
+Recommendation Service Benchmark
+
+Seeds the database, drives the list, get, create and lookup endpoints at a
+given concurrency and prints a JSON report with the p50/p95/p99 latencies,
+the requests per second and the memory (RSS) of the service during every
+scenario.
+
+Usage:
+    python -m benchmarks.bench --rows 100000 --requests 2000 --concurrency 16
+
+The requests are sent through the Flask test client in this process, or to a
+running service with --url (the database of that service must be the one
+configured by DATABASE_URI here, so that the seeded ids exist). Use
+DATABASE_URI=sqlite:////tmp/bench.db to run without PostgreSQL.
+
+The RSS is read from /proc: the benchmark process itself when the app runs
+in-process (so it includes the client threads), or the process given with
+--service-pid and its children (the gunicorn workers) with --url.
+"""
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ("list", "get", "create", "lookup")
+
+
+def percentile(samples, fraction):
+    """Returns the nearest-rank percentile of sorted samples"""
+    if not samples:
+        return None
+    rank = max(1, math.ceil(fraction * len(samples)))
+    return samples[min(rank, len(samples)) - 1]
+
+
+def read_rss_kb(pid="self"):
+    """Returns the current resident set size of a process in kB, or None without /proc"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def tree_rss_kb(pid):
+    """Returns the RSS of a process and its direct children in kB, or None if it cannot be read"""
+    total = read_rss_kb(pid)
+    if total is None:
+        return None
+    for entry in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{entry}/stat", encoding="ascii") as file:
+                # The parent pid follows the parenthesized command name, which may contain spaces
+                ppid = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == pid:
+            total += read_rss_kb(entry) or 0
+    return total
+
+
+class RssSampler:
+    """Samples the RSS of the service from a background thread while a scenario runs"""
+
+    def __init__(self, measure, interval=0.05):
+        self.measure = measure
+        self.interval = interval
+        self.samples = []
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._done.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = self.measure()
+        if rss is not None:
+            self.samples.append(rss)
+
+    def start(self):
+        """Takes the first sample and starts sampling"""
+        self._sample()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Takes the last sample and returns the start, end, peak and growth of the RSS in kB"""
+        self._done.set()
+        self._thread.join()
+        self._sample()
+        if not self.samples:
+            return {"rss_start_kb": None, "rss_end_kb": None, "rss_peak_kb": None, "rss_growth_kb": None}
+        start, end = self.samples[0], self.samples[-1]
+        return {"rss_start_kb": start, "rss_end_kb": end, "rss_peak_kb": max(self.samples), "rss_growth_kb": end - start}
+
+
+def summarize(name, latencies, errors, elapsed, rss=None):
+    """Returns the report of a scenario, latencies are in seconds and rss is the result of RssSampler.stop()"""
+    latencies = sorted(latencies)
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+        **(rss or {}),
+    }
+
+
+class Client:  # pylint: disable=too-few-public-methods
+    """Sends requests to the Flask app in this process or to a running service"""
+
+    def __init__(self, url=None):
+        self.url = url
+        self._local = threading.local()
+
+    def request(self, method, path, **kwargs):
+        """Sends a request and returns its status code"""
+        if self.url:
+            import requests  # pylint: disable=import-outside-toplevel
+            if not hasattr(self._local, "session"):
+                self._local.session = requests.Session()
+            return self._local.session.request(method, self.url + path, timeout=30, **kwargs).status_code
+        if not hasattr(self._local, "client"):
+            from service import app  # pylint: disable=import-outside-toplevel
+            self._local.client = app.test_client()
+        return self._local.client.open(path, method=method, **kwargs).status_code
+
+
+def make_requests(name, pids, ids, lookup_size):
+    """Returns a function building the (method, path, kwargs) of the n-th request of a scenario"""
+    randoms = threading.local()
+    create_pids = itertools.count(pids.stop + 1)
+
+    def rng():
+        if not hasattr(randoms, "value"):
+            randoms.value = random.Random(threading.get_ident())
+        return randoms.value
+
+    def build():
+        if name == "list":
+            return "GET", f"/recommendations?pid={rng().choice(pids)}", {}
+        if name == "get":
+            return "GET", f"/recommendations/{rng().randint(*ids)}", {}
+        if name == "create":
+            pid = next(create_pids)
+            data = {"pid": pid, "recommended_pid": pid + 1, "type": "accessory", "liked": False}
+            return "POST", "/recommendations", {"json": data}
+        data = {"pids": [rng().choice(pids) for _ in range(lookup_size)], "limit": 10}
+        return "POST", "/recommendations/lookup", {"json": data}
+
+    return build
+
+
+def run_scenario(client, name, build, total, concurrency, measure=read_rss_kb):  # pylint: disable=R0913
+    """Sends `total` requests of a scenario from `concurrency` threads and returns its report
+
+    Args:
+        measure (callable): returns the RSS of the service in kB, sampled during the scenario
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def send(_):
+        method, path, kwargs = build()
+        start = time.perf_counter()
+        code = client.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if code >= 400:
+                errors.append(code)
+
+    sampler = RssSampler(measure).start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(total)))
+    elapsed = time.perf_counter() - start
+    return summarize(name, latencies, len(errors), elapsed, sampler.stop())
+
+
+def rss_target(args):
+    """Returns the description of the process whose RSS is reported and the function measuring it"""
+    if args.service_pid:
+        return f"service pid {args.service_pid} and its children", lambda: tree_rss_kb(args.service_pid)
+    if args.url:
+        return "not measured, pass --service-pid", lambda: None
+    return "benchmark process (in-process app and client)", read_rss_kb
+
+
+def run_scenarios(args, scenarios, pids, ids):
+    """Runs the scenarios and returns their reports with the process their RSS belongs to"""
+    client = Client(args.url)
+    rss_of, measure = rss_target(args)
+    return {
+        "rss_of": rss_of,
+        "scenarios": [
+            run_scenario(
+                client, name, make_requests(name, pids, tuple(ids), args.lookup_size), args.requests, args.concurrency,
+                measure,
+            )
+            for name in scenarios
+        ],
+    }
+
+
+def seed_database(parser, args):
+    """Seeds the database unless --no-seed is given, returns the pids of the seeded products"""
+    from benchmarks import seed  # pylint: disable=import-outside-toplevel
+    if args.no_seed:
+        return range(1, 1 + (args.rows + args.fanout - 1) // args.fanout)
+    try:
+        return seed.seed(args.rows, args.fanout, reset=args.reset)
+    except ValueError as error:
+        return parser.error(str(error))
+
+
+def main(argv=None):
+    """Seeds the database, runs the scenarios and prints the JSON report"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="Recommendations to seed (default 10000)")
+    parser.add_argument("--fanout", type=int, default=10, help="Recommendations per product (default 10)")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario (default 1000)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients (default 8)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios")
+    parser.add_argument("--lookup-size", type=int, default=20, help="pids per lookup request (default 20)")
+    parser.add_argument("--url", help="base URL of a running service instead of the in-process app")
+    parser.add_argument("--service-pid", type=int, help="pid of the service at --url whose RSS is reported")
+    parser.add_argument("--no-seed", action="store_true", help="keep the Recommendations already seeded")
+    parser.add_argument("--reset", action="store_true", help="delete the existing Recommendations before seeding")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # Importing the service sets up the database session, not the tables
+    from service import app  # pylint: disable=import-outside-toplevel
+    from benchmarks import seed  # pylint: disable=import-outside-toplevel
+    seed.prepare()
+    app.logger.setLevel(logging.WARNING)
+    logging.getLogger("flask.app").setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    pids = seed_database(parser, args)
+    seed_seconds = time.perf_counter() - start
+    ids = seed.id_range()
+
+    report = {
+        "database": app.config["SQLALCHEMY_DATABASE_URI"].split("@")[-1],
+        "target": args.url or "in-process",
+        "rows": args.rows,
+        "concurrency": args.concurrency,
+        "seed_seconds": round(seed_seconds, 3),
+        **run_scenarios(args, scenarios, pids, ids),
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
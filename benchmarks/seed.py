@@ -0,0 +1,79 @@
+"""
+Seeding
+
+Fills the database with generated Recommendations built by the test
+factories, in chunks committed with Recommendation.bulk_create().
+"""
+import itertools
+from service.common import migrations
+from service.common.cache import cache
+from service.models import ProductVersion, Recommendation, RecommendationType, db
+from tests.utils import make_recommendation
+
+TYPES = list(RecommendationType)
+
+
+def generate(rows, fanout=10, first_pid=1):
+    """
+    Yields the data of `rows` Recommendations, `fanout` per product
+
+    Every product gets distinct recommended pids, so the rows never conflict
+    on (pid, recommended_pid, type).
+    """
+    for index in range(rows):
+        pid = first_pid + index // fanout
+        rec = make_recommendation(
+            pid,
+            pid + 1 + index % fanout,
+            rec_type=TYPES[index % len(TYPES)],
+            liked=index % 7 == 0,
+        )
+        data = rec.serialize()
+        data["score"] = float(index * 7919 % 1000) / 10
+        yield data
+
+
+def prepare():
+    """Brings the database to the latest schema, the service does not create the tables"""
+    return migrations.upgrade(db.engine)
+
+
+def delete_all():
+    """Deletes every Recommendation like the other writes do, returns the number of products emptied"""
+    pids = db.session.execute(db.select(Recommendation.pid).distinct()).scalars().all()
+    try:
+        db.session.execute(db.delete(Recommendation), execution_options={"synchronize_session": False})
+        ProductVersion.bump(pids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    cache.invalidate(pids=pids)
+    return len(pids)
+
+
+def seed(rows, fanout=10, chunk_size=100000, batch_size=1000, reset=False):  # pylint: disable=R0913
+    """
+    Creates `rows` new Recommendations, returns the pids used
+
+    The existing Recommendations are only deleted when `reset` is set.
+
+    Raises:
+        ValueError: if the table already has Recommendations and reset is not set
+    """
+    if reset:
+        delete_all()
+    elif db.session.execute(db.select(Recommendation.id).limit(1)).first() is not None:
+        raise ValueError("The database already has Recommendations, pass --reset to delete them")
+    items = generate(rows, fanout)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        Recommendation.bulk_create(chunk, batch_size=batch_size)
+    return range(1, 1 + (rows + fanout - 1) // fanout)
+
+
+def id_range():
+    """Returns the lowest and highest Recommendation ids"""
+    return db.session.execute(db.select(db.func.min(Recommendation.id), db.func.max(Recommendation.id))).one()
@@ -0,0 +1,42 @@
+"""
+Gunicorn configuration
+
+gunicorn loads this file from the working directory. When
+PROMETHEUS_MULTIPROC_DIR is set, every worker writes its metrics to that
+directory, which is emptied when the server starts, and the files of the
+workers that exit are merged into the totals of the dead workers.
+
+The app is imported once by the master and forked into the workers
+(GUNICORN_PRELOAD=false imports it in every worker instead). The workers
+drop the database connections inherited from the master, and start their
+own adjacency index and like write-behind threads on first use.
+"""
+import os
+import shutil
+import sys
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("true", "yes", "1")
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Starts the metrics of the server from scratch, the workers are not forked yet"""
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Stops reporting the live gauges of a worker that exited"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Keeps a preloaded worker off the connections of the master"""
+    if "service.models" in sys.modules:
+        from service import app  # pylint: disable=import-outside-toplevel
+        from service.models import db  # pylint: disable=import-outside-toplevel
+        with app.app_context():
+            db.engine.dispose(close=False)
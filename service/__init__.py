@@ -4,11 +4,10 @@ Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
-import sys
 from flask import Flask
 from flask_restx import Api
 from service import config
-from service.common import log_handlers
+from service.common import log_handlers, metrics, query_stats
 
 # Create Flask application
 app = Flask(__name__)
@@ -36,24 +35,36 @@ def init_api():
                )
 
 
-# Dependencies require we import the routes AFTER the Flask app is created
-# pylint: disable=wrong-import-position, wrong-import-order, cyclic-import
-from service import routes, models  # noqa: E402, E261
-# pylint: disable=wrong-import-position
-from service.common import cli_commands  # noqa: F401, E402
+def configure_app():
+    """
+    Sets up the routes, logging, metrics and database session of the module app, once
 
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
+    Nothing here talks to the database: the tables are created by
+    `flask db-migrate`, or at startup with DB_AUTO_CREATE=true, so that a
+    worker boots while the database is unreachable. The Swagger spec is only
+    built when /swagger.json is first requested.
+    """
+    if "service" in app.extensions:
+        return app
 
-app.logger.info(70 * "*")
-app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+    # Dependencies require we import the routes AFTER the Flask app is created
+    # pylint: disable=import-outside-toplevel, cyclic-import, unused-import
+    from service import routes, models  # noqa: F401
+    from service.common import cli_commands  # noqa: F401
 
-try:
-    models.init_db(app)  # make our SQLAlchemy tables
-except Exception as error:  # pylint: disable=broad-except
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
+    # Set up logging for production
+    log_handlers.init_logging(app, "gunicorn.error")
+    metrics.init_app(app)
+    query_stats.init_app(app)
 
-app.logger.info("Service initialized!")
+    app.logger.info(70 * "*")
+    app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    models.init_db(app)
+    app.extensions["service"] = True
+    app.logger.info("Service initialized!")
+    return app
+
+
+configure_app()
@@ -0,0 +1,216 @@
+"""
+Async serving mode
+
+An ASGI application that serves the read endpoints
+(`GET /recommendations` and `GET /recommendations/{id}`) on SQLAlchemy's
+asyncio engine, so that a worker keeps hundreds of lookups in flight while
+they wait on PostgreSQL. Every other request is handed to the Flask app on a
+thread pool.
+
+Run it with:
+    uvicorn --host 0.0.0.0 --port $PORT service.asgi:app
+
+The queries are built by the same Recommendation model methods as the sync
+routes, and the query parameters, cursors and ETags are handled by the same
+helpers of service.common.pagination. PostgreSQL is reached through asyncpg and SQLite through aiosqlite.
+"""
+import json
+import os
+from urllib.parse import parse_qsl, urlencode
+from flask_restx import marshal
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from werkzeug.http import parse_etags, quote_etag
+from service import app as flask_app, config
+from service.common import status
+from service.common.pagination import (
+    list_params, next_page_query, parse_list_args, product_list_etag, recommendation_etag
+)
+from service.models import DataValidationError, ProductVersion, Recommendation, RecommendationRecord
+from service.routes import recommendation_model
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_database_url(database_uri):
+    """Returns the database URI using the asyncio driver of its database"""
+    url = make_url(database_uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No asyncio driver for '{backend}' databases")
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == "postgresql" and os.getenv("DB_POOL_MODE", "queue") == "null":
+        # PgBouncer in transaction mode cannot keep asyncpg's prepared statements
+        url = url.update_query_dict({"prepared_statement_cache_size": "0"})
+    return url
+
+
+def async_engine_options(database_uri):
+    """Returns the engine options of config.engine_options() for the asyncio drivers"""
+    options = config.engine_options(database_uri)
+    options.pop("connect_args", None)
+    if database_uri.startswith("postgresql"):
+        connect_args = {"timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "10"))}
+        statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+        if statement_timeout:
+            connect_args["server_settings"] = {"statement_timeout": str(statement_timeout)}
+        if os.getenv("DB_POOL_MODE", "queue") == "null":
+            connect_args["statement_cache_size"] = 0
+        options["connect_args"] = connect_args
+    return options
+
+
+######################################################################
+# READ ENDPOINTS
+######################################################################
+async def fetch_records(session, stmt):
+    """Runs a SELECT of Recommendations and returns read-only records"""
+    result = await session.execute(Recommendation.select_fields(stmt))
+    return list(map(RecommendationRecord._make, result))
+
+
+def marshal_list(records):
+    """Returns Recommendation records in the schema of the sync routes"""
+    return [record.serialize() for record in records]
+
+
+async def list_recommendations(session, args, url, if_none_match):
+    """Returns the Recommendations matching the filters, one page at a time if asked"""
+    args = parse_list_args(args)
+    filters = {"pid": args["pid"], "rec_type": args["type"], "liked": args["liked"]}
+    headers = {}
+
+    if args["limit"] is None:
+        if args["pid"] is not None:
+            # The version is read first so it can never be newer than the rows
+            version = (await session.execute(ProductVersion.select_version(args["pid"]))).scalar() or 0
+            etag = product_list_etag(args["pid"], list_params(args), version)
+            headers["ETag"] = quote_etag(etag)
+            if if_none_match and etag in parse_etags(if_none_match):
+                return status.HTTP_304_NOT_MODIFIED, None, headers
+        stmt = Recommendation.select_by_attributes(limit=args["amount"], **filters)
+        recommendations = await fetch_records(session, stmt)
+        return status.HTTP_200_OK, marshal_list(recommendations), headers
+
+    # Fetch one extra row to know whether there is a next page
+    limit = args["limit"]
+    stmt = Recommendation.select_by_attributes(limit=limit + 1, after_id=args["after_id"], **filters)
+    recommendations = await fetch_records(session, stmt)
+    if len(recommendations) > limit:
+        recommendations = recommendations[:limit]
+        query = next_page_query(url["args"], limit, recommendations[-1].id)
+        headers["Link"] = f'<{url["base"]}?{urlencode(query)}>; rel="next"'
+    return status.HTTP_200_OK, marshal_list(recommendations), headers
+
+
+async def get_recommendation(session, recommendation_id, if_none_match):
+    """Returns a single Recommendation with its ETag, or a 304 while it did not change"""
+    rec = await session.get(Recommendation, recommendation_id)
+    if not rec:
+        return status.HTTP_404_NOT_FOUND, {
+            "message": f"Recommendation with id '{recommendation_id}' could not be found.",
+        }, {}
+
+    etag = recommendation_etag(recommendation_id, rec.version)
+    headers = {"ETag": quote_etag(etag)}
+    if if_none_match and etag in parse_etags(if_none_match):
+        return status.HTTP_304_NOT_MODIFIED, None, headers
+    return status.HTTP_200_OK, marshal(rec.serialize(), recommendation_model), headers
+
+
+######################################################################
+# A S G I   A P P L I C A T I O N
+######################################################################
+class AsyncReadApp:
+    """Serves the read endpoints on the asyncio engine and everything else with Flask"""
+
+    def __init__(self, wsgi_app, database_uri):
+        self.fallback = WSGIMiddleware(wsgi_app)
+        self.database_uri = database_uri
+        self.engine = None
+        self.sessions = None
+
+    def start(self):
+        """Creates the asyncio engine, once per worker"""
+        if self.engine is None:
+            self.engine = create_async_engine(
+                async_database_url(self.database_uri), **async_engine_options(self.database_uri)
+            )
+            self.sessions = async_sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def stop(self):
+        """Closes the connections of the asyncio engine"""
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        route = self.match(scope)
+        if route is None:
+            await self.fallback(scope, receive, send)
+            return
+
+        self.start()
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        try:
+            async with self.sessions() as session:
+                if route == "list":
+                    args = dict(reversed(parse_qsl(scope["query_string"].decode("latin-1"))))
+                    url = {"base": self.base_url(scope, headers), "args": args}
+                    code, body, response_headers = await list_recommendations(
+                        session, args, url, headers.get("if-none-match")
+                    )
+                else:
+                    code, body, response_headers = await get_recommendation(
+                        session, route, headers.get("if-none-match")
+                    )
+        except DataValidationError as error:
+            code, response_headers = status.HTTP_400_BAD_REQUEST, {}
+            body = {"status_code": code, "error": "Bad Request", "message": str(error)}
+        await self.respond(send, code, body, response_headers)
+
+    @staticmethod
+    def match(scope):
+        """Returns "list", a Recommendation id, or None when Flask must answer"""
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return None
+        parts = scope["path"].strip("/").split("/")
+        if parts == ["recommendations"]:
+            return "list"
+        if len(parts) == 2 and parts[0] == "recommendations" and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    @staticmethod
+    def base_url(scope, headers):
+        """Returns the external URL of the requested path"""
+        host = headers.get("host") or f"{scope['server'][0]}:{scope['server'][1]}"
+        return f"{scope.get('scheme', 'http')}://{host}{scope['path']}"
+
+    @staticmethod
+    async def respond(send, code, body, headers):
+        """Sends a JSON response"""
+        payload = b"" if body is None else json.dumps(body).encode("utf-8") + b"\n"
+        raw_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]
+        raw_headers += [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()]
+        await send({"type": "http.response.start", "status": code, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": payload})
+
+    async def lifespan(self, receive, send):
+        """Opens the engine when the worker starts and closes it when it stops"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = AsyncReadApp(flask_app, flask_app.config["SQLALCHEMY_DATABASE_URI"])
@@ -0,0 +1,309 @@
+"""
+Adjacency Index
+
+An optional in-process copy of the Recommendation graph that answers the
+per-product lists without touching the database.
+
+The edges are stored in compressed sparse row (CSR) arrays. One sorted array
+holds every known pid with the change counter of its product, and every type
+of Recommendation gets its own offsets array over those pids plus one array
+per column (id, recommended_pid, liked, score). An edge costs 17 bytes, so a
+million Recommendations fit in about 20MB.
+
+The index is refreshed by a background thread. The first refresh loads the
+whole table. The next ones only reload the products whose change counter moved
+since the `updated_at` watermark of product_version, into an overlay that is
+merged into new arrays once it grows. Every refresh publishes a new immutable
+snapshot, so the readers never lock.
+
+The pids written by this worker are served from the database until a refresh
+that started after the write has reloaded them. The changes of the other
+workers are seen after at most one refresh interval.
+"""
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from array import array
+from datetime import timedelta
+from operator import itemgetter
+
+logger = logging.getLogger("flask.app")
+
+# Columns of the edge tuples: the public fields of a Recommendation
+ID, PID, RECOMMENDED_PID, TYPE, LIKED, SCORE = range(6)
+LIKED_CODES = {None: -1, False: 0, True: 1}
+LIKED_VALUES = {-1: None, 0: False, 1: True}
+
+
+class TypeEdges:
+    """The CSR arrays of the Recommendations of one type"""
+
+    __slots__ = ("offsets", "ids", "targets", "liked", "scores")
+
+    def __init__(self, pid_count):
+        # Every pid before the first edge of this type has no edge of it
+        self.offsets = array("q", [0] * (pid_count + 1))
+        self.ids = array("i")
+        self.targets = array("i")
+        self.liked = array("b")
+        self.scores = array("d")
+
+    def append(self, edge):
+        """Adds an edge to the pid being built"""
+        self.ids.append(edge[ID])
+        self.targets.append(edge[RECOMMENDED_PID])
+        self.liked.append(LIKED_CODES[edge[LIKED]])
+        self.scores.append(edge[SCORE])
+
+    def edges(self, position, pid, rec_type):
+        """Returns the edges of the pid at the given position"""
+        return [
+            (self.ids[i], pid, self.targets[i], rec_type, LIKED_VALUES[self.liked[i]], self.scores[i])
+            for i in range(self.offsets[position], self.offsets[position + 1])
+        ]
+
+    def nbytes(self):
+        """Returns the memory used by the arrays"""
+        return sum(column.itemsize * len(column) for column in (self.offsets, self.ids, self.targets, self.liked, self.scores))
+
+
+class AdjacencyArrays:
+    """The CSR arrays of every type over one sorted array of pids"""
+
+    __slots__ = ("pids", "versions", "types")
+
+    def __init__(self):
+        self.pids = array("i")
+        self.versions = array("q")
+        self.types = {}
+
+    @classmethod
+    def build(cls, groups):
+        """Builds the arrays from (pid, version, edges) groups sorted by pid"""
+        arrays = cls()
+        for pid, version, edges in groups:
+            position = len(arrays.pids)
+            arrays.pids.append(pid)
+            arrays.versions.append(version)
+            for edge in edges:
+                if edge[TYPE] not in arrays.types:
+                    arrays.types[edge[TYPE]] = TypeEdges(position)
+                arrays.types[edge[TYPE]].append(edge)
+            for type_edges in arrays.types.values():
+                type_edges.offsets.append(len(type_edges.ids))
+        return arrays
+
+    def find(self, pid):
+        """Returns the version and the edges of a pid ordered by id, or None if it is unknown"""
+        position = bisect.bisect_left(self.pids, pid)
+        if position == len(self.pids) or self.pids[position] != pid:
+            return None
+        edges = []
+        for rec_type, type_edges in self.types.items():
+            edges.extend(type_edges.edges(position, pid, rec_type))
+        edges.sort(key=itemgetter(ID))
+        return self.versions[position], edges
+
+    def groups(self):
+        """Yields the (pid, version, edges) of every pid"""
+        for pid in self.pids:
+            yield (pid, *self.find(pid))
+
+    def edge_count(self):
+        """Returns the number of edges"""
+        return sum(len(type_edges.ids) for type_edges in self.types.values())
+
+    def nbytes(self):
+        """Returns the memory used by the arrays"""
+        size = self.pids.itemsize * len(self.pids) + self.versions.itemsize * len(self.versions)
+        return size + sum(type_edges.nbytes() for type_edges in self.types.values())
+
+
+def merge_groups(versions, edges):
+    """
+    Yields (pid, version, edges) sorted by pid
+
+    Args:
+        versions (dict): the change counter of every product
+        edges (iterable): the edge tuples ordered by pid and id
+    """
+    version_items = ((pid, 0, version) for pid, version in sorted(versions.items()))
+    edge_groups = ((pid, 1, list(group)) for pid, group in itertools.groupby(edges, key=itemgetter(PID)))
+    for pid, items in itertools.groupby(heapq.merge(version_items, edge_groups, key=itemgetter(0, 1)), key=itemgetter(0)):
+        version, group = 0, []
+        for _, kind, value in items:
+            if kind == 0:
+                version = value
+            else:
+                group = value
+        yield pid, version, group
+
+
+class Snapshot:  # pylint: disable=too-few-public-methods
+    """An immutable state of the index: the arrays, the overlay of the changed pids and the watermark"""
+
+    __slots__ = ("arrays", "overlay", "watermark")
+
+    def __init__(self, arrays, overlay, watermark):
+        self.arrays = arrays
+        self.overlay = overlay
+        self.watermark = watermark
+
+    def find(self, pid):
+        """Returns the version and the edges of a pid ordered by id"""
+        found = self.overlay.get(pid)
+        if found is None:
+            found = self.arrays.find(pid)
+        # Products that never had a Recommendation have none and version 0
+        return found if found is not None else (0, [])
+
+
+class AdjacencyIndex:
+    """The in-process Recommendation graph, refreshed from the database in the background"""
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.load_versions = None
+        self.load_edges = None
+        self.interval = 2.0
+        self.overlap = timedelta(seconds=30)
+        self.snapshot = None
+        self.dirty = {}
+        self.refreshes = 0
+        self.last_refresh_seconds = None
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    def init_app(self, app, load_versions, load_edges):
+        """
+        Configures the index from the Flask configuration
+
+        Args:
+            load_versions (callable): load_versions(since) returns the (pid, version, updated_at)
+                of the products changed since a datetime, or of all of them when since is None
+            load_edges (callable): load_edges(pids) returns the edge tuples of the given products,
+                or of all of them when pids is None, ordered by pid and id
+        """
+        self.app = app
+        self.enabled = app.config.get("ADJACENCY_INDEX", False)
+        self.interval = app.config.get("ADJACENCY_REFRESH_SECONDS", 2.0)
+        self.overlap = timedelta(seconds=app.config.get("ADJACENCY_REFRESH_OVERLAP", 30))
+        self.load_versions = load_versions
+        self.load_edges = load_edges
+        self.snapshot = None
+        if self.enabled:
+            logger.info("Using the in-process adjacency index")
+
+    def lookup(self, pid):
+        """Returns the version and the edges of a product, or None when the database must answer"""
+        if not self.enabled:
+            return None
+        self.start()
+        snapshot = self.snapshot
+        if snapshot is None or pid in self.dirty:
+            return None
+        return snapshot.find(pid)
+
+    def invalidate(self, ids=(), pids=()):  # pylint: disable=unused-argument
+        """Sends the given products to the database until a later refresh reloads them"""
+        if self.enabled:
+            now = time.monotonic()
+            for pid in pids:
+                self.dirty[pid] = now
+
+    def start(self):
+        """Starts the refresh thread of this process"""
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="adjacency-index", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Adjacency index refresh failed")
+            time.sleep(self.interval)
+
+    def refresh(self):
+        """Loads the whole table on the first call, then only the products that changed"""
+        started = time.monotonic()
+        snapshot = self.snapshot
+        if snapshot is None:
+            changes = self.load_versions(None)
+            versions = {pid: version for pid, version, _ in changes}
+            arrays = AdjacencyArrays.build(merge_groups(versions, self.load_edges(None)))
+            snapshot = Snapshot(arrays, {}, self._watermark(changes, None))
+        else:
+            since = snapshot.watermark - self.overlap if snapshot.watermark is not None else None
+            changes = self.load_versions(since)
+            changed = {
+                pid: version for pid, version, _ in changes
+                if version > snapshot.find(pid)[0] or pid in self.dirty
+            }
+            overlay = dict(snapshot.overlay)
+            if changed:
+                edges = {pid: [] for pid in changed}
+                for edge in self.load_edges(sorted(changed)):
+                    edges[edge[PID]].append(edge)
+                overlay.update((pid, (version, edges[pid])) for pid, version in changed.items())
+            arrays = snapshot.arrays
+            if len(overlay) > max(1000, len(arrays.pids) // 10):
+                arrays = self._compact(arrays, overlay)
+                overlay = {}
+            snapshot = Snapshot(arrays, overlay, self._watermark(changes, snapshot.watermark))
+
+        self.snapshot = snapshot
+        for pid, marked in list(self.dirty.items()):
+            if marked < started:
+                self.dirty.pop(pid, None)
+        self.refreshes += 1
+        self.last_refresh_seconds = time.monotonic() - started
+
+    @staticmethod
+    def _watermark(changes, watermark):
+        """Returns the latest updated_at seen"""
+        for _, _, updated_at in changes:
+            if updated_at is not None and (watermark is None or updated_at > watermark):
+                watermark = updated_at
+        return watermark
+
+    @staticmethod
+    def _compact(arrays, overlay):
+        """Returns new arrays with the overlay merged in"""
+        pids = sorted(set(arrays.pids).union(overlay))
+        return AdjacencyArrays.build(
+            (pid, *(overlay.get(pid) or arrays.find(pid))) for pid in pids
+        )
+
+    def stats(self):
+        """Returns the counters of the index"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {"enabled": self.enabled, "loaded": False}
+        return {
+            "enabled": self.enabled,
+            "loaded": True,
+            "pids": len(snapshot.arrays.pids),
+            "edges": snapshot.arrays.edge_count(),
+            "overlay": len(snapshot.overlay),
+            "bytes": snapshot.arrays.nbytes(),
+            "dirty": len(self.dirty),
+            "refreshes": self.refreshes,
+            "last_refresh_seconds": round(self.last_refresh_seconds, 6),
+            "watermark": snapshot.watermark.isoformat() if snapshot.watermark else None,
+        }
+
+
+# The index used by the service, configured by init_db()
+adjacency_index = AdjacencyIndex()
@@ -0,0 +1,297 @@
+"""
+Cache
+
+Read-through cache for single Recommendations and per-product lists.
+
+The entries are invalidated by the model on every write. Single
+Recommendations and per-product lists are keyed with a generation number that
+is replaced on write, so every cached variant of a list (type, liked,
+amount...) becomes unreachable at once. The generation is read before the
+database, so a reader that loaded a row just before a write commits stores it
+under a generation that is already gone. Generations come from a sequence
+that never repeats, which keeps the invalidation exact even when the
+generation itself is evicted.
+
+Backends:
+    none   - caching disabled (the default)
+    memory - an in-process LRU with a TTL, only for a single worker process:
+             the writes served by other workers do not invalidate it
+    redis  - a shared Redis server, so that all the workers see the same cache
+"""
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+MISSING = object()
+
+
+class NullBackend:
+    """A backend that never caches anything"""
+
+    name = "none"
+
+    def get(self, key):  # pylint: disable=unused-argument
+        """Returns the value of a key or MISSING"""
+        return MISSING
+
+    def set(self, key, value):
+        """Stores the value of a key"""
+
+    def add(self, key, value):  # pylint: disable=unused-argument
+        """Stores the value of a key unless it has one, returns the value of the key"""
+        return value
+
+    def delete(self, *keys):
+        """Removes keys"""
+
+    def clear(self):
+        """Removes every key"""
+
+    def next_sequence(self):
+        """Returns a number that was never returned before"""
+        return 0
+
+    def __len__(self):
+        return 0
+
+
+class MemoryBackend:
+    """An in-process LRU cache where every entry lives at most `ttl` seconds"""
+
+    name = "memory"
+
+    def __init__(self, max_entries=10000, ttl=30.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._sequence = itertools.count(1)
+
+    def get(self, key):
+        """Returns the value of a key or MISSING"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires <= self._clock():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Stores the value of a key, evicting the least recently used keys"""
+        with self._lock:
+            self._store(key, value)
+
+    def add(self, key, value):
+        """Stores the value of a key unless it has one, returns the value of the key"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                return entry[1]
+            self._store(key, value)
+            return value
+
+    def _store(self, key, value):
+        """Stores the value of a key while holding the lock"""
+        self._entries[key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """Removes keys"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every key"""
+        with self._lock:
+            self._entries.clear()
+
+    def next_sequence(self):
+        """Returns a number that was never returned before"""
+        return next(self._sequence)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """
+    A Redis cache shared by every worker, values are stored as JSON
+
+    It fails open: while Redis is unreachable every read is a miss, the writes
+    are skipped and the errors are logged, so the service keeps answering from
+    the database.
+    """
+
+    name = "redis"
+
+    def __init__(self, url=None, ttl=30.0, prefix="recommendations:", client=None, errors=None):
+        if client is None:
+            import redis  # pylint: disable=import-outside-toplevel
+            client = redis.Redis.from_url(url)
+        if errors is None:
+            try:
+                import redis  # pylint: disable=import-outside-toplevel, reimported
+                errors = (redis.RedisError,)
+            except ImportError:
+                errors = ()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.errors = errors
+        self.failures = 0
+
+    def _call(self, default, method, *args, **kwargs):
+        """Returns the result of a client method, or the default when Redis fails"""
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except self.errors as error:
+            self.failures += 1
+            logger.warning("Redis cache %s failed, continuing without it: %s", method, error)
+            return default
+
+    def get(self, key):
+        """Returns the value of a key or MISSING"""
+        value = self._call(None, "get", self.prefix + key)
+        return MISSING if value is None else json.loads(value)
+
+    def set(self, key, value):
+        """Stores the value of a key"""
+        self._call(None, "set", self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def add(self, key, value):
+        """Stores the value of a key unless it has one, returns the value of the key"""
+        if self._call(None, "set", self.prefix + key, json.dumps(value), px=int(self.ttl * 1000), nx=True):
+            return value
+        existing = self.get(key)
+        return value if existing is MISSING else existing
+
+    def delete(self, *keys):
+        """Removes keys"""
+        if keys:
+            self._call(None, "delete", *[self.prefix + key for key in keys])
+
+    def _keys(self):
+        """Returns the keys of the cache, or none when Redis fails"""
+        try:
+            return list(self.client.scan_iter(match=self.prefix + "*"))
+        except self.errors as error:
+            self.failures += 1
+            logger.warning("Redis cache scan failed, continuing without it: %s", error)
+            return []
+
+    def clear(self):
+        """Removes every key"""
+        keys = self._keys()
+        if keys:
+            self._call(None, "delete", *keys)
+
+    def next_sequence(self):
+        """Returns a number that was never returned before"""
+        sequence = self._call(None, "incr", self.prefix + "sequence")
+        # A random generation never matches an entry, should Redis come back meanwhile
+        return sequence if sequence is not None else f"local-{uuid.uuid4().hex}"
+
+    def __len__(self):
+        return len(self._keys())
+
+
+class RecommendationCache:
+    """Read-through cache of Recommendations with write invalidation and hit/miss counters"""
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else NullBackend()
+        # Called with the ids and pids of every invalidation
+        self.listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        """Configures the backend from the Flask configuration"""
+        name = app.config.get("CACHE_BACKEND", "none")
+        ttl = app.config.get("CACHE_TTL", 30)
+        if name == "memory":
+            backend = MemoryBackend(max_entries=app.config.get("CACHE_MAX_ENTRIES", 10000), ttl=ttl)
+        elif name == "redis":
+            backend = RedisBackend(url=app.config.get("CACHE_REDIS_URL"), ttl=ttl)
+        elif name == "none":
+            backend = NullBackend()
+        else:
+            raise ValueError(f"Unknown CACHE_BACKEND '{name}'")
+        logger.info("Using the %s recommendation cache", backend.name)
+        self.backend = backend
+
+    def get_recommendation(self, rec_id, loader):
+        """Returns the serialized Recommendation with the given id, calling loader() on a miss"""
+        return self._read_through(f"rec:{rec_id}:{self._generation(f'rec:{rec_id}')}", loader)
+
+    def get_pid_list(self, pid, params, loader):
+        """Returns a serialized list of the Recommendations of a product, calling loader() on a miss"""
+        variant = ":".join(str(param) for param in params)
+        return self._read_through(f"pid:{pid}:{self._generation(pid)}:{variant}", loader)
+
+    def invalidate(self, ids=(), pids=()):
+        """Forgets the given Recommendations and every cached list of the given products"""
+        names = {f"rec:{rec_id}" for rec_id in ids if rec_id is not None} | {pid for pid in pids if pid is not None}
+        if names:
+            # One new number is enough, no key ever had it
+            generation = self.backend.next_sequence()
+            for name in names:
+                self.backend.set(f"gen:{name}", generation)
+        self.invalidations += 1
+        for listener in self.listeners:
+            listener(ids=ids, pids=pids)
+
+    def clear(self):
+        """Forgets every cached entry"""
+        self.backend.clear()
+
+    def stats(self):
+        """Returns the counters of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name,
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+    def _generation(self, name):
+        """Returns the current generation of a Recommendation ("rec:<id>") or of the lists of a product (its pid)"""
+        generation = self.backend.get(f"gen:{name}")
+        if generation is MISSING:
+            # A fresh generation can never match an entry cached before, and it never replaces the one of a
+            # concurrent invalidation
+            generation = self.backend.add(f"gen:{name}", self.backend.next_sequence())
+        return generation
+
+    def _read_through(self, key, loader):
+        value = self.backend.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+
+# The cache used by the service, configured by init_db()
+cache = RecommendationCache()
@@ -1,8 +1,11 @@
 """
 Flask CLI Command Extensions
 """
+import click
 from service import app
 from service.models import db
+from service.common import migrations
+from service.common.migrations import MigrationError
 
 
 ######################################################################
@@ -19,3 +22,25 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+    migrations.stamp(db.engine)
+
+
+######################################################################
+# Command to upgrade an existing database in place
+# Usage:
+#   flask db-migrate [--dedupe]
+######################################################################
+@app.cli.command("db-migrate")
+@click.option("--dedupe", is_flag=True, help="Delete the duplicated Recommendations, keeping the lowest id of each.")
+def db_migrate(dedupe):
+    """
+    Applies the pending schema migrations without dropping any data
+    """
+    try:
+        applied = migrations.upgrade(db.engine, dedupe=dedupe)
+    except MigrationError as error:
+        raise click.ClickException(str(error)) from error
+    for version, description in applied:
+        click.echo(f"Applied migration {version}: {description}")
+    if not applied:
+        click.echo(f"Database is up to date at version {migrations.head()}")
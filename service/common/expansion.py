@@ -0,0 +1,96 @@
+"""
+Expansion
+
+Hop-wise breadth-first walk of the Recommendation graph, used to recommend
+the products that are two or three hops away from a product.
+
+A product reached at hop h scores the sum, over its parents at hop h - 1, of
+the parent score times the weight of the edge. The weight of an edge depends
+on its type and on whether it was liked, and every hop after the first is
+damped by a decay factor. Every product is kept at the first hop it is
+reached, so the walk is linear in the edges it visits. Only the best
+`frontier_limit` products of a hop are expanded further, and the walk stops
+early, returning what it found, once its time budget is spent.
+"""
+import heapq
+import time
+
+TYPE_WEIGHTS = {
+    "frequently-together": 1.0,
+    "accessory": 0.8,
+    "cross-sell": 0.7,
+    "up-sell": 0.6,
+    "default": 0.5,
+}
+LIKED_BOOST = 1.5
+DEPTH_DECAY = 0.5
+
+
+class Expansion:  # pylint: disable=too-few-public-methods
+    """The result of an expansion"""
+
+    __slots__ = ("recommendations", "truncated", "visited")
+
+    def __init__(self, recommendations, truncated, visited):
+        self.recommendations = recommendations
+        self.truncated = truncated
+        self.visited = visited
+
+
+def edge_weight(edge_type, liked, weights=None):
+    """Returns the weight of an edge of the given type"""
+    weight = (weights or TYPE_WEIGHTS).get(edge_type, 0.0)
+    return weight * LIKED_BOOST if liked else weight
+
+
+def expand(origin, neighbors, depth, limit, budget, frontier_limit=200, weights=None):  # pylint: disable=R0913
+    """
+    Returns the best products reachable from a product in at most `depth` hops
+
+    Args:
+        origin (int): the pid of the product
+        neighbors (callable): neighbors(pids) returns {pid: [(recommended_pid, type, liked)]}
+        depth (int): the number of hops to walk
+        limit (int): the number of products to return
+        budget (float): the seconds the walk may take
+        frontier_limit (int): the number of products of a hop that are expanded further
+        weights (dict): the weight of every type of Recommendation
+
+    Returns:
+        Expansion: the recommendations as (recommended_pid, score, depth, via) sorted by
+            descending score, and whether the time budget cut the walk short
+    """
+    deadline = time.monotonic() + budget
+    found = {}
+    frontier = {origin: 1.0}
+    visited = 0
+    truncated = False
+    for hop in range(1, depth + 1):
+        if time.monotonic() > deadline:
+            truncated = True
+            break
+        decay = DEPTH_DECAY ** (hop - 1)
+        reached = {}
+        for pid, edges in neighbors(list(frontier)).items():
+            parent_score = frontier[pid]
+            for recommended_pid, edge_type, liked in edges:
+                visited += 1
+                if recommended_pid == origin or recommended_pid in found:
+                    continue
+                score = parent_score * edge_weight(edge_type, liked, weights) * decay
+                if score <= 0:
+                    continue
+                if recommended_pid in reached:
+                    best_score, best_via = reached[recommended_pid]
+                    reached[recommended_pid] = (best_score + score, best_via if best_score >= score else pid)
+                else:
+                    reached[recommended_pid] = (score, pid)
+        for recommended_pid, (score, via) in reached.items():
+            found[recommended_pid] = (recommended_pid, score, hop, via)
+        best = heapq.nlargest(frontier_limit, reached.items(), key=lambda item: item[1][0])
+        frontier = {recommended_pid: score for recommended_pid, (score, _) in best}
+        if not frontier:
+            break
+
+    recommendations = heapq.nlargest(limit, found.values(), key=lambda item: (item[1], -item[0]))
+    return Expansion(recommendations, truncated, visited)
@@ -0,0 +1,54 @@
+"""
+Export
+
+Generators that encode a stream of database rows as NDJSON or CSV chunks,
+optionally gzip compressed, so that exports use constant memory whatever
+the number of rows.
+"""
+import csv
+import io
+import json
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+
+def ndjson_chunks(rows, fields, chunk_size=CHUNK_SIZE):
+    """Yields the rows as newline delimited JSON objects, a chunk at a time"""
+    buffer = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(fields, row)), separators=(",", ":")) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def csv_chunks(rows, fields, chunk_size=CHUNK_SIZE):
+    """Yields the rows as CSV with a header line, a chunk at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def gzip_chunks(chunks, level=6):
+    """Compresses a stream of chunks into a single gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,116 @@
+"""
+Health Checks
+
+Liveness and readiness of a worker, served by GET /health/live and
+GET /health/ready.
+
+A worker is live as long as it answers. It is ready when its database answers
+and neither its connection pool nor its queues are saturated, otherwise it is
+"down" or "degraded" and the load balancer should send the traffic elsewhere.
+
+The database check is cached for `HEALTH_CACHE_SECONDS` and run by one thread
+at a time, the others answering with the previous result, so that the probes
+never pile up on a database in trouble. It is not run while every connection
+of the pool is in use. The pool and queue checks only read in-process counters.
+"""
+import threading
+import time
+from service.common.pool_stats import pool_stats
+from service.common.write_behind import like_writes
+
+
+class HealthCheck:
+    """The readiness checks of this worker"""
+
+    def __init__(self, clock=time.monotonic):
+        self.check_database = None
+        self.cache_seconds = 2.0
+        self.pool_saturation = 0.9
+        self.pool_waiting = 4
+        self.queue_depth = 10000
+        self.clock = clock
+        self._database = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, check_database):
+        """
+        Configures the checks from the Flask configuration
+
+        Args:
+            check_database (callable): raises an exception when the database does not answer
+        """
+        self.check_database = check_database
+        self.cache_seconds = app.config.get("HEALTH_CACHE_SECONDS", 2.0)
+        self.pool_saturation = app.config.get("HEALTH_POOL_SATURATION", 0.9)
+        self.pool_waiting = app.config.get("HEALTH_POOL_WAITING", 4)
+        self.queue_depth = app.config.get("HEALTH_QUEUE_DEPTH", 10000)
+        self._database = None
+
+    def ready(self):
+        """Returns "ready", "degraded" or "down" with the result of every check"""
+        pool = self.pool()
+        database = self.database(refresh=not pool["exhausted"])
+        queues = self.queues()
+        if database["status"] != "up":
+            state = "down"
+        elif pool["status"] != "ok" or queues["status"] != "ok":
+            state = "degraded"
+        else:
+            state = "ready"
+        return {"status": state, "checks": {"database": database, "pool": pool, "queues": queues}}
+
+    def database(self, refresh=True):
+        """Returns the cached result of the database check, running it again once it expired"""
+        result = self._database
+        expired = result is None or self.clock() - result["checked_at"] >= self.cache_seconds
+        # Only the first check waits, the others keep the previous result while one thread runs it
+        if refresh and expired and self._lock.acquire(blocking=result is None):
+            try:
+                result = self._database
+                if result is None or self.clock() - result["checked_at"] >= self.cache_seconds:
+                    result = self._database = self._run_database_check()
+            finally:
+                self._lock.release()
+        if result is None:
+            return {"status": "unknown"}
+        report = {key: value for key, value in result.items() if key != "checked_at"}
+        report["age_seconds"] = round(self.clock() - result["checked_at"], 3)
+        return report
+
+    def _run_database_check(self):
+        start = self.clock()
+        result = {"status": "up"}
+        try:
+            self.check_database()
+        except Exception as error:  # pylint: disable=broad-except
+            result = {"status": "down", "error": str(error).splitlines()[0] if str(error) else type(error).__name__}
+        result["latency_ms"] = round((self.clock() - start) * 1000, 3)
+        result["checked_at"] = self.clock()
+        return result
+
+    def pool(self):
+        """Returns the share of the connections in use and the threads waiting for one"""
+        stats = pool_stats.stats()
+        capacity = stats["size"] + stats["max_overflow"]
+        saturation = stats["checked_out"] / capacity if capacity else 0.0
+        saturated = saturation >= self.pool_saturation or stats["waiting"] >= self.pool_waiting
+        return {
+            "status": "saturated" if saturated else "ok",
+            "checked_out": stats["checked_out"],
+            "capacity": capacity,
+            "saturation": round(saturation, 3),
+            "waiting": stats["waiting"],
+            "exhausted": bool(capacity) and stats["checked_out"] >= capacity,
+        }
+
+    def queues(self):
+        """Returns the depth of the in-process queues"""
+        depth = len(like_writes.pending)
+        return {
+            "status": "saturated" if depth >= self.queue_depth else "ok",
+            "like_write_behind": depth,
+        }
+
+
+# The checks of the service, configured by init_db()
+health = HealthCheck()
@@ -19,18 +19,321 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+The records of the app are formatted as one JSON object per line (LOG_FORMAT,
+"json" or "text") by a background thread: the request threads only put them
+on a bounded queue, and drop them when it is full rather than wait for stdout.
+
+Every record carries the id of its request, taken from the X-Request-ID
+header or generated, and sent back in the response. The records below WARNING
+of read_logger are sampled by LOG_SAMPLE_RATES, e.g. "flask.app.reads=0.01"
+keeps 1% of the logs of the hot read paths.
+
+The levels and sample rates can be changed without a redeploy by writing
+LOG_CONFIG_FILE, which every worker polls:
+
+    {"level": "WARNING", "levels": {"flask.app.reads": "ERROR"}, "sample_rates": {"flask.app.reads": 0.001}}
 """
+import atexit
+import json
 import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, has_request_context, request
+
+# The logger of the service modules, and the one of their hot read paths
+LOGGER = "flask.app"
+READ_LOGGER = "flask.app.reads"
+
+REQUEST_ID_HEADER = "X-Request-ID"
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+# The attributes of every LogRecord, the others are extras of the call
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one JSON object, with the extras of the call """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    """ Adds the id of the current request to a record """
+
+    def filter(self, record):
+        record.request_id = g.get("request_id") if has_request_context() else None
+        return True
+
+
+class SampledLogger(logging.LoggerAdapter):
+    """
+    A logger that keeps a share of its records below WARNING
+
+    The rate of the logger in LOG_SAMPLE_RATES is applied before the record is
+    even created, which is most of the cost of a log call.
+    """
+
+    def __init__(self, logger, config):
+        super().__init__(logger, {})
+        self.config = config
+
+    def isEnabledFor(self, level):
+        if not self.logger.isEnabledFor(level):
+            return False
+        rate = self.config.sample_rates.get(self.logger.name)
+        return rate is None or level >= logging.WARNING or random.random() < rate
+
+    def process(self, msg, kwargs):
+        return msg, kwargs
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    Puts the records on a bounded queue that a thread writes to the handlers
+
+    The thread is started on first use in every process, so that the workers
+    forked by gunicorn get their own. A SimpleQueue, bounded by its size, is
+    a lot cheaper for the request threads than a Queue and its conditions.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Starts the writer thread of this process"""
+        with self._start_lock:
+            if self.pid == os.getpid():
+                return
+            # The queue and thread inherited through fork are unusable
+            self.queue = queue.SimpleQueue()
+            self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Writes the queued records and stops the writer thread"""
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self.pid = None
+
+    def prepare(self, record):
+        """Merges the arguments into the message, leaving the formatting to the writer thread"""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        if self.queue.qsize() < self.maxsize:
+            self.queue.put_nowait(record)
+        else:
+            self.dropped += 1
+
+    def stats(self):
+        """Returns the depth of the queue and the records dropped"""
+        return {"queued": self.queue.qsize(), "dropped": self.dropped}
+
+
+class LogConfig:
+    """
+    The levels and sample rates of the loggers, reloaded from LOG_CONFIG_FILE
+
+    The file is polled every LOG_CONFIG_POLL_SECONDS by a thread of every
+    process. Without the file, the levels and rates of the environment apply.
+    """
+
+    def __init__(self):
+        self.loggers = []
+        self.level = logging.NOTSET
+        self.sample_rates = {}
+        self.default_rates = {}
+        self.path = None
+        self.poll_seconds = 5.0
+        self.handler = None
+        self.changed_levels = set()
+        self.mtime = None
+        self.pid = None
+        self.reloads = 0
+
+    def init_app(self, app, level):
+        """Configures the levels and sample rates from the Flask configuration"""
+        self.loggers = [app.logger, logging.getLogger(LOGGER)]
+        self.level = level
+        for logger in self.loggers:
+            logger.setLevel(level)
+        self.default_rates = parse_sample_rates(app.config.get("LOG_SAMPLE_RATES", ""))
+        self.sample_rates = dict(self.default_rates)
+        self.path = app.config.get("LOG_CONFIG_FILE") or None
+        self.poll_seconds = app.config.get("LOG_CONFIG_POLL_SECONDS", 5.0)
+        self.mtime = None
+        self.pid = None
+        if self.path:
+            self.try_reload()
+
+    def start(self):
+        """Starts polling the file in this process"""
+        if not self.path or self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(target=self._poll, name="log-config", daemon=True).start()
+
+    def _poll(self):
+        while self.pid == os.getpid():
+            time.sleep(self.poll_seconds)
+            self.try_reload()
+
+    def try_reload(self):
+        """Reloads the file, logging the errors instead of raising them"""
+        try:
+            return self.reload()
+        except (OSError, ValueError) as error:
+            self.loggers[0].warning("Could not reload %s: %s", self.path, error)
+            return False
+
+    def reload(self):
+        """Applies the file if it changed since the last reload, returns True if it did"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        # A broken file is reported once, then ignored until it changes again
+        self.mtime = mtime
+        settings = {}
+        if mtime is not None:
+            with open(self.path, encoding="utf-8") as config_file:
+                settings = json.load(config_file)
+        self.apply(settings)
+        self.reloads += 1
+        return True
+
+    def apply(self, settings):
+        """Sets the levels and sample rates, back to the defaults for the ones not given"""
+        levels = {name: logging.getLevelName(str(value).upper()) for name, value in settings.get("levels", {}).items()}
+        for name, level in levels.items():
+            if not isinstance(level, int):
+                raise ValueError(f"Unknown log level {settings['levels'][name]} for {name}")
+        level = logging.getLevelName(str(settings.get("level", "")).upper()) if "level" in settings else self.level
+        if not isinstance(level, int):
+            raise ValueError(f"Unknown log level {settings['level']}")
+
+        for logger in self.loggers:
+            logger.setLevel(level)
+        for name in self.changed_levels - set(levels):
+            logging.getLogger(name).setLevel(logging.NOTSET)
+        for name, value in levels.items():
+            logging.getLogger(name).setLevel(value)
+        self.changed_levels = set(levels)
+        rates = {name: float(rate) for name, rate in settings.get("sample_rates", {}).items()}
+        self.sample_rates = {**self.default_rates, **rates}
+
+    def stats(self):
+        """Returns the current levels, sample rates and queue of the logs"""
+        report = {
+            "level": logging.getLevelName(self.loggers[0].getEffectiveLevel()) if self.loggers else None,
+            "levels": {name: logging.getLevelName(logging.getLogger(name).level) for name in sorted(self.changed_levels)},
+            "sample_rates": self.sample_rates,
+            "reloads": self.reloads,
+        }
+        if self.handler is not None:
+            report.update(self.handler.stats())
+        return report
+
+
+def parse_sample_rates(value):
+    """Returns the sample rates of "logger=rate,logger=rate" as a dictionary"""
+    rates = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def assign_request_id():
+    """Keeps the request id of the caller, or generates one, and starts the log threads of a new worker"""
+    request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    g.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+    log_config.start()
+    if log_config.handler is not None and log_config.handler.pid != os.getpid():
+        log_config.handler.start()
+
+
+def send_request_id(response):
+    """Returns the request id to the caller"""
+    if "request_id" in g:
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
 
 
 def init_logging(app, logger_name: str):
-    """Set up logging for production"""
-    app.logger.propagate = False
+    """Set up logging for production, for the app logger and the one of the service modules"""
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    level = logging.getLevelName(app.config["LOG_LEVEL"].upper()) if app.config.get("LOG_LEVEL") else gunicorn_logger.level
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT", "json") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
+    for handler in gunicorn_logger.handlers:
         handler.setFormatter(formatter)
+
+    if log_config.handler is not None:
+        log_config.handler.stop()
+    log_config.handler = None
+    handlers = []
+    if gunicorn_logger.handlers:
+        log_config.handler = AsyncLogHandler(gunicorn_logger.handlers, app.config.get("LOG_QUEUE_SIZE", 10000))
+        log_config.handler.addFilter(RequestIdFilter())
+        handlers = [log_config.handler]
+    app.logger.propagate = False
+    app.logger.handlers = handlers
+    # The modules log to the root logger when not served by gunicorn
+    module_logger = logging.getLogger(LOGGER)
+    module_logger.propagate = not handlers
+    module_logger.handlers = handlers
+    log_config.init_app(app, level)
+
+    if assign_request_id not in app.before_request_funcs.get(None, []):
+        app.before_request(assign_request_id)
+        app.after_request(send_request_id)
     app.logger.info("Logging handler established")
+
+
+# The levels and sample rates of the service, configured by init_logging()
+log_config = LogConfig()
+
+# Logs the reads of every request, sampled by LOG_SAMPLE_RATES
+read_logger = SampledLogger(logging.getLogger(READ_LOGGER), log_config)
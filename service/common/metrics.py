@@ -0,0 +1,180 @@
+"""
+Metrics
+
+Prometheus metrics of the service, served by GET /metrics:
+
+    recommendations_http_requests_total            requests per endpoint, method and status
+    recommendations_http_request_duration_seconds  latency per endpoint and method
+    recommendations_sql_queries_per_request        SQL statements sent by one request
+    recommendations_sql_query_duration_seconds     duration of every SQL statement
+    recommendations_db_pool_wait_seconds           time waited for a pooled connection
+    recommendations_db_pool_checked_out            connections in use
+    recommendations_cache_*                        read cache counters
+    recommendations_like_flush_lag_seconds         age of the oldest like event at its flush
+    recommendations_like_pending                   like events waiting for a flush
+
+The endpoint label is the Flask endpoint, i.e. the flask_restx resource, so
+its cardinality is bounded by the routes.
+
+Under gunicorn every worker has its own counters. When PROMETHEUS_MULTIPROC_DIR
+is set, the workers write them to that directory and /metrics aggregates them
+(see gunicorn.conf.py). The directory is created on import, so that any process
+loading the service (gunicorn, the flask commands of the init container) starts.
+"""
+import os
+import threading
+import time
+from flask import g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from service.common.cache import cache
+from service.common.pool_stats import pool_stats
+from service.common.write_behind import like_writes
+
+# prometheus_client opens its files in the directory as soon as a metric is defined
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+REQUESTS = Counter(
+    "recommendations_http_requests_total",
+    "HTTP requests handled",
+    ["endpoint", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "recommendations_http_request_duration_seconds",
+    "HTTP request latency",
+    ["endpoint", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    "recommendations_sql_queries_per_request",
+    "SQL statements executed by one HTTP request",
+    ["endpoint", "method"],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+QUERY_LATENCY = Histogram(
+    "recommendations_sql_query_duration_seconds",
+    "SQL statement duration",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+POOL_WAIT = Histogram(
+    "recommendations_db_pool_wait_seconds",
+    "Time spent waiting for a pooled database connection",
+    buckets=LATENCY_BUCKETS,
+)
+POOL_CHECKED_OUT = Gauge(
+    "recommendations_db_pool_checked_out",
+    "Database connections in use",
+    multiprocess_mode="livesum",
+)
+CACHE_HITS = Counter("recommendations_cache_hits", "Read cache hits")
+CACHE_MISSES = Counter("recommendations_cache_misses", "Read cache misses")
+CACHE_ENTRIES = Gauge("recommendations_cache_entries", "Read cache entries", multiprocess_mode="livesum")
+LIKE_FLUSH_LAG = Histogram(
+    "recommendations_like_flush_lag_seconds",
+    "Time from the oldest like/unlike event of a flush to its commit",
+    buckets=LATENCY_BUCKETS,
+)
+LIKE_PENDING = Gauge("recommendations_like_pending", "Like events waiting for a flush", multiprocess_mode="livesum")
+
+pool_stats.observers.append(POOL_WAIT.observe)
+like_writes.observers.append(LIKE_FLUSH_LAG.observe)
+
+# The cache counters of this worker already added to CACHE_HITS and CACHE_MISSES
+reported_lookups = {"hits": 0, "misses": 0}
+reported_lock = threading.Lock()
+
+
+def request_labels():
+    """Returns the endpoint and method labels of the current request"""
+    return request.endpoint or "unmatched", request.method
+
+
+def init_app(app):
+    """Times every request of a Flask app"""
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+def init_engine(engine):
+    """Times every SQL statement of an engine and counts them per request"""
+    if event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def start_request():
+    """Starts the timers of a request"""
+    g.metrics_start = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+
+def finish_request(response):
+    """Records the latency and the SQL statements of a request"""
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+    endpoint, method = request_labels()
+    REQUESTS.labels(endpoint, method, response.status_code).inc()
+    REQUEST_LATENCY.labels(endpoint, method).observe(time.perf_counter() - start)
+    REQUEST_QUERIES.labels(endpoint, method).observe(g.sql_queries)
+    update_gauges()
+    return response
+
+
+def update_gauges():
+    """Copies the pool and like counters of this worker into the gauges, and adds its new cache lookups"""
+    POOL_CHECKED_OUT.set(pool_stats.stats()["checked_out"])
+    with reported_lock:
+        hits, misses = cache.hits, cache.misses
+        CACHE_HITS.inc(hits - reported_lookups["hits"])
+        CACHE_MISSES.inc(misses - reported_lookups["misses"])
+        reported_lookups.update(hits=hits, misses=misses)
+    LIKE_PENDING.set(len(like_writes.pending))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=R0913,W0613
+    """Remembers when a statement was sent, on its execution context so a failed statement leaves nothing behind"""
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=R0913,W0613
+    """Records the duration of a statement, also in the totals of the current request"""
+    start = getattr(context, "metrics_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = "none"
+    if has_request_context():
+        endpoint = request_labels()[0]
+        g.sql_queries = g.get("sql_queries", 0) + 1
+        g.sql_seconds = g.get("sql_seconds", 0.0) + elapsed
+    QUERY_LATENCY.labels(endpoint).observe(elapsed)
+
+
+def render():
+    """Returns the metrics in the Prometheus text format with its content type"""
+    update_gauges()
+    CACHE_ENTRIES.set(len(cache.backend))
+
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,179 @@
+"""
+Database Migrations
+
+Forward-only, versioned schema migrations so that existing databases can
+pick up schema changes without `flask db-create` dropping every table.
+
+The applied version is recorded in the `schema_version` table. Every
+migration must be idempotent because fresh databases are created directly
+at the latest schema by `create_all()` before the migrations are applied.
+A migration that cannot be applied without losing data raises a
+MigrationError unless the option that allows it is given to upgrade().
+"""
+import logging
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+from service.models import ProductStats, ProductVersion, Recommendation, db
+
+logger = logging.getLogger("flask.app")
+
+# Kept out of db.metadata so that `db.drop_all()` never forgets the version
+version_metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255)),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+MIGRATIONS = []
+
+# The number of conflicting rows listed by a MigrationError
+MAX_LISTED = 20
+
+
+class MigrationError(Exception):
+    """ Used when a migration cannot be applied to the data in the database """
+
+
+def migration(version, description):
+    """Registers a function as the migration to a given schema version"""
+    def decorator(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return function
+    return decorator
+
+
+def head():
+    """Returns the latest known schema version"""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(connection):
+    """Returns the schema version recorded in the database"""
+    schema_version.create(connection, checkfirst=True)
+    version = connection.execute(select(func.max(schema_version.c.version))).scalar()
+    return version or 0
+
+
+def upgrade(engine, **options):
+    """
+    Applies all pending migrations, each one in its own transaction
+
+    Args:
+        options: the flags passed to every migration, e.g. dedupe=True
+
+    Returns:
+        list: the (version, description) of every migration applied
+
+    Raises:
+        MigrationError: if a migration refuses the data, which leaves the
+                        database at the version before it
+    """
+    with engine.begin() as connection:
+        db.metadata.create_all(connection, checkfirst=True)
+        version = current_version(connection)
+
+    applied = []
+    for number, description, function in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info("Applying migration %s: %s", number, description)
+        with engine.begin() as connection:
+            function(connection, options)
+            connection.execute(schema_version.insert().values(version=number, description=description))
+        applied.append((number, description))
+    return applied
+
+
+def stamp(engine):
+    """Records the latest schema version without running any migration"""
+    with engine.begin() as connection:
+        schema_version.create(connection, checkfirst=True)
+        connection.execute(schema_version.delete())
+        connection.execute(schema_version.insert().values(version=head(), description="stamped"))
+
+
+def create_indexes(connection, table, *names):
+    """Creates the named indexes of a model table unless they already exist"""
+    for index in table.indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+
+def add_column(connection, column):
+    """Adds a model column to its existing table unless it is already there"""
+    table = column.table
+    if column.name in {existing["name"] for existing in inspect(connection).get_columns(table.name)}:
+        return
+    ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(connection.dialect)}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    connection.execute(text(ddl))
+
+
+######################################################################
+# M I G R A T I O N S
+######################################################################
+@migration(1, "Add recommendation indexes and unique (pid, recommended_pid, type)")
+def add_recommendation_indexes(connection, options):
+    """Creates the lookup indexes, refusing the duplicated Recommendations unless the dedupe option is set"""
+    table = Recommendation.__table__
+    key = (table.c.pid, table.c.recommended_pid, table.c.type)
+    # The unique index accepts any number of rows with a NULL in the key
+    complete = [column.is_not(None) for column in key]
+    stmt = select(*key, func.count(), func.min(table.c.id)).where(*complete).group_by(*key).having(func.count() > 1)
+    duplicates = connection.execute(stmt.order_by(*key)).all()
+    if duplicates and not options.get("dedupe"):
+        listed = "; ".join(f"{tuple(row[:3])} x {row[3]}" for row in duplicates[:MAX_LISTED])
+        more = f" and {len(duplicates) - MAX_LISTED} more" if len(duplicates) > MAX_LISTED else ""
+        raise MigrationError(
+            f"{len(duplicates)} (pid, recommended_pid, type) are shared by several Recommendations: {listed}{more}. "
+            "Remove the duplicates, or run `flask db-migrate --dedupe` to keep the one with the lowest id"
+        )
+    for row in duplicates:
+        logger.warning("Keeping recommendation %s of the %s with %s", row[4], row[3], tuple(row[:3]))
+    if duplicates:
+        keep = select(func.min(table.c.id)).where(*complete).group_by(*key)
+        result = connection.execute(table.delete().where(*complete, table.c.id.not_in(keep)))
+        logger.warning("Removed %s duplicated recommendations", result.rowcount)
+    create_indexes(
+        connection,
+        table,
+        "ix_recommendation_pid_type_liked",
+        "ix_recommendation_recommended_pid",
+        "uq_recommendation_pid_recommended_pid_type",
+    )
+
+
+@migration(2, "Add recommendation versions and product change counters for ETags")
+def add_versions(connection, _options):
+    """Adds the version column and the product_version table"""
+    add_column(connection, Recommendation.__table__.c.version)
+    ProductVersion.__table__.create(connection, checkfirst=True)
+
+
+@migration(3, "Add recommendation scores and the (pid, score DESC, id) index")
+def add_scores(connection, _options):
+    """Adds the score column and the index of the top-K queries"""
+    add_column(connection, Recommendation.__table__.c.score)
+    create_indexes(connection, Recommendation.__table__, "ix_recommendation_pid_score")
+
+
+@migration(4, "Add the product_version updated_at watermark of the adjacency index")
+def add_product_updated_at(connection, _options):
+    """Adds the updated_at column and its index"""
+    add_column(connection, ProductVersion.__table__.c.updated_at)
+    create_indexes(connection, ProductVersion.__table__, "ix_product_version_updated_at")
+
+
+@migration(5, "Add recommendation like and impression counters and the product_stats totals")
+def add_counters(connection, _options):
+    """Adds the counter columns and the product_stats table"""
+    add_column(connection, Recommendation.__table__.c.like_count)
+    add_column(connection, Recommendation.__table__.c.impression_count)
+    ProductStats.__table__.create(connection, checkfirst=True)
@@ -0,0 +1,135 @@
+"""
+Pagination
+
+Helpers for the list requests shared by the WSGI routes and the async serving
+mode: the parsing of the query parameters, keyset (cursor) pagination and the
+ETags of the conditional requests.
+
+A cursor is an opaque token that remembers the last id of the page that was
+returned, so the next page is fetched with
+`WHERE id > :last_id ORDER BY id LIMIT :size` and costs the same no matter how
+deep the client pages.
+"""
+import base64
+import binascii
+import hashlib
+import json
+from flask_restx import inputs
+from service.models import DataValidationError, RecommendationType
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(last_id: int) -> str:
+    """Returns the opaque cursor pointing after the given id"""
+    token = json.dumps({"id": last_id}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(token).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor: str) -> int:
+    """
+    Returns the last id remembered by a cursor
+
+    Raises:
+        ValueError: if the cursor was not produced by encode_cursor()
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))["id"]
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError) as error:
+        raise ValueError(f"Invalid cursor '{cursor}'") from error
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError(f"Invalid cursor '{cursor}'")
+    return last_id
+
+
+def parse_int(args, name):
+    """Returns an integer query parameter or None"""
+    if args.get(name) is None:
+        return None
+    try:
+        return int(args[name])
+    except ValueError as error:
+        raise DataValidationError(f"'{name}' must be an integer.") from error
+
+
+def parse_liked(args):
+    """Returns the liked query parameter as a boolean or None"""
+    if args.get("liked") is None:
+        return None
+    try:
+        return inputs.boolean(args["liked"])
+    except ValueError as error:
+        raise DataValidationError("'liked' must be a boolean.") from error
+
+
+def parse_page(parsed, cursor):
+    """Sets the page size (limit) and the after_id of the cursor of a paged list request"""
+    if parsed["amount"] is not None:
+        raise DataValidationError("'amount' cannot be combined with 'limit' or 'cursor'.")
+    if parsed["limit"] is None:
+        parsed["limit"] = DEFAULT_PAGE_SIZE
+    if not 0 < parsed["limit"] <= MAX_PAGE_SIZE:
+        raise DataValidationError(f"'limit' must be between 1 and {MAX_PAGE_SIZE}.")
+    if cursor is not None:
+        try:
+            parsed["after_id"] = decode_cursor(cursor)
+        except ValueError as error:
+            raise DataValidationError(str(error)) from error
+
+
+def parse_list_args(args):
+    """
+    Validates the query parameters of GET /recommendations
+
+    Args:
+        args (dict): the query parameters as strings
+
+    Returns:
+        dict: the pid, type, liked and amount filters, and the page size
+              (limit) and after_id of a paged request, whose limit is None
+              for a plain list
+
+    Raises:
+        DataValidationError: if a parameter is not valid
+    """
+    parsed = {name: parse_int(args, name) for name in ("pid", "amount", "limit")}
+    parsed["type"] = args.get("type")
+    if parsed["type"] is not None and parsed["type"] not in list(RecommendationType):
+        raise DataValidationError(f"Type '{parsed['type']}' is an invalid recommendation type.")
+    parsed["liked"] = parse_liked(args)
+    parsed["after_id"] = None
+
+    if parsed["limit"] is None and args.get("cursor") is None:
+        if parsed["amount"] is not None and parsed["amount"] < 0:
+            raise DataValidationError("'amount' must be a positive integer.")
+    else:
+        parse_page(parsed, args.get("cursor"))
+    return parsed
+
+
+def next_page_query(args, limit, last_id):
+    """Returns the query parameters of the page after the given id"""
+    query = {key: value for key, value in args.items() if key != "cursor"}
+    query.update(limit=limit, cursor=encode_cursor(last_id))
+    return query
+
+
+def list_params(args):
+    """Returns the filters that tell apart the cached lists of a product"""
+    return (args["type"], args["liked"], args["amount"])
+
+
+######################################################################
+# CONDITIONAL REQUESTS
+######################################################################
+def recommendation_etag(recommendation_id, version):
+    """Returns the strong ETag of a version of a Recommendation"""
+    return f"rec-{recommendation_id}-{version}"
+
+
+def product_list_etag(pid, params, version):
+    """Returns the strong ETag of a filtered list of the Recommendations of a product"""
+    variant = hashlib.sha1(repr(params).encode("utf-8")).hexdigest()[:12]
+    return f"pid-{pid}-{version}-{variant}"
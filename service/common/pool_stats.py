@@ -0,0 +1,95 @@
+"""
+Pool Statistics
+
+Counters of the SQLAlchemy connection pool of every worker: checkouts,
+connections in use, the threads waiting for one, and the time they waited.
+
+SQLAlchemy has no event for the start of a checkout, so the wait is timed by
+wrapping the connect() method of the pool. The wrapper is installed again
+when the engine is disposed and its pool is recreated.
+"""
+import threading
+import time
+from sqlalchemy import event
+
+
+class PoolStats:
+    """Connection pool counters, with observers notified of every checkout wait"""
+
+    def __init__(self):
+        self.engine = None
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidated = 0
+        self.waiting = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.observers = []
+        self._lock = threading.Lock()
+
+    def init_engine(self, engine):
+        """Starts collecting the statistics of the pool of an engine"""
+        if self.engine is engine:
+            return
+        self.engine = engine
+        # A pool recreated by dispose() copies these listeners but not the wrapper
+        event.listen(engine.pool, "connect", lambda *_: self._count("connects"))
+        event.listen(engine.pool, "invalidate", lambda *_: self._count("invalidated"))
+        event.listen(engine, "engine_disposed", lambda _: self._instrument(engine.pool))
+        self._instrument(engine.pool)
+
+    def _instrument(self, pool):
+        """Wraps the connect() of a pool to time the checkout waits"""
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            self._add_waiting(1)
+            try:
+                return connect()
+            finally:
+                self._add_waiting(-1)
+                self.record_wait(time.perf_counter() - start)
+
+        pool.connect = timed_connect
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _add_waiting(self, count):
+        with self._lock:
+            self.waiting += count
+
+    def record_wait(self, seconds):
+        """Records the time spent waiting for a connection"""
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+        for observer in self.observers:
+            observer(seconds)
+
+    def stats(self):
+        """Returns the pool counters"""
+        pool = self.engine.pool if self.engine is not None else None
+        size = getattr(pool, "size", lambda: 0)()
+        overflow = getattr(pool, "overflow", lambda: 0)()
+        return {
+            "pool": type(pool).__name__ if pool is not None else None,
+            "size": size,
+            "checked_out": getattr(pool, "checkedout", lambda: 0)(),
+            "overflow": max(overflow, 0),
+            "max_overflow": getattr(pool, "_max_overflow", 0),
+            "waiting": self.waiting,
+            "checkouts": self.checkouts,
+            "connects": self.connects,
+            "invalidated": self.invalidated,
+            "wait_seconds_total": round(self.wait_seconds_total, 6),
+            "wait_seconds_max": round(self.wait_seconds_max, 6),
+            "wait_seconds_avg": round(self.wait_seconds_total / self.checkouts, 6) if self.checkouts else 0.0,
+        }
+
+
+# The statistics of the pool used by the service, started by init_db()
+pool_stats = PoolStats()
@@ -0,0 +1,116 @@
+"""
+Query Statistics
+
+Reports the SQL statements and the database time of the requests, counted by
+the cursor events of metrics.py, to catch slow and N+1 query patterns:
+
+- a sample of the requests (`QUERY_STATS_SAMPLE_RATE`, all of them in debug
+  mode) gets a Server-Timing header and a structured log line,
+- a request over `QUERY_BUDGET` statements, or repeating one statement
+  `QUERY_REPEAT_THRESHOLD` times, is logged as a warning and raises
+  QueryBudgetExceeded when `QUERY_BUDGET_RAISE` is set, e.g. in tests.
+
+count_queries() returns the statements sent by a block of code.
+"""
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger("flask.app")
+
+
+class QueryBudgetExceeded(Exception):
+    """ Raised when a request sends more SQL statements than its budget """
+
+
+def init_app(app):
+    """Reports the SQL statements of the requests of a Flask app"""
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+def init_engine(engine):
+    """Counts every distinct SQL statement of the requests sent through an engine"""
+    if not event.contains(engine, "before_cursor_execute", count_statement):
+        event.listen(engine, "before_cursor_execute", count_statement)
+
+
+def start_request():
+    """Starts counting the statements of a request"""
+    g.sql_statements = Counter()
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=R0913,W0613
+    """Counts a statement of the current request"""
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements[statement] += 1
+
+
+def finish_request(response):
+    """Adds the Server-Timing header and logs the sampled requests and the ones over budget"""
+    config = current_app.config
+    queries = g.get("sql_queries", 0)
+    budget = config.get("QUERY_BUDGET", 0)
+    threshold = config.get("QUERY_REPEAT_THRESHOLD", 0)
+    repeated = [
+        (statement, count) for statement, count in g.get("sql_statements", Counter()).most_common()
+        if threshold and count >= threshold
+    ]
+    over_budget = bool(budget) and queries > budget
+    sampled = current_app.debug or random.random() < config.get("QUERY_STATS_SAMPLE_RATE", 0.0)
+    if not (sampled or over_budget or repeated):
+        return response
+
+    db_ms = g.get("sql_seconds", 0.0) * 1000
+    start = g.get("metrics_start")
+    total_ms = (time.perf_counter() - start) * 1000 if start is not None else None
+    stats = {
+        "endpoint": request.endpoint,
+        "method": request.method,
+        "path": request.path,
+        "status": response.status_code,
+        "sql_queries": queries,
+        "sql_ms": round(db_ms, 3),
+        "total_ms": round(total_ms, 3) if total_ms is not None else None,
+        "query_budget": budget or None,
+        "repeated": [{"statement": " ".join(statement.split())[:200], "count": count} for statement, count in repeated],
+    }
+    if sampled:
+        timing = f'db;dur={db_ms:.3f};desc="{queries} queries"'
+        if total_ms is not None:
+            timing += f", total;dur={total_ms:.3f}"
+        response.headers.add("Server-Timing", timing)
+
+    if over_budget or repeated:
+        logger.warning(
+            "%s %s sent %d SQL statements (budget %s, %d repeated)",
+            request.method, request.path, queries, budget or "none", len(repeated),
+            extra={"query_stats": stats},
+        )
+        if config.get("QUERY_BUDGET_RAISE", False):
+            raise QueryBudgetExceeded(f"{request.method} {request.path} sent {queries} SQL statements: {stats}")
+    else:
+        logger.info(
+            "%s %s sent %d SQL statements in %.3f ms", request.method, request.path, queries, db_ms,
+            extra={"query_stats": stats},
+        )
+    return response
+
+
+@contextmanager
+def count_queries(engine):
+    """Yields the list of the SQL statements sent through an engine inside the block"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=R0913,W0613
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
@@ -0,0 +1,244 @@
+"""
+Like Write-Behind
+
+An optional write-behind path for PUT /recommendations/{id}/like and /unlike.
+
+Instead of one transaction per request, the events are appended to a journal
+file and coalesced in memory per Recommendation id, the last event winning. A
+background thread applies them with batched UPDATE statements every
+`LIKE_FLUSH_SECONDS`, or as soon as `LIKE_FLUSH_SIZE` Recommendations are
+pending.
+
+Every worker writes its own journal segments, `likes-<pid>-<seq>.log`, while
+holding an exclusive lock on `likes-<pid>.lock`. A flush starts a new segment
+and deletes the previous ones once the UPDATE is committed. When a worker
+starts, it adopts the segments of the workers whose lock is free, i.e. that
+exited before their last flush, and applies them with its next flush.
+"""
+import atexit
+import contextlib
+import fcntl
+import glob
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger("flask.app")
+
+SEGMENT_PATTERN = re.compile(r"likes-(\d+)-(\d+)\.log$")
+
+
+class LikeWriteBehind:
+    """The pending like/unlike events of this worker and their journal"""
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.apply = None
+        self.directory = None
+        self.flush_seconds = 1.0
+        self.flush_size = 500
+        self.fsync = False
+        self.pending = {}
+        self.likes = {}
+        self.oldest = None
+        self.observers = []
+        self.flushes = 0
+        self.flushed = 0
+        self.last_lag_seconds = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._owner_pid = None
+        self._lock_file = None
+        self._journal = None
+        self._sequence = 0
+        self._closed = []
+
+    def init_app(self, app, apply):
+        """
+        Configures the write-behind from the Flask configuration
+
+        Args:
+            apply (callable): apply(changes, likes) sets the liked value of every
+                Recommendation id of the {id: liked} changes and adds the
+                {id: count} like events to their counters in one transaction
+        """
+        self.app = app
+        self.apply = apply
+        self.enabled = app.config.get("LIKE_WRITE_BEHIND", False)
+        self.directory = app.config.get("LIKE_JOURNAL_DIR", "/tmp/recommendation-likes")
+        self.flush_seconds = app.config.get("LIKE_FLUSH_SECONDS", 1.0)
+        self.flush_size = app.config.get("LIKE_FLUSH_SIZE", 500)
+        self.fsync = app.config.get("LIKE_JOURNAL_FSYNC", False)
+        if self.enabled:
+            logger.info("Writing likes behind to %s", self.directory)
+
+    def enqueue(self, rec_id, liked):
+        """Records that a Recommendation was liked or unliked"""
+        self.start()
+        with self._lock:
+            self._journal.write(f"{rec_id} {int(liked)}\n")
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self.pending[rec_id] = liked
+            if liked:
+                self.likes[rec_id] = self.likes.get(rec_id, 0) + 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            full = len(self.pending) >= self.flush_size
+        if full:
+            self._wake.set()
+
+    def start(self):
+        """Opens the journal of this process, adopts the orphaned ones and starts the flush thread"""
+        if self._owner_pid == os.getpid():
+            return
+        with self._lock:
+            if self._owner_pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            pid = os.getpid()
+            # Whatever a forked parent had pending is in its own journal, and
+            # it keeps its lock until its own copy of the descriptor is closed
+            for handle in (self._journal, self._lock_file):
+                if handle is not None:
+                    handle.close()
+            self.pending, self.likes, self.oldest, self._closed = {}, {}, None, []
+            self._lock_file = open(self._path(f"likes-{pid}.lock"), "a", encoding="utf-8")  # pylint: disable=R1732
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._adopt_orphans(pid)
+            self._open_segment(pid)
+            self._owner_pid = pid
+            threading.Thread(target=self._run, name="like-write-behind", daemon=True).start()
+            atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Like write-behind flush failed")
+
+    def _flush_at_exit(self):
+        if self._owner_pid != os.getpid():
+            return
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Like write-behind flush failed, the journal keeps the events")
+
+    def flush(self):
+        """Applies the pending events and returns the number of Recommendations sent"""
+        with self._lock:
+            if not self.pending:
+                return 0
+            changes, likes, oldest = self.pending, self.likes, self.oldest
+            self.pending, self.likes, self.oldest = {}, {}, None
+            self._journal.close()
+            self._closed.append(self._journal.name)
+            self._open_segment(self._owner_pid)
+            closed = list(self._closed)
+
+        try:
+            self.apply(changes, likes)
+        except Exception:
+            # Keep the events, unless newer ones replaced them, and their segments
+            with self._lock:
+                for rec_id, liked in changes.items():
+                    self.pending.setdefault(rec_id, liked)
+                for rec_id, count in likes.items():
+                    self.likes[rec_id] = self.likes.get(rec_id, 0) + count
+                self.oldest = oldest if self.oldest is None else min(oldest, self.oldest)
+            raise
+
+        with self._lock:
+            self._closed = [path for path in self._closed if path not in closed]
+        for path in closed:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        lag = time.monotonic() - oldest
+        self.flushes += 1
+        self.flushed += len(changes)
+        self.last_lag_seconds = lag
+        for observer in self.observers:
+            observer(lag)
+        return len(changes)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open_segment(self, pid):
+        self._sequence += 1
+        self._journal = open(  # pylint: disable=R1732
+            self._path(f"likes-{pid}-{self._sequence:08d}.log"), "a", encoding="utf-8"
+        )
+
+    def _adopt_orphans(self, pid):
+        """Loads the segments of the workers that exited, and the leftovers of a previous process with this pid"""
+        segments = {}
+        for path in glob.glob(self._path("likes-*-*.log")):
+            match = SEGMENT_PATTERN.search(path)
+            if match:
+                segments.setdefault(int(match.group(1)), []).append((int(match.group(2)), path))
+        # Number the adopted segments after the leftovers of this pid, not over them
+        self._sequence = max((sequence for sequence, _ in segments.get(pid, [])), default=0)
+        for owner, paths in sorted(segments.items()):
+            if owner != pid and not self._lock_orphan(owner):
+                continue
+            for _, path in sorted(paths):
+                # The rename makes sure only one worker adopts a segment
+                self._sequence += 1
+                adopted = self._path(f"likes-{pid}-{self._sequence:08d}.log")
+                try:
+                    os.rename(path, adopted)
+                except FileNotFoundError:
+                    continue
+                self._load(adopted)
+            if owner != pid:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(f"likes-{owner}.lock"))
+
+    def _lock_orphan(self, owner):
+        """Returns True when the worker owning a journal is gone"""
+        with open(self._path(f"likes-{owner}.lock"), "a", encoding="utf-8") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+
+    def _load(self, path):
+        """Adds the events of a journal segment to the pending ones"""
+        with open(path, encoding="utf-8") as segment:
+            for line in segment:
+                parts = line.split()
+                # A worker killed in the middle of a write leaves a partial line
+                if len(parts) == 2 and parts[0].isdigit() and parts[1] in ("0", "1"):
+                    rec_id, liked = int(parts[0]), parts[1] == "1"
+                    self.pending[rec_id] = liked
+                    if liked:
+                        self.likes[rec_id] = self.likes.get(rec_id, 0) + 1
+        if self.pending and self.oldest is None:
+            self.oldest = time.monotonic()
+        self._closed.append(path)
+
+    def stats(self):
+        """Returns the counters of the write-behind"""
+        return {
+            "enabled": self.enabled,
+            "pending": len(self.pending),
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "last_lag_seconds": None if self.last_lag_seconds is None else round(self.last_lag_seconds, 6),
+        }
+
+
+# The write-behind used by the service, configured by init_db()
+like_writes = LikeWriteBehind()
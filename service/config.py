@@ -2,6 +2,43 @@
 Global Configuration for Application
 """
 import os
+from sqlalchemy.pool import NullPool
+
+
+def getenv_bool(name, default):
+    """Returns an environment variable as a boolean"""
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
+
+def engine_options(database_uri):
+    """
+    Returns the SQLAlchemy engine options configured by the environment
+
+    DB_POOL_MODE=queue keeps a pool of connections in every worker.
+    DB_POOL_MODE=null opens a connection per checkout. Use it behind PgBouncer
+    in transaction mode, and set the statement timeout on the database role
+    there because PgBouncer rejects the startup option. psycopg2 never uses
+    server-side prepared statements, so it is PgBouncer safe.
+    """
+    options = {"pool_pre_ping": getenv_bool("DB_POOL_PRE_PING", True)}
+    if os.getenv("DB_POOL_MODE", "queue") == "null":
+        options["poolclass"] = NullPool
+    elif not database_uri.startswith("sqlite"):
+        options.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        )
+
+    if database_uri.startswith("postgresql"):
+        connect_args = {"connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "10"))}
+        statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+        if statement_timeout:
+            connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+        options["connect_args"] = connect_args
+    return options
+
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -11,6 +48,60 @@ DATABASE_URI = os.getenv(
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URI)
+
+# Create the missing tables when a worker starts, instead of `flask db-migrate`
+DB_AUTO_CREATE = getenv_bool("DB_AUTO_CREATE", False)
+
+# Bulk ingestion
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "200000"))
+
+# Streaming export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Read-through cache: none, memory (single worker only) or redis (shared)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "none")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# In-process adjacency index serving GET /recommendations?pid=
+ADJACENCY_INDEX = getenv_bool("ADJACENCY_INDEX", False)
+ADJACENCY_REFRESH_SECONDS = float(os.getenv("ADJACENCY_REFRESH_SECONDS", "2"))
+ADJACENCY_REFRESH_OVERLAP = float(os.getenv("ADJACENCY_REFRESH_OVERLAP", "30"))
+
+# Multi-hop expansion of GET /products/{pid}/recommendations/expanded
+EXPANSION_TIME_BUDGET_MS = float(os.getenv("EXPANSION_TIME_BUDGET_MS", "200"))
+EXPANSION_FRONTIER_LIMIT = int(os.getenv("EXPANSION_FRONTIER_LIMIT", "200"))
+
+# Write-behind of PUT /recommendations/{id}/like and /unlike
+LIKE_WRITE_BEHIND = getenv_bool("LIKE_WRITE_BEHIND", False)
+LIKE_FLUSH_SECONDS = float(os.getenv("LIKE_FLUSH_SECONDS", "1"))
+LIKE_FLUSH_SIZE = int(os.getenv("LIKE_FLUSH_SIZE", "500"))
+LIKE_JOURNAL_DIR = os.getenv("LIKE_JOURNAL_DIR", "/tmp/recommendation-likes")
+LIKE_JOURNAL_FSYNC = getenv_bool("LIKE_JOURNAL_FSYNC", False)
+
+# Readiness of GET /health/ready
+HEALTH_CACHE_SECONDS = float(os.getenv("HEALTH_CACHE_SECONDS", "2"))
+HEALTH_POOL_SATURATION = float(os.getenv("HEALTH_POOL_SATURATION", "0.9"))
+HEALTH_POOL_WAITING = int(os.getenv("HEALTH_POOL_WAITING", "4"))
+HEALTH_QUEUE_DEPTH = int(os.getenv("HEALTH_QUEUE_DEPTH", "10000"))
+
+# SQL statements of the requests: Server-Timing and logs of a sample, budget warnings
+QUERY_STATS_SAMPLE_RATE = float(os.getenv("QUERY_STATS_SAMPLE_RATE", "0.01"))
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "20"))
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", "10"))
+QUERY_BUDGET_RAISE = getenv_bool("QUERY_BUDGET_RAISE", False)
+
+# Logging: level (defaults to the gunicorn one), "json" or "text", sampling of the
+# hot read paths, and a file polled for level and rate changes without a redeploy
+LOG_LEVEL = os.getenv("LOG_LEVEL", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "flask.app.reads=0.01")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_CONFIG_FILE = os.getenv("LOG_CONFIG_FILE", "")
+LOG_CONFIG_POLL_SECONDS = float(os.getenv("LOG_CONFIG_POLL_SECONDS", "5"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -3,10 +3,21 @@ Models for Recommendation
 
 All of the models are stored in this module
 """
+from collections import Counter
 from enum import Enum
+from typing import NamedTuple
 
 import logging
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
+from service.common.cache import cache
+from service.common import metrics, query_stats
+from service.common.adjacency import adjacency_index
+from service.common.health import health
+from service.common.log_handlers import read_logger
+from service.common.pool_stats import pool_stats
+from service.common.write_behind import like_writes
 
 logger = logging.getLogger("flask.app")
 
@@ -20,10 +31,34 @@ def init_db(app):
     Recommendation.init_db(app)
 
 
+def check_connection():
+    """ Runs a trivial query on a pooled connection, raising an exception if the database does not answer """
+    with db.engine.connect() as connection:
+        connection.execute(db.text("SELECT 1"))
+
+
+def upsert(model):
+    """Returns an INSERT supporting ON CONFLICT clauses for the database in use"""
+    if db.session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def clock_timestamp():
+    """Returns the current time of the database, which unlike now() on PostgreSQL moves on within a transaction"""
+    if db.session.get_bind().dialect.name == "postgresql":
+        return db.func.clock_timestamp()
+    return db.func.now()
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class DataConflictError(Exception):
+    """ Used when a Recommendation would duplicate an existing one """
+
+
 class RecommendationType(str, Enum):
     """
     Enum of different type of recommendation
@@ -35,19 +70,57 @@ class RecommendationType(str, Enum):
     FREQUENTLY_TOGETHER = 'frequently-together'
 
 
-class Recommendation(db.Model):
+class RecommendationRecord(NamedTuple):
+    """
+    A read-only Recommendation
+
+    A plain tuple of the public fields that is never tracked by the session,
+    returned by the read-only query helpers of Recommendation
+    """
+
+    id: int
+    pid: int
+    recommended_pid: int
+    type: str
+    liked: bool
+    score: float
+
+    def serialize(self):
+        """ Serializes a Recommendation record into a dictionary """
+        return self._asdict()
+
+
+class Recommendation(db.Model):  # pylint: disable=too-many-public-methods
     """
     Class that represents a Recommendation
     """
 
     app = None
 
+    # Public fields, in the order they are serialized and exported
+    FIELDS = RecommendationRecord._fields
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     pid = db.Column(db.Integer)
     recommended_pid = db.Column(db.Integer)
     type = db.Column(db.String(64))
     liked = db.Column(db.Boolean)
+    # Ranking of the Recommendation among the ones of its product, higher is better
+    score = db.Column(db.Float, nullable=False, default=0.0, server_default="0")
+    # Incremented on every update, used for the ETag of the Recommendation
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # Like events and impressions, summed per product by ProductStats
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    impression_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Indexes (existing databases get them through `flask db-migrate`)
+    __table_args__ = (
+        db.Index("ix_recommendation_pid_type_liked", "pid", "type", "liked"),
+        db.Index("ix_recommendation_recommended_pid", "recommended_pid"),
+        db.Index("uq_recommendation_pid_recommended_pid_type", "pid", "recommended_pid", "type", unique=True),
+        db.Index("ix_recommendation_pid_score", pid, score.desc(), id),
+    )
 
     def __repr__(self):
         return f"<Recommendation id=[{self.id}] ({self.pid} - {self.recommended_pid})>"
@@ -59,20 +132,42 @@ class Recommendation(db.Model):
         logger.info("Creating recommendation %s (%s - %s)", self.id, self.pid, self.recommended_pid)
         self.id = None  # pylint: disable=invalid-name
         db.session.add(self)
-        db.session.commit()
+        self._commit([self.pid])
+        cache.invalidate(pids=[self.pid])
 
     def update(self):
         """
         Updates a Recommendation to the database
         """
         logger.info("Updating recommendation %s (%s - %s)", self.id, self.pid, self.recommended_pid)
-        db.session.commit()
+        # the product this Recommendation used to belong to, if it was moved
+        pids = [self.pid, *db.inspect(self).attrs.pid.history.deleted]
+        self.version = Recommendation.version + 1
+        self._commit(pids)
+        cache.invalidate(ids=[self.id], pids=pids)
 
     def delete(self):
         """ Removes a Recommendation from the data store """
         logger.info("Deleting recommendation %s (%s - %s)", self.id, self.pid, self.recommended_pid)
         db.session.delete(self)
-        db.session.commit()
+        self._commit([self.pid])
+        cache.invalidate(ids=[self.id], pids=[self.pid])
+
+    def _commit(self, pids):
+        """ Commits the changes of the given products, reporting duplicates as a DataConflictError """
+        try:
+            ProductVersion.bump(pids)
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            raise DataConflictError(
+                f"Recommendation ({self.pid} - {self.recommended_pid}) of type '{self.type}' already exists"
+            ) from error
+
+    def key(self):
+        """ Returns the (pid, recommended_pid, type) that uniquely identifies a Recommendation """
+        rec_type = self.type.value if isinstance(self.type, RecommendationType) else self.type
+        return (self.pid, self.recommended_pid, rec_type)
 
     def serialize(self):
         """ Serializes a Recommendation into a dictionary """
@@ -82,6 +177,8 @@ class Recommendation(db.Model):
             "recommended_pid": self.recommended_pid,
             "type": self.type,
             "liked": self.liked,
+            "score": self.score,
+            "version": self.version,
         }
 
     def deserialize(self, data):
@@ -92,6 +189,12 @@ class Recommendation(db.Model):
             data (dict): A dictionary containing the resource data
         """
         try:
+            for field in ("pid", "recommended_pid"):
+                if isinstance(data[field], bool) or not isinstance(data[field], int):
+                    raise DataValidationError(
+                        "invalid type for integer [" + field + "]:"
+                        + str(type(data[field]))
+                    )
             self.pid = data["pid"]
             self.recommended_pid = data["recommended_pid"]
             self.type = RecommendationType(data["type"])
@@ -101,6 +204,14 @@ class Recommendation(db.Model):
                     "invalid type for boolean [liked]:"
                     + str(type(self.liked))
                 )
+            self.score = data.get("score")
+            if self.score is None:
+                self.score = 0.0
+            if isinstance(self.score, bool) or not isinstance(self.score, (int, float)):
+                raise DataValidationError(
+                    "invalid type for number [score]:"
+                    + str(type(self.score))
+                )
         except ValueError as error:
             raise DataValidationError("Invalid value: " + error.args[0]) from error
         except KeyError as error:
@@ -119,10 +230,371 @@ class Recommendation(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        cache.init_app(app)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        pool_stats.init_engine(db.engine)
+        metrics.init_engine(db.engine)
+        query_stats.init_engine(db.engine)
+        adjacency_index.init_app(app, ProductVersion.find_changes, cls.iterate_edges)
+        if adjacency_index.invalidate not in cache.listeners:
+            cache.listeners.append(adjacency_index.invalidate)
+        like_writes.init_app(app, cls.apply_likes)
+        health.init_app(app, check_connection)
+        if app.config.get("DB_AUTO_CREATE", False):
+            cls.create_tables()
+
+    @classmethod
+    def create_tables(cls):
+        """ Creates the missing tables, logging instead of failing while the database is unreachable """
+        try:
+            db.create_all()  # make our sqlalchemy tables
+        except OperationalError as error:
+            logger.error("Cannot create the tables: %s", error)
+
+    @classmethod
+    def bulk_create(cls, items, batch_size=1000):
+        """
+        Creates many Recommendations in a single transaction
+
+        Every item is validated with deserialize() and the valid ones are
+        flushed to the database `batch_size` rows at a time, with one commit
+        at the end. Invalid and duplicated items are reported, not created.
+
+        Args:
+            items (iterable): dictionaries containing the Recommendations data
+            batch_size (int): the number of rows sent to the database at once
+
+        Returns:
+            list: one result per item, in order, with a status of
+                  "created" (and the new id), "invalid" or "duplicate"
+        """
+        logger.info("Processing bulk create in batches of %s", batch_size)
+        results = []
+        seen = set()
+        batch = []
+        try:
+            for index, data in enumerate(items):
+                result = {"index": index}
+                results.append(result)
+                rec = cls()
+                try:
+                    rec.deserialize(data)
+                except DataValidationError as error:
+                    result.update(status="invalid", message=f"Invalid item {index}: {error}")
+                    continue
+                batch.append((result, rec))
+                if len(batch) >= batch_size:
+                    cls._flush_batch(batch, seen)
+                    batch = []
+            cls._flush_batch(batch, seen)
+            pids = {key[0] for key in seen}
+            ProductVersion.bump(pids)
+            db.session.commit()
+            cache.invalidate(pids=pids)
+        except IntegrityError as error:
+            db.session.rollback()
+            raise DataConflictError("Recommendations were created concurrently, please retry") from error
+        except Exception:
+            db.session.rollback()
+            raise
+        logger.info("Created %s recommendations", sum(result.get("status") == "created" for result in results))
+        return results
+
+    @classmethod
+    def _flush_batch(cls, batch, seen):
+        """ Inserts a batch of new Recommendations, skipping the duplicated ones """
+        if not batch:
+            return
+        pids = {rec.pid for _, rec in batch}
+        stmt = db.select(cls.pid, cls.recommended_pid, cls.type).where(cls.pid.in_(pids))
+        existing = {tuple(row) for row in db.session.execute(stmt).all()}
+
+        created = []
+        for result, rec in batch:
+            key = rec.key()
+            if key in existing or key in seen:
+                result.update(status="duplicate", message=f"Recommendation {key} already exists")
+                continue
+            seen.add(key)
+            db.session.add(rec)
+            created.append((result, rec))
+        db.session.flush()
+
+        # Forget the flushed rows so memory does not grow with the payload
+        for result, rec in created:
+            result.update(status="created", id=rec.id)
+            db.session.expunge(rec)
+
+    @classmethod
+    def update_by_attributes(cls, changes, **filters):
+        """
+        Updates every Recommendation matching the filters with one UPDATE statement
+
+        Args:
+            changes (dict): the new "liked", "type" and/or "score" values
+            filters: the pid, recommended_pid, rec_type and liked criteria (see criteria())
+
+        Returns:
+            int: the number of Recommendations updated
+        """
+        logger.info("Processing bulk update of %s for %s ...", changes, filters)
+        values = cls._validate_changes(changes)
+        stmt = db.update(cls).where(*cls._required_criteria(filters))
+        stmt = stmt.values(version=cls.version + 1, **values).returning(cls.id, cls.pid)
+        try:
+            rows = db.session.execute(stmt, execution_options={"synchronize_session": False}).all()
+            ProductVersion.bump(row.pid for row in rows)
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            raise DataConflictError("The update would create duplicated Recommendations") from error
+        cache.invalidate(ids=[row.id for row in rows], pids=[row.pid for row in rows])
+        return len(rows)
+
+    @classmethod
+    def apply_likes(cls, changes, likes=None, batch_size=1000):
+        """
+        Sets the liked value of many Recommendations in one transaction
+
+        Every value is sent with one UPDATE per `batch_size` ids, which skips
+        the Recommendations that already have it.
+
+        Args:
+            changes (dict): the new liked value of every Recommendation id
+            likes (dict): the number of like events to add to every Recommendation id
+
+        Returns:
+            int: the number of Recommendations updated
+        """
+        logger.info("Processing %d like changes ...", len(changes))
+        rows = []
+        try:
+            for liked in (True, False):
+                ids = sorted(rec_id for rec_id, value in changes.items() if value is liked)
+                for start in range(0, len(ids), batch_size):
+                    stmt = db.update(cls).where(cls.id.in_(ids[start:start + batch_size]), cls.liked.is_distinct_from(liked))
+                    stmt = stmt.values(liked=liked, version=cls.version + 1).returning(cls.id, cls.pid)
+                    rows.extend(db.session.execute(stmt, execution_options={"synchronize_session": False}).all())
+            ProductStats.add(cls._add_counts(cls.like_count, likes or {}, batch_size), "like_count")
+            ProductVersion.bump(row.pid for row in rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cache.invalidate(ids=[row.id for row in rows], pids=[row.pid for row in rows])
+        return len(rows)
+
+    @classmethod
+    def set_liked(cls, rec_id, liked):
+        """
+        Likes or unlikes a Recommendation with a single UPDATE ... RETURNING
+
+        Unlike find() then update(), the Recommendation is neither read before
+        nor reloaded after the change.
+
+        Returns:
+            RecommendationRecord: the updated Recommendation, or None if it does not exist
+        """
+        logger.info("Setting liked of recommendation %s to %s", rec_id, liked)
+        values = {"liked": liked, "version": cls.version + 1}
+        if liked:
+            values["like_count"] = cls.like_count + 1
+        stmt = db.update(cls).where(cls.id == rec_id).values(values).returning(*cls.columns())
+        try:
+            row = db.session.execute(stmt, execution_options={"synchronize_session": False}).first()
+            if row is None:
+                db.session.rollback()
+                return None
+            ProductVersion.bump([row.pid])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cache.invalidate(ids=[row.id], pids=[row.pid])
+        return RecommendationRecord._make(row)
+
+    @classmethod
+    def add_impressions(cls, ids, batch_size=1000):
+        """
+        Counts one impression for every occurrence of a Recommendation id
+
+        The counters are not part of the Recommendation, so its version and
+        the caches are left alone.
+
+        Args:
+            ids (list): the ids of the Recommendations shown, repeated once per impression
+
+        Returns:
+            int: the number of impressions of existing Recommendations
+        """
+        logger.info("Processing %d impressions ...", len(ids))
+        try:
+            added = cls._add_counts(cls.impression_count, Counter(ids), batch_size)
+            ProductStats.add(added, "impression_count")
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return sum(count for _, count in added)
+
+    @classmethod
+    def _add_counts(cls, column, counts, batch_size):
+        """
+        Adds to a counter column with one UPDATE per increment and `batch_size` ids
+
+        Returns:
+            list: the (pid, increment) of every Recommendation updated
+        """
+        ids_by_count = {}
+        for rec_id, count in counts.items():
+            if count:
+                ids_by_count.setdefault(count, []).append(rec_id)
+        added = []
+        for count, ids in sorted(ids_by_count.items()):
+            ids.sort()
+            for start in range(0, len(ids), batch_size):
+                stmt = db.update(cls).where(cls.id.in_(ids[start:start + batch_size]))
+                stmt = stmt.values({column.key: column + count}).returning(cls.pid)
+                rows = db.session.execute(stmt, execution_options={"synchronize_session": False}).all()
+                added.extend((row.pid, count) for row in rows)
+        return added
+
+    @classmethod
+    def sync_product(cls, pid, items, batch_size=1000):
+        """
+        Replaces the Recommendations of a product with the given ones in one transaction
+
+        The new list is applied as a diff: the new Recommendations are inserted
+        and the changed ones updated with INSERT ... ON CONFLICT DO UPDATE, the
+        ones missing from the list are deleted, and the unchanged ones are left
+        alone. The product is locked for the duration, so concurrent syncs of
+        it apply one after the other, and readers see the old list until the
+        commit. A Recommendation is identified by its (recommended_pid, type)
+        and keeps its liked value when the item leaves it out.
+
+        Args:
+            pid (int): the pid of the product
+            items (iterable): dictionaries containing the Recommendations data
+            batch_size (int): the number of rows sent to the database at once
+
+        Returns:
+            dict: the number of Recommendations inserted, updated, unchanged and removed
+        """
+        logger.info("Processing sync of the Recommendations of product %s ...", pid)
+        recs = cls._parse_sync_items(pid, items)
+        try:
+            ProductVersion.lock(pid)
+            values, updated, unchanged, removed = cls._diff_product(pid, recs)
+            for start in range(0, len(values), batch_size):
+                stmt = upsert(cls).values(values[start:start + batch_size])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[cls.pid, cls.recommended_pid, cls.type],
+                    set_={"liked": stmt.excluded.liked, "score": stmt.excluded.score, "version": cls.version + 1},
+                )
+                db.session.execute(stmt)
+            for start in range(0, len(removed), batch_size):
+                stmt = db.delete(cls).where(cls.id.in_(removed[start:start + batch_size]))
+                db.session.execute(stmt, execution_options={"synchronize_session": False})
+            if values or removed:
+                ProductVersion.bump([pid])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        if values or removed:
+            cache.invalidate(ids=updated + removed, pids=[pid])
+        inserted = len(values) - len(updated)
+        return {"pid": pid, "inserted": inserted, "updated": len(updated), "unchanged": unchanged, "removed": len(removed)}
+
+    @classmethod
+    def _parse_sync_items(cls, pid, items):
+        """ Returns the validated items of a sync by (pid, recommended_pid, type), with whether they set liked """
+        recs = {}
+        for index, data in enumerate(items):
+            if not isinstance(data, dict):
+                raise DataValidationError(f"Invalid item {index}: body of request contained bad or no data")
+            if data.get("pid", pid) != pid:
+                raise DataValidationError(f"Invalid item {index}: pid {data['pid']} is not the product {pid}")
+            try:
+                rec = cls().deserialize({**data, "pid": pid})
+            except DataValidationError as error:
+                raise DataValidationError(f"Invalid item {index}: {error}") from error
+            if rec.key() in recs:
+                raise DataValidationError(f"Invalid item {index}: Recommendation {rec.key()} is listed twice")
+            recs[rec.key()] = (rec, "liked" in data)
+        return recs
+
+    @classmethod
+    def _diff_product(cls, pid, recs):
+        """ Returns the rows to upsert, the ids updated, the count unchanged and the ids to delete of a sync """
+        stmt = db.select(cls.id, cls.recommended_pid, cls.type, cls.liked, cls.score).where(cls.pid == pid)
+        existing = {(pid, row.recommended_pid, row.type): row for row in db.session.execute(stmt).all()}
+        values, updated, unchanged = [], [], 0
+        for key, (rec, has_liked) in recs.items():
+            row = existing.get(key)
+            liked = rec.liked if has_liked or row is None else row.liked
+            if row is not None and (row.liked, row.score) == (liked, rec.score):
+                unchanged += 1
+                continue
+            if row is not None:
+                updated.append(row.id)
+            values.append({"pid": pid, "recommended_pid": key[1], "type": key[2], "liked": liked, "score": rec.score})
+        removed = sorted(row.id for key, row in existing.items() if key not in recs)
+        return values, updated, unchanged, removed
+
+    @classmethod
+    def delete_by_attributes(cls, **filters):
+        """
+        Removes every Recommendation matching the filters with one DELETE statement
+
+        Args:
+            filters: the pid, recommended_pid, rec_type and liked criteria (see criteria())
+
+        Returns:
+            int: the number of Recommendations deleted
+        """
+        logger.info("Processing bulk delete for %s ...", filters)
+        stmt = db.delete(cls).where(*cls._required_criteria(filters)).returning(cls.id, cls.pid)
+        rows = db.session.execute(stmt, execution_options={"synchronize_session": False}).all()
+        ProductVersion.bump(row.pid for row in rows)
+        db.session.commit()
+        cache.invalidate(ids=[row.id for row in rows], pids=[row.pid for row in rows])
+        return len(rows)
+
+    @classmethod
+    def _required_criteria(cls, filters):
+        """ Returns the WHERE clauses of a bulk operation, which must filter on something """
+        clauses = cls.criteria(**filters)
+        if not clauses:
+            raise DataValidationError("At least one filter is required for a bulk operation")
+        return clauses
+
+    @staticmethod
+    def _validate_changes(changes):
+        """ Returns the column values of a bulk update after validating them """
+        if not isinstance(changes, dict) or not changes:
+            raise DataValidationError("Invalid changes: body of request contained bad or no data")
+        unknown = set(changes) - {"liked", "type", "score"}
+        if unknown:
+            raise DataValidationError("Invalid changes: cannot update " + ", ".join(sorted(unknown)))
+        values = {}
+        if "liked" in changes:
+            if not isinstance(changes["liked"], bool):
+                raise DataValidationError("invalid type for boolean [liked]:" + str(type(changes["liked"])))
+            values["liked"] = changes["liked"]
+        if "type" in changes:
+            try:
+                values["type"] = RecommendationType(changes["type"]).value
+            except ValueError as error:
+                raise DataValidationError("Invalid value: " + error.args[0]) from error
+        if "score" in changes:
+            if isinstance(changes["score"], bool) or not isinstance(changes["score"], (int, float)):
+                raise DataValidationError("invalid type for number [score]:" + str(type(changes["score"])))
+            values["score"] = changes["score"]
+        return values
 
     @classmethod
     def all(cls):
@@ -130,12 +602,70 @@ class Recommendation(db.Model):
         logger.info("Processing all Recommendation")
         return cls.query.all()
 
+    @classmethod
+    def iterate_rows(cls, batch_size=1000):
+        """
+        Returns an iterator over the records of every Recommendation, ordered by id
+
+        The rows are fetched `batch_size` at a time through a server-side
+        cursor, so the whole table is never held in memory
+        """
+        logger.info("Processing export of all Recommendation")
+        stmt = cls.select_fields(db.select(cls).order_by(cls.id)).execution_options(yield_per=batch_size)
+        return map(RecommendationRecord._make, db.session.execute(stmt))
+
+    @classmethod
+    def iterate_edges(cls, pids=None, batch_size=1000):
+        """
+        Returns an iterator over the records of the given products, ordered by pid and id
+
+        Args:
+            pids (list): the pids of the products, all of them when None
+            batch_size (int): the number of rows fetched at once and of pids per query
+        """
+        stmt = cls.select_fields(db.select(cls).order_by(cls.pid, cls.id)).execution_options(yield_per=batch_size)
+        if pids is None:
+            return map(RecommendationRecord._make, db.session.execute(stmt))
+        pids = list(pids)
+        batches = (stmt.where(cls.pid.in_(pids[start:start + batch_size])) for start in range(0, len(pids), batch_size))
+        return (RecommendationRecord._make(row) for batch in batches for row in db.session.execute(batch).all())
+
+    @classmethod
+    def columns(cls):
+        """Returns the columns of the public FIELDS"""
+        return [getattr(cls, field) for field in cls.FIELDS]
+
+    @classmethod
+    def select_fields(cls, stmt):
+        """Returns a SELECT of Recommendations reduced to the columns of the public FIELDS"""
+        return stmt.with_only_columns(*cls.columns())
+
+    @classmethod
+    def fetch_records(cls, stmt):
+        """Runs a SELECT of Recommendations and returns read-only records
+
+        The records are plain tuples that are never added to the session,
+        which is much cheaper than loading ORM objects only to serialize them
+        """
+        return list(map(RecommendationRecord._make, db.session.execute(cls.select_fields(stmt))))
+
+    @classmethod
+    def all_records(cls):
+        """ Returns all of the Recommendations as read-only records """
+        logger.info("Processing all Recommendation records")
+        return cls.fetch_records(db.select(cls).order_by(cls.id))
+
     @classmethod
     def find(cls, by_id):
         """ Finds a Recommendation by it's ID """
-        logger.info("Processing lookup for id %s ...", by_id)
+        read_logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
 
+    @classmethod
+    def find_version(cls, by_id):
+        """ Returns the version of the Recommendation with the given ID, or None if it does not exist """
+        return db.session.execute(db.select(cls.version).where(cls.id == by_id)).scalar()
+
     @classmethod
     def find_by_pid(cls, pid):
         """Returns all Recommendation with the given pid
@@ -143,9 +673,50 @@ class Recommendation(db.Model):
         Args:
             pid (int): the pid of the Recommendation you want to match
         """
-        logger.info("Processing pid query for %s ...", pid)
+        read_logger.info("Processing pid query for %s ...", pid)
         return cls.query.filter(cls.pid == pid)
 
+    @classmethod
+    def find_top(cls, pid, top, rec_type=None):
+        """Returns the best Recommendations of a product, by descending score
+
+        The (pid, score DESC, id) index lets the database stop after `top`
+        rows instead of sorting every Recommendation of the product
+
+        Args:
+            pid (int): the pid of the product
+            top (int): the number of Recommendations to return
+            rec_type (string): only return the Recommendations of this type
+        """
+        read_logger.info("Processing top %s query for pid %s ...", top, pid)
+        return db.session.execute(cls.select_top(pid, top, rec_type=rec_type)).scalars().all()
+
+    @classmethod
+    def select_top(cls, pid, top, rec_type=None):
+        """Builds the SELECT statement of find_top()"""
+        stmt = db.select(cls).where(*cls.criteria(pid=pid, rec_type=rec_type))
+        return stmt.order_by(cls.score.desc(), cls.id).limit(top)
+
+    @classmethod
+    def find_top_by_pids(cls, pids, top, rec_type=None):
+        """Returns the best Recommendations of many products as read-only records, with a single query
+
+        A ROW_NUMBER() window partitioned by pid ranks the Recommendations of
+        every product by descending score, and only the first `top` of each
+        product are returned, ordered by pid and rank
+
+        Args:
+            pids (list): the pids of the products
+            top (int): the number of Recommendations to return per product
+            rec_type (string): only return the Recommendations of this type
+        """
+        read_logger.info("Processing top %s query for %s pids ...", top, len(pids))
+        rank = db.func.row_number().over(partition_by=cls.pid, order_by=(cls.score.desc(), cls.id)).label("rank")
+        ranked = db.select(*cls.columns(), rank).where(cls.pid.in_(pids), *cls.criteria(rec_type=rec_type)).subquery()
+        stmt = db.select(*[ranked.c[field] for field in cls.FIELDS])
+        stmt = stmt.where(ranked.c.rank <= top).order_by(ranked.c.pid, ranked.c.rank)
+        return list(map(RecommendationRecord._make, db.session.execute(stmt)))
+
     @classmethod
     def find_by_type(cls, rec_type):
         """Returns all Recommendations of the given type
@@ -153,7 +724,7 @@ class Recommendation(db.Model):
         Args:
             rec_type (string): the type of the Recommendations you want to match
         """
-        logger.info("Processing type filter query for type %s ...", rec_type)
+        read_logger.info("Processing type filter query for type %s ...", rec_type)
         return cls.query.filter(cls.type == rec_type)
 
     @classmethod
@@ -163,21 +734,267 @@ class Recommendation(db.Model):
         Args:
             liked (bool): like criteria based on which you want to match the Recommendations
         """
-        logger.info("Processing liked filter query for liked %s ...", liked)
+        read_logger.info("Processing liked filter query for liked %s ...", liked)
         return cls.query.filter(cls.liked == liked)
 
     @classmethod
-    def find_by_attributes(cls, rec_type=None, liked=None):
-        """Returns all Recommendation filtered by likes
+    def criteria(cls, pid=None, recommended_pid=None, rec_type=None, liked=None):
+        """Returns the WHERE clauses matching the given attributes
 
         Args:
+            pid (int): the pid of the Recommendations you want to match
+            recommended_pid (int): the recommended pid of the Recommendations you want to match
+            rec_type (string): the type of the Recommendations you want to match
             liked (bool): like criteria based on which you want to match the Recommendations
         """
-        logger.info("Processing liked filter query for liked %s ...", liked)
-        res = cls.query
-
+        clauses = []
+        if pid is not None:
+            clauses.append(cls.pid == pid)
+        if recommended_pid is not None:
+            clauses.append(cls.recommended_pid == recommended_pid)
         if rec_type is not None:
-            res = res.filter(cls.type == rec_type)
+            clauses.append(cls.type == rec_type)
         if liked is not None:
-            res = res.filter(cls.liked == liked)
-        return res.all()
+            clauses.append(cls.liked == liked)
+        return clauses
+
+    @classmethod
+    def select_by_attributes(cls, pid=None, rec_type=None, liked=None, limit=None, after_id=None):  # pylint: disable=R0913
+        """Builds a SELECT statement for the Recommendations matching the given attributes
+
+        Every criteria is pushed down into the WHERE / LIMIT clauses so the
+        database only returns the rows that are asked for
+
+        Args:
+            pid (int): the pid of the Recommendations you want to match
+            rec_type (string): the type of the Recommendations you want to match
+            liked (bool): like criteria based on which you want to match the Recommendations
+            limit (int): the maximum number of Recommendations to return
+            after_id (int): only return the Recommendations with an id greater than this one
+        """
+        stmt = db.select(cls).where(*cls.criteria(pid=pid, rec_type=rec_type, liked=liked))
+        if after_id is not None:
+            stmt = stmt.where(cls.id > after_id)
+        stmt = stmt.order_by(cls.id)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    @classmethod
+    def find_by_attributes(cls, rec_type=None, liked=None, pid=None, limit=None, after_id=None):  # pylint: disable=R0913
+        """Returns all Recommendation filtered by type, likes and pid
+
+        Args:
+            rec_type (string): the type of the Recommendations you want to match
+            liked (bool): like criteria based on which you want to match the Recommendations
+            pid (int): the pid of the Recommendations you want to match
+            limit (int): the maximum number of Recommendations to return
+            after_id (int): only return the Recommendations with an id greater than this one
+        """
+        read_logger.info("Processing attributes query for pid %s, type %s, liked %s ...", pid, rec_type, liked)
+        stmt = cls.select_by_attributes(pid=pid, rec_type=rec_type, liked=liked, limit=limit, after_id=after_id)
+        return db.session.execute(stmt).scalars().all()
+
+    @classmethod
+    def find_records_by_attributes(  # pylint: disable=R0913
+        cls, rec_type=None, liked=None, pid=None, limit=None, after_id=None
+    ):
+        """Same as find_by_attributes() but returns read-only records"""
+        read_logger.info("Processing attributes records query for pid %s, type %s, liked %s ...", pid, rec_type, liked)
+        stmt = cls.select_by_attributes(pid=pid, rec_type=rec_type, liked=liked, limit=limit, after_id=after_id)
+        return cls.fetch_records(stmt)
+
+
+class ProductVersion(db.Model):
+    """
+    Class that represents the change counter of the Recommendations of a product
+
+    The counter is incremented in the same transaction as every write to the
+    Recommendations of the product, so it can stand for the whole list in ETags
+    """
+
+    # Table Schema
+    pid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # Database time of the last change (clock_timestamp() on PostgreSQL), the watermark of the adjacency index refreshes
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_product_version_updated_at", "updated_at"),
+    )
+
+    def __repr__(self):
+        return f"<ProductVersion pid=[{self.pid}] version=[{self.version}]>"
+
+    @classmethod
+    def bump(cls, pids, batch_size=1000):
+        """Increments the counters of the given products and refreshes their totals, in pid order to avoid deadlocks
+
+        Every write path calls it before its commit, so the ProductStats rows are always current.
+
+        Args:
+            pids (iterable): the pids of the products whose Recommendations changed
+        """
+        pids = sorted({pid for pid in pids if pid is not None})
+        for start in range(0, len(pids), batch_size):
+            # The time of the statement, not of the transaction start, so a long write is still seen by the refreshes
+            now = clock_timestamp()
+            values = [{"pid": pid, "version": 1, "updated_at": now} for pid in pids[start:start + batch_size]]
+            stmt = upsert(cls).values(values)
+            stmt = stmt.on_conflict_do_update(index_elements=[cls.pid], set_={"version": cls.version + 1, "updated_at": now})
+            db.session.execute(stmt)
+            ProductStats.refresh(pids[start:start + batch_size])
+
+    @classmethod
+    def lock(cls, pid):
+        """Locks the counter of a product until the end of the transaction, creating it if needed
+
+        Args:
+            pid (int): the pid of the product
+        """
+        stmt = upsert(cls).values(pid=pid, version=0, updated_at=clock_timestamp())
+        db.session.execute(stmt.on_conflict_do_nothing(index_elements=[cls.pid]))
+        db.session.execute(db.select(cls.version).where(cls.pid == pid).with_for_update())
+
+    @classmethod
+    def find_version(cls, pid):
+        """Returns the change counter of a product, 0 if its Recommendations never changed
+
+        Args:
+            pid (int): the pid of the product
+        """
+        return db.session.execute(cls.select_version(pid)).scalar() or 0
+
+    @classmethod
+    def select_version(cls, pid):
+        """Builds a SELECT statement for the change counter of a product, no row if it never changed"""
+        return db.select(cls.version).where(cls.pid == pid)
+
+    @classmethod
+    def find_changes(cls, since=None):
+        """Returns the (pid, version, updated_at) of the products changed since a time, or of all of them
+
+        Args:
+            since (datetime): only return the products whose updated_at is at or after this time
+        """
+        stmt = db.select(cls.pid, cls.version, cls.updated_at)
+        if since is not None:
+            stmt = stmt.where(cls.updated_at >= since)
+        return [tuple(row) for row in db.session.execute(stmt).all()]
+
+
+class ProductStats(db.Model):
+    """
+    Class that represents the totals of the Recommendations of a product
+
+    Every write that bumps the ProductVersion of a product recomputes its row
+    in the same transaction, and the counter updates that leave the version
+    alone (impressions and repeated likes) are added to it, so reading the
+    totals is a primary key lookup. Only the products not written since the
+    table was added are summed on the fly.
+    """
+
+    __tablename__ = "product_stats"
+
+    # Table Schema
+    pid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # The ProductVersion counter the totals were computed at, -1 while never computed
+    version = db.Column(db.Integer, nullable=False, default=-1)
+    recommendations = db.Column(db.Integer, nullable=False, default=0)
+    liked = db.Column(db.Integer, nullable=False, default=0)
+    like_count = db.Column(db.Integer, nullable=False, default=0)
+    impression_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # The columns summed from the Recommendations of the product
+    TOTALS = ("recommendations", "liked", "like_count", "impression_count")
+
+    def __repr__(self):
+        return f"<ProductStats pid=[{self.pid}] version=[{self.version}]>"
+
+    def serialize(self):
+        """ Serializes the totals of a product into a dictionary """
+        return {
+            "pid": self.pid,
+            "version": self.version,
+            "recommendations": self.recommendations,
+            "liked": self.liked,
+            "like_count": self.like_count,
+            "impression_count": self.impression_count,
+            "like_rate": self.like_count / self.impression_count if self.impression_count else None,
+        }
+
+    @classmethod
+    def add(cls, counts, column):
+        """Adds counter increments to the totals of their products, in pid order to avoid deadlocks
+
+        Args:
+            counts (list): the (pid, increment) of every Recommendation updated
+            column (str): the name of the counter, "like_count" or "impression_count"
+        """
+        totals = {}
+        for pid, count in counts:
+            totals[pid] = totals.get(pid, 0) + count
+        if totals:
+            stmt = upsert(cls).values([{"pid": pid, "version": -1, column: count} for pid, count in sorted(totals.items())])
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[cls.pid], set_={column: getattr(cls, column) + stmt.excluded[column]}
+            ))
+            # The products without totals yet get them from their Recommendations, already incremented
+            cls.recompute(list(totals), cls.version == -1)
+
+    @classmethod
+    def find(cls, pid):
+        """Returns the serialized totals of a product, summed on the fly (never stored) if they are behind
+
+        Args:
+            pid (int): the pid of the product
+        """
+        stats = db.session.get(cls, pid)
+        version = ProductVersion.find_version(pid)
+        if stats is None and version == 0:  # a product that never had a Recommendation has no row
+            return cls(pid=pid, version=0, recommendations=0, liked=0, like_count=0, impression_count=0).serialize()
+        if stats is not None and stats.version == version:
+            return stats.serialize()
+        return cls.compute(pid, version)
+
+    @classmethod
+    def compute(cls, pid, version):
+        """Sums the totals of a product from its Recommendations, without storing them
+
+        Args:
+            pid (int): the pid of the product
+            version (int): its ProductVersion counter, read before the sums so they are at least that recent
+        """
+        totals = db.session.execute(db.select(*cls.sums()).where(Recommendation.pid == pid)).one()
+        return cls(pid=pid, version=version, **dict(zip(cls.TOTALS, totals))).serialize()
+
+    @staticmethod
+    def sums():
+        """Returns the aggregates of the TOTALS columns over Recommendations"""
+        return (
+            db.func.count(Recommendation.id),
+            db.func.count(Recommendation.id).filter(Recommendation.liked.is_(True)),
+            db.func.coalesce(db.func.sum(Recommendation.like_count), 0),
+            db.func.coalesce(db.func.sum(Recommendation.impression_count), 0),
+        )
+
+    @classmethod
+    def refresh(cls, pids):
+        """Recomputes the stored totals of products from their Recommendations, in the current transaction
+
+        Args:
+            pids (list): the sorted pids of the products whose Recommendations changed
+        """
+        # With the rows created or locked first, the sums include every counter update committed before them
+        stmt = upsert(cls).values([{"pid": pid, "version": -1} for pid in pids])
+        db.session.execute(stmt.on_conflict_do_update(index_elements=[cls.pid], set_={"version": -1}))
+        cls.recompute(pids)
+
+    @classmethod
+    def recompute(cls, pids, *criteria):
+        """Sets the totals of the existing rows of products, matching the criteria, from their Recommendations"""
+        table = cls.__table__
+        version = db.select(ProductVersion.version).where(ProductVersion.pid == table.c.pid).scalar_subquery()
+        totals = [db.select(total).where(Recommendation.pid == table.c.pid).scalar_subquery() for total in cls.sums()]
+        values = dict(zip(cls.TOTALS, totals), version=db.func.coalesce(version, 0))
+        db.session.execute(table.update().where(table.c.pid.in_(pids), *criteria).values(values))
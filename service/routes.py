@@ -4,10 +4,26 @@ My Service
 Describe what your service does here
 """
 
-from flask import abort
+import json
+from flask import Response, abort, request, stream_with_context
 from flask_restx import Resource, fields, inputs, reqparse
-from service.common import status  # HTTP Status Codes
-from service.models import DataValidationError, Recommendation, RecommendationType
+from werkzeug.http import quote_etag
+from service.common import metrics, status  # HTTP Status Codes
+from service.common.adjacency import adjacency_index
+from service.common.cache import cache
+from service.common.encoding import JSON_MIMETYPE, dumps, encode_rows
+from service.common.expansion import expand
+from service.common.health import health as health_check
+from service.common.log_handlers import log_config, read_logger
+from service.common.export import csv_chunks, gzip_chunks, ndjson_chunks
+from service.common.pagination import (
+    list_params, next_page_query, parse_list_args, product_list_etag, recommendation_etag
+)
+from service.common.pool_stats import pool_stats
+from service.common.write_behind import like_writes
+from service.models import (
+    DataConflictError, DataValidationError, ProductStats, ProductVersion, Recommendation, RecommendationType
+)
 
 # Import Flask application
 from . import app, init_api
@@ -39,24 +55,71 @@ def request_validation_error(error):
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(DataConflictError)
+def request_conflict_error(error):
+    """Handles duplicate Recommendations"""
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
+
+
 ######################################################################
 # HEALTH CHECK
 ######################################################################
 @app.route("/health")
+@app.route("/health/live")
 def health():
-    """ For health check """
+    """ For health check: the worker answers """
     return (
         {"status": "OK"},
         status.HTTP_200_OK,
     )
 
 
+@app.route("/health/ready")
+def readiness():
+    """ For readiness check: the database answers and the pool and queues are not saturated """
+    report = health_check.ready()
+    code = status.HTTP_200_OK if report["status"] == "ready" else status.HTTP_503_SERVICE_UNAVAILABLE
+    return report, code
+
+
+######################################################################
+# STATISTICS
+######################################################################
+@app.route("/stats")
+def stats():
+    """ Returns the runtime counters of the service """
+    return (
+        {
+            "cache": cache.stats(),
+            "pool": pool_stats.stats(),
+            "adjacency": adjacency_index.stats(),
+            "likes": like_writes.stats(),
+            "logging": log_config.stats(),
+        },
+        status.HTTP_200_OK,
+    )
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """ Returns the Prometheus metrics of the service """
+    body, content_type = metrics.render()
+    return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
+
 # Define the model so that the docs reflect what can be sent
 create_model = api.model('Recommendation', {
     'pid': fields.Integer(required=True, description='Product ID'),
     'recommended_pid': fields.Integer(required=True, description='Recommended product ID'),
     'type': fields.String(enum=[member.value for member in RecommendationType], description='Recommendation type'),
     'liked': fields.Boolean(description='Is the Recommendation liked?'),
+    'score': fields.Float(description='Ranking among the Recommendations of the product, higher is better'),
 })
 
 recommendation_model = api.inherit(
@@ -68,42 +131,250 @@ recommendation_model = api.inherit(
     }
 )
 
-# query string arguments
+update_model = api.model('RecommendationChanges', {
+    'type': fields.String(enum=[member.value for member in RecommendationType], description='New recommendation type'),
+    'liked': fields.Boolean(description='New liked value'),
+    'score': fields.Float(description='New ranking score'),
+})
+
+lookup_model = api.model('RecommendationLookup', {
+    'pids': fields.List(fields.Integer, required=True, description='The product IDs to look up'),
+    'limit': fields.Integer(description='Maximum number of Recommendations per product (default 10)'),
+    'type': fields.String(enum=[member.value for member in RecommendationType], description='Recommendation type'),
+})
+
+lookup_result_model = api.model('RecommendationLookupResult', {
+    'pid': fields.Integer(description='Product ID'),
+    'recommendations': fields.List(fields.Nested(recommendation_model),
+                                   description='The best Recommendations of the product, by descending score'),
+})
+
+bulk_result_model = api.model('BulkResult', {
+    'index': fields.Integer(description='Position of the item in the request'),
+    'status': fields.String(enum=['created', 'invalid', 'duplicate'], description='Outcome for the item'),
+    'id': fields.Integer(description='The id of the created Recommendation'),
+    'message': fields.String(description='Why the item was not created'),
+})
+
+bulk_response_model = api.model('BulkResponse', {
+    'created': fields.Integer(description='Number of Recommendations created'),
+    'failed': fields.Integer(description='Number of items that were not created'),
+    'results': fields.List(fields.Nested(bulk_result_model)),
+})
+
+expanded_model = api.model('ExpandedRecommendation', {
+    'recommended_pid': fields.Integer(description='Recommended product ID'),
+    'score': fields.Float(description='Type-weighted score summed over the paths that reach the product'),
+    'depth': fields.Integer(description='Number of hops from the product'),
+    'via': fields.Integer(description='The product of the previous hop on the best path'),
+})
+
+expansion_model = api.model('RecommendationExpansion', {
+    'pid': fields.Integer(description='Product ID'),
+    'depth': fields.Integer(description='Number of hops walked'),
+    'truncated': fields.Boolean(description='True when the time budget stopped the walk early'),
+    'recommendations': fields.List(fields.Nested(expanded_model), description='By descending score'),
+})
+
+impressions_model = api.model('RecommendationImpressions', {
+    'ids': fields.List(fields.Integer, required=True,
+                       description='The ids of the Recommendations shown, once per impression'),
+})
+
+product_stats_model = api.model('ProductRecommendationStats', {
+    'pid': fields.Integer(description='Product ID'),
+    'version': fields.Integer(description='The change counter of the product the totals were computed at'),
+    'recommendations': fields.Integer(description='Number of Recommendations of the product'),
+    'liked': fields.Integer(description='Number of liked Recommendations'),
+    'like_count': fields.Integer(description='Like events of all the Recommendations'),
+    'impression_count': fields.Integer(description='Impressions of all the Recommendations'),
+    'like_rate': fields.Float(description='like_count / impression_count, null without impressions'),
+})
+
+sync_item_model = api.model('ProductRecommendation', {
+    'recommended_pid': fields.Integer(required=True, description='Recommended product ID'),
+    'type': fields.String(enum=[member.value for member in RecommendationType], description='Recommendation type'),
+    'liked': fields.Boolean(description='Is the Recommendation liked? Left unchanged when missing'),
+    'score': fields.Float(description='Ranking among the Recommendations of the product, higher is better'),
+})
+
+sync_result_model = api.model('ProductRecommendationSync', {
+    'pid': fields.Integer(description='Product ID'),
+    'inserted': fields.Integer(description='Number of Recommendations created'),
+    'updated': fields.Integer(description='Number of Recommendations whose liked value or score changed'),
+    'unchanged': fields.Integer(description='Number of Recommendations left as they were'),
+    'removed': fields.Integer(description='Number of Recommendations missing from the list, deleted'),
+})
+
+# query string arguments, documented here and parsed by parse_list_args() like in the async serving mode
 rec_args = reqparse.RequestParser()
 rec_args.add_argument('pid', type=int, location='args', required=False, help='List Recommendations by product ID')
 rec_args.add_argument('type', type=str, location='args', required=False, help='List Recommendations by type')
 rec_args.add_argument('liked', type=inputs.boolean, location='args', required=False, help='List Recommendations by liked')
 rec_args.add_argument('amount', type=int, location='args', required=False,
                       help='Maximum number of Recommendations to be returned (default returns all)')
+rec_args.add_argument('limit', type=int, location='args', required=False,
+                      help='Page size for cursor pagination (a Link header points to the next page)')
+rec_args.add_argument('cursor', type=str, location='args', required=False,
+                      help='Opaque cursor returned in the Link header of the previous page')
+
+# query string arguments of the bulk operations
+filter_args = reqparse.RequestParser()
+filter_args.add_argument('pid', type=int, location='args', required=False, help='Match Recommendations by product ID')
+filter_args.add_argument('recommended_pid', type=int, location='args', required=False,
+                         help='Match Recommendations by recommended product ID')
+filter_args.add_argument('type', type=str, location='args', required=False, help='Match Recommendations by type')
+filter_args.add_argument('liked', type=inputs.boolean, location='args', required=False,
+                         help='Match Recommendations by liked')
+
+# query string arguments of the export
+export_args = reqparse.RequestParser()
+export_args.add_argument('format', type=str, location='args', required=False, default='ndjson',
+                         choices=('ndjson', 'csv'), help='Export format: ndjson (default) or csv')
+
+# query string arguments of the top recommendations of a product
+top_args = reqparse.RequestParser()
+top_args.add_argument('top', type=int, location='args', required=False, default=10,
+                      help='Number of Recommendations to return, by descending score (default 10)')
+top_args.add_argument('type', type=str, location='args', required=False, help='Only return Recommendations of this type')
+
+expand_args = reqparse.RequestParser()
+expand_args.add_argument('depth', type=int, location='args', required=False, default=2,
+                         help='Number of hops to walk (default 2)')
+expand_args.add_argument('limit', type=int, location='args', required=False, default=20,
+                         help='Number of products to return (default 20)')
+
+MAX_TOP = 1000
+MAX_LOOKUP_PIDS = 500
+MAX_LOOKUP_LIMIT = 100
+MAX_EXPANSION_DEPTH = 3
+MAX_EXPANSION_LIMIT = 100
+MAX_IMPRESSIONS = 10000
 
 
 ######################################################################
 # LIST ALL RECOMMENDATIONS
 ######################################################################
-def get_recommendation_based_on_filter(rec_type, liked):
-    """Returns list of the Recommendations with or without specific type and liked filters"""
-    recommendations = []
-    cond_type = None
-    cond_liked = None
+def check_recommendation_type(rec_type):
+    """Aborts the request if the given type filter is not a valid recommendation type"""
+    if rec_type is not None and rec_type not in list(RecommendationType):
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Type '{rec_type}' is an invalid recommendation type.",
+        )
+
+
+def get_bulk_filters():
+    """Returns the filters of a bulk update or delete, which must not be empty"""
+    args = filter_args.parse_args()
+    check_recommendation_type(args.get("type"))
+    filters = {
+        "pid": args.get("pid"),
+        "recommended_pid": args.get("recommended_pid"),
+        "rec_type": args.get("type"),
+        "liked": args.get("liked"),
+    }
+    if all(value is None for value in filters.values()):
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "At least one of 'pid', 'recommended_pid', 'type' or 'liked' is required.",
+        )
+    return filters
+
+
+def get_recommendation_based_on_filter(args, amount=None, after_id=None):
+    """Returns the records of the Recommendations matching the pid, type and liked filters of parse_list_args()"""
+    return Recommendation.find_records_by_attributes(
+        rec_type=args["type"], liked=args["liked"], pid=args["pid"], limit=amount, after_id=after_id
+    )
 
-    if rec_type is not None:
-        if rec_type in list(RecommendationType):
-            cond_type = rec_type
-        else:
-            abort(
-                status.HTTP_400_BAD_REQUEST,
-                f"Type '{rec_type}' is an invalid recommendation type.",
-            )
 
-    if liked is not None:
-        cond_liked = liked
+def encode_recommendations(records):
+    """Returns Recommendation records as the JSON text of a list of recommendation_model"""
+    return encode_rows(records, Recommendation.FIELDS).decode("utf-8")
 
-    if cond_type is None and cond_liked is None:
-        recommendations = Recommendation.all()
-    else:
-        recommendations = Recommendation.find_by_attributes(rec_type=cond_type, liked=cond_liked)
 
-    return recommendations
+def json_response(body, code=status.HTTP_200_OK, headers=None):
+    """Returns a response with an already encoded JSON body"""
+    return Response(body, status=code, mimetype=JSON_MIMETYPE, headers=headers)
+
+
+def get_recommendation_page(args):
+    """Returns a page of the Recommendations and the headers linking to the next page"""
+    limit = args["limit"]
+    # Fetch one extra row to know whether there is a next page
+    recommendations = get_recommendation_based_on_filter(args, amount=limit + 1, after_id=args["after_id"])
+
+    headers = {}
+    if len(recommendations) > limit:
+        recommendations = recommendations[:limit]
+        query = next_page_query(request.args, limit, recommendations[-1].id)
+        next_url = api.url_for(RecommendationCollection, _external=True, **query)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+
+    return recommendations, headers
+
+
+######################################################################
+# CONDITIONAL REQUESTS
+######################################################################
+def not_modified(etag):
+    """Returns a 304 Not Modified response for the given ETag"""
+    return {}, status.HTTP_304_NOT_MODIFIED, {"ETag": quote_etag(etag)}
+
+
+def get_product_list(pid, params, load_results):
+    """Returns a cached list of the Recommendations of a product with its ETag, or a 304"""
+    if request.if_none_match:
+        etag = product_list_etag(pid, params, ProductVersion.find_version(pid))
+        if etag in request.if_none_match:
+            return not_modified(etag)
+
+    def load_versioned_results():
+        # The version is read first so it can never be newer than the rows
+        version = ProductVersion.find_version(pid)
+        return {"version": version, "results": load_results()}
+
+    cached = cache.get_pid_list(pid, params, load_versioned_results)
+    etag = product_list_etag(pid, params, cached["version"])
+    return json_response(cached["results"], headers={"ETag": quote_etag(etag)})
+
+
+def get_indexed_list(pid, params, indexed):
+    """Returns a list of the Recommendations of a product from the adjacency index, or a 304"""
+    rec_type, liked, amount = params
+    version, edges = indexed
+    etag = product_list_etag(pid, params, version)
+    if request.if_none_match and etag in request.if_none_match:
+        return not_modified(etag)
+
+    edges = [
+        edge for edge in edges
+        if (rec_type is None or edge[3] == rec_type) and (liked is None or edge[4] == liked)
+    ]
+    return json_response(encode_recommendations(edges[:amount]), headers={"ETag": quote_etag(etag)})
+
+
+def get_neighbors(pids):
+    """Returns the (recommended_pid, type, liked) edges of products, from the adjacency index when it can answer"""
+    neighbors = {}
+    missing = []
+    for pid in pids:
+        indexed = adjacency_index.lookup(pid)
+        if indexed is None:
+            missing.append(pid)
+        else:
+            neighbors[pid] = [(edge[2], edge[3], edge[4]) for edge in indexed[1]]
+    if missing:
+        for record in Recommendation.iterate_edges(missing):
+            neighbors.setdefault(record.pid, []).append((record.recommended_pid, record.type, record.liked))
+    return neighbors
+
+
+def load_recommendation(recommendation_id):
+    """Returns the serialized Recommendation with the given id or None"""
+    rec = Recommendation.find(recommendation_id)
+    return rec.serialize() if rec else None
 
 
 ######################################################################
@@ -120,56 +391,37 @@ class RecommendationCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_recommendations')
     @api.expect(rec_args, validate=True)
+    @api.response(304, 'The list of the product (pid) did not change since the If-None-Match ETag')
     @api.response(400, 'The query parameter was not valid')
-    @api.marshal_list_with(recommendation_model, code=200)
+    @api.response(200, 'Success', [recommendation_model])
     def get(self):
         """Returns list of the Recommendations"""
-        app.logger.info("Request for Recommendations list")
+        read_logger.info("Request for Recommendations list")
 
-        args = rec_args.parse_args()
-        rec_type = args.get("type")
-        liked = args.get("liked")
-        recommendations = get_recommendation_based_on_filter(rec_type, liked)
-
-        pid = None
-        amount = None
-
-        try:
-            pid = int(args.get('pid'))
-        except TypeError:  # pylint: disable=broad-except
-            pass
-
-        try:
-            amount = int(args.get('amount'))
-        except TypeError:  # pylint: disable=broad-except
-            pass
-
-        if pid is not None:
-            results = []
-            for recommendation in recommendations:
-                if recommendation.pid == pid:
-                    results.append(recommendation.serialize())
-        else:
-            results = [recommendation.serialize() for recommendation in recommendations]
-
-        if amount is not None:
-            # Get top k recommendations (Sort first if adding priority)
-            if amount < 0:
-                abort(
-                    status.HTTP_400_BAD_REQUEST,
-                    "'amount' must be a positive integer.",
-                )
-            result = results[0:amount]
-        else:
-            result = results
+        args = parse_list_args(request.args)
+        if args["limit"] is not None:
+            recommendations, headers = get_recommendation_page(args)
+            return json_response(encode_recommendations(recommendations), headers=headers)
 
-        return result, status.HTTP_200_OK
+        def load_results():
+            return encode_recommendations(get_recommendation_based_on_filter(args, amount=args["amount"]))
+
+        if args["pid"] is None:
+            return json_response(load_results())
+
+        # The lists of a product are read constantly from the product pages
+        params = list_params(args)
+        indexed = adjacency_index.lookup(args["pid"])
+        if indexed is not None:
+            return get_indexed_list(args["pid"], params, indexed)
+        return get_product_list(args["pid"], params, load_results)
 
     # ------------------------------------------------------------------
     #  CREATE A NEW RECOMMENDATION
     # ------------------------------------------------------------------
     @api.doc('create_recommendations')
     @api.response(400, 'The posted data was not valid')
+    @api.response(409, 'The Recommendation already exists')
     @api.expect(create_model)
     @api.marshal_with(recommendation_model, code=201)
     def post(self):
@@ -188,6 +440,186 @@ class RecommendationCollection(Resource):
 
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
+    # ------------------------------------------------------------------
+    #  UPDATE ALL MATCHING RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc('bulk_update_recommendations')
+    @api.expect(filter_args, update_model, validate=False)
+    @api.response(400, 'The filters or the changes were not valid')
+    @api.response(409, 'The update would duplicate a Recommendation')
+    def patch(self):
+        """ Update every recommendation matching the filters in one statement """
+        app.logger.info("Request to bulk update Recommendations")
+
+        filters = get_bulk_filters()
+        count = Recommendation.update_by_attributes(api.payload, **filters)
+        app.logger.info("%s Recommendations were updated", count)
+        return {"updated": count}, status.HTTP_200_OK
+
+    # ------------------------------------------------------------------
+    #  DELETE ALL MATCHING RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc('bulk_delete_recommendations')
+    @api.expect(filter_args, validate=True)
+    @api.response(400, 'The filters were not valid')
+    def delete(self):
+        """ Delete every recommendation matching the filters in one statement """
+        app.logger.info("Request to bulk delete Recommendations")
+
+        filters = get_bulk_filters()
+        count = Recommendation.delete_by_attributes(**filters)
+        app.logger.info("%s Recommendations were deleted", count)
+        return {"deleted": count}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/bulk
+######################################################################
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def parse_ndjson_line(line):
+    """Returns the JSON value of a NDJSON line or None when it is not valid JSON"""
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def read_bulk_items():
+    """Returns the items of a bulk request sent as a JSON array or as NDJSON"""
+    max_items = app.config["BULK_MAX_ITEMS"]
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = (parse_ndjson_line(line) for line in request.stream if line.strip())
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"The request body must be a JSON array or {NDJSON_MIMETYPE}.",
+            )
+
+    for position, item in enumerate(items):
+        if position >= max_items:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"A bulk request cannot contain more than {max_items} items.",
+            )
+        yield item
+
+
+@api.route('/recommendations/bulk')
+class RecommendationBulkCollection(Resource):
+    """
+    Handles the creation of many Recommendations at once
+    """
+
+    @api.doc('bulk_create_recommendations',
+             description=f'Accepts a JSON array or {NDJSON_MIMETYPE} (one Recommendation per line). '
+                         'All the valid items are created in a single transaction.')
+    @api.expect([create_model])
+    @api.response(400, 'The request body was not a list of Recommendations')
+    @api.response(413, 'The request contained too many items')
+    @api.response(200, 'The outcome of every item', bulk_response_model)
+    def post(self):
+        """ Create many recommendations """
+        app.logger.info("Request to bulk create Recommendations")
+
+        results = Recommendation.bulk_create(read_bulk_items(), batch_size=app.config["BULK_BATCH_SIZE"])
+        created = sum(result["status"] == "created" for result in results)
+        return {
+            "created": created,
+            "failed": len(results) - created,
+            "results": results,
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/lookup
+######################################################################
+def get_lookup_request(data):
+    """Returns the de-duplicated pids, the per-pid limit and the type of a lookup request"""
+    if not isinstance(data, dict) or not isinstance(data.get("pids"), list):
+        raise DataValidationError("Invalid lookup: 'pids' must be a list of product IDs")
+    pids = data["pids"]
+    if any(isinstance(pid, bool) or not isinstance(pid, int) for pid in pids):
+        raise DataValidationError("Invalid lookup: 'pids' must be a list of product IDs")
+    pids = list(dict.fromkeys(pids))
+    if len(pids) > MAX_LOOKUP_PIDS:
+        raise DataValidationError(f"Invalid lookup: at most {MAX_LOOKUP_PIDS} pids can be looked up at once")
+
+    limit = data.get("limit", 10)
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 0 < limit <= MAX_LOOKUP_LIMIT:
+        raise DataValidationError(f"Invalid lookup: 'limit' must be between 1 and {MAX_LOOKUP_LIMIT}")
+
+    rec_type = data.get("type")
+    check_recommendation_type(rec_type)
+    return pids, limit, rec_type
+
+
+@api.route('/recommendations/lookup')
+class RecommendationLookup(Resource):
+    """
+    Looks up the Recommendations of many products at once
+    """
+
+    @api.doc('lookup_recommendations')
+    @api.expect(lookup_model)
+    @api.response(400, 'The lookup request was not valid')
+    @api.response(200, 'Success', [lookup_result_model])
+    def post(self):
+        """ Returns the best recommendations of every requested product with a single query """
+        read_logger.info("Request to look up Recommendations")
+
+        pids, limit, rec_type = get_lookup_request(api.payload)
+        grouped = {pid: [] for pid in pids}
+        if pids:
+            for rec in Recommendation.find_top_by_pids(pids, limit, rec_type=rec_type):
+                grouped[rec.pid].append(rec.serialize())
+
+        return json_response(dumps([{"pid": pid, "recommendations": recs} for pid, recs in grouped.items()]))
+
+
+######################################################################
+#  PATH: /recommendations/export
+######################################################################
+EXPORT_FORMATS = {
+    "ndjson": (ndjson_chunks, NDJSON_MIMETYPE),
+    "csv": (csv_chunks, "text/csv"),
+}
+
+
+@api.route('/recommendations/export')
+class RecommendationExport(Resource):
+    """
+    Streams every Recommendation for downstream jobs
+    """
+
+    @api.doc('export_recommendations',
+             description='Streams the whole table as NDJSON or CSV. The response is gzip '
+                         'compressed when the client sends "Accept-Encoding: gzip".')
+    @api.expect(export_args, validate=True)
+    @api.response(400, 'The export format was not valid')
+    @api.produces([NDJSON_MIMETYPE, 'text/csv'])
+    def get(self):
+        """ Export all recommendations """
+        app.logger.info("Request to export Recommendations")
+
+        args = export_args.parse_args()
+        encode, mimetype = EXPORT_FORMATS[args.get("format")]
+        rows = Recommendation.iterate_rows(batch_size=app.config["EXPORT_BATCH_SIZE"])
+        chunks = encode(rows, Recommendation.FIELDS)
+
+        headers = {
+            "Content-Disposition": f"attachment; filename=recommendations.{args.get('format')}",
+            "Vary": "Accept-Encoding",
+        }
+        if request.accept_encodings["gzip"]:
+            chunks = gzip_chunks(chunks)
+            headers["Content-Encoding"] = "gzip"
+
+        return Response(stream_with_context(chunks), status=status.HTTP_200_OK, mimetype=mimetype, headers=headers)
+
 
 ######################################################################
 #  PATH: /recommendations/{id}
@@ -208,6 +640,7 @@ class RecommendationResource(Resource):
     #  RETRIEVE A RECOMMENDATION
     # ------------------------------------------------------------------
     @api.doc('get_recommendations')
+    @api.response(304, 'Recommendation not modified since the If-None-Match ETag')
     @api.response(404, 'Recommendation not found')
     @api.marshal_with(recommendation_model)
     def get(self, recommendation_id):
@@ -215,17 +648,25 @@ class RecommendationResource(Resource):
         Retrieve a single Recommendation
         This endpoint will return a Recommendation based on it's id
         """
-        app.logger.info("Request for Recommendation with id: %s", recommendation_id)
+        read_logger.info("Request for Recommendation with id: %s", recommendation_id)
+
+        # Only the version is read to answer a conditional request
+        if request.if_none_match:
+            version = Recommendation.find_version(recommendation_id)
+            etag = recommendation_etag(recommendation_id, version)
+            if version is not None and etag in request.if_none_match:
+                return not_modified(etag)
 
         # See if the account exists and abort if it doesn't
-        rec = Recommendation.find(recommendation_id)
+        rec = cache.get_recommendation(recommendation_id, lambda: load_recommendation(recommendation_id))
         if not rec:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Recommendation with id '{recommendation_id}' could not be found.",
             )
 
-        return rec.serialize(), status.HTTP_200_OK
+        etag = recommendation_etag(recommendation_id, rec["version"])
+        return rec, status.HTTP_200_OK, {"ETag": quote_etag(etag)}
 
     # ------------------------------------------------------------------
     #  UPDATE A RECOMMENDATION
@@ -233,6 +674,7 @@ class RecommendationResource(Resource):
     @api.doc('update_recommendations')
     @api.response(404, 'Recommendation not found')
     @api.response(400, 'The posted Recommendation data was not valid')
+    @api.response(409, 'The Recommendation already exists')
     @api.expect(create_model)
     @api.marshal_with(recommendation_model)
     def put(self, recommendation_id):
@@ -269,6 +711,180 @@ class RecommendationResource(Resource):
         return "", status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+#  PATH: /products/{pid}/recommendations
+######################################################################
+@api.route('/products/<int:pid>/recommendations')
+@api.param('pid', 'The product identifier')
+class ProductRecommendationCollection(Resource):
+    """
+    Handles the ranked Recommendations of a product
+    """
+
+    @api.doc('list_top_recommendations')
+    @api.expect(top_args, validate=True)
+    @api.response(304, 'The Recommendations did not change since the If-None-Match ETag')
+    @api.response(400, 'The query parameter was not valid')
+    @api.response(200, 'Success', [recommendation_model])
+    def get(self, pid):
+        """Returns the best Recommendations of a product"""
+        read_logger.info("Request for the top Recommendations of product %s", pid)
+
+        args = top_args.parse_args()
+        top = args.get("top")
+        rec_type = args.get("type")
+        check_recommendation_type(rec_type)
+        if not 0 < top <= MAX_TOP:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"'top' must be between 1 and {MAX_TOP}.",
+            )
+
+        def load_results():
+            return encode_recommendations(Recommendation.fetch_records(Recommendation.select_top(pid, top, rec_type=rec_type)))
+
+        return get_product_list(pid, ("top", top, rec_type), load_results)
+
+    @api.doc('sync_recommendations',
+             description=f'Accepts a JSON array or {NDJSON_MIMETYPE}. The list replaces the Recommendations '
+                         'of the product in a single transaction: the missing ones are deleted.')
+    @api.expect([sync_item_model])
+    @api.response(400, 'The request body was not a list of valid Recommendations')
+    @api.response(413, 'The request contained too many items')
+    @api.response(200, 'The number of Recommendations inserted, updated, unchanged and removed', sync_result_model)
+    def put(self, pid):
+        """Replaces the Recommendations of a product"""
+        app.logger.info("Request to sync the Recommendations of product %s", pid)
+
+        result = Recommendation.sync_product(pid, read_bulk_items(), batch_size=app.config["BULK_BATCH_SIZE"])
+        app.logger.info("Synced the Recommendations of product %s: %s", pid, result)
+        return result, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/{pid}/recommendations/expanded
+######################################################################
+@api.route('/products/<int:pid>/recommendations/expanded')
+@api.param('pid', 'The product identifier')
+class ProductExpansion(Resource):
+    """
+    Recommends the products a few hops away in the Recommendation graph
+    """
+
+    @api.doc('expand_recommendations')
+    @api.expect(expand_args, validate=True)
+    @api.response(400, 'The query parameter was not valid')
+    @api.marshal_with(expansion_model, code=200)
+    def get(self, pid):
+        """Returns the best products reachable from a product in a few hops"""
+        read_logger.info("Request to expand the Recommendations of product %s", pid)
+
+        args = expand_args.parse_args()
+        depth = args.get("depth")
+        limit = args.get("limit")
+        if not 0 < depth <= MAX_EXPANSION_DEPTH:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"'depth' must be between 1 and {MAX_EXPANSION_DEPTH}.",
+            )
+        if not 0 < limit <= MAX_EXPANSION_LIMIT:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"'limit' must be between 1 and {MAX_EXPANSION_LIMIT}.",
+            )
+
+        expansion = expand(
+            pid,
+            get_neighbors,
+            depth,
+            limit,
+            budget=app.config["EXPANSION_TIME_BUDGET_MS"] / 1000,
+            frontier_limit=app.config["EXPANSION_FRONTIER_LIMIT"],
+        )
+        if expansion.truncated:
+            app.logger.warning("Expansion of product %s stopped by its time budget", pid)
+        recommendations = [
+            {"recommended_pid": recommended_pid, "score": round(score, 6), "depth": hop, "via": via}
+            for recommended_pid, score, hop, via in expansion.recommendations
+        ]
+        return {
+            "pid": pid,
+            "depth": depth,
+            "truncated": expansion.truncated,
+            "recommendations": recommendations,
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/{pid}/recommendations/stats
+######################################################################
+@api.route('/products/<int:pid>/recommendations/stats')
+@api.param('pid', 'The product identifier')
+class ProductStatsResource(Resource):
+    """
+    Like and impression totals of the Recommendations of a product
+    """
+
+    @api.doc('get_recommendation_stats')
+    @api.marshal_with(product_stats_model, code=200)
+    def get(self, pid):
+        """Returns the like and impression totals of a product"""
+        read_logger.info("Request for the Recommendation stats of product %s", pid)
+        return ProductStats.find(pid), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/impressions
+######################################################################
+@api.route('/recommendations/impressions')
+class RecommendationImpressions(Resource):
+    """
+    Counts the impressions of Recommendations
+    """
+
+    @api.doc('record_impressions')
+    @api.expect(impressions_model)
+    @api.response(400, 'The impressions were not valid')
+    def post(self):
+        """Counts one impression for every Recommendation id of the request"""
+        data = api.payload
+        if not isinstance(data, dict) or not isinstance(data.get("ids"), list):
+            raise DataValidationError("Invalid impressions: 'ids' must be a list of Recommendation ids")
+        ids = data["ids"]
+        if any(isinstance(rec_id, bool) or not isinstance(rec_id, int) for rec_id in ids):
+            raise DataValidationError("Invalid impressions: 'ids' must be a list of Recommendation ids")
+        if len(ids) > MAX_IMPRESSIONS:
+            raise DataValidationError(f"Invalid impressions: at most {MAX_IMPRESSIONS} can be recorded at once")
+        app.logger.info("Request to record %d impressions", len(ids))
+
+        return {"recorded": Recommendation.add_impressions(ids)}, status.HTTP_200_OK
+
+
+def set_liked(recommendation_id, liked):
+    """
+    Likes or unlikes a Recommendation and returns it, queueing the change with the write-behind
+
+    The write-behind is eventually consistent: the response has the new liked value but
+    the reads show the stored Recommendation until the next flush commits the change.
+    """
+    if like_writes.enabled:
+        rec = cache.get_recommendation(recommendation_id, lambda: load_recommendation(recommendation_id))
+    else:
+        rec = Recommendation.set_liked(recommendation_id, liked)
+    if not rec:
+        abort(
+            status.HTTP_404_NOT_FOUND,
+            f"Recommendation with id '{recommendation_id}' could not be found.",
+        )
+
+    if like_writes.enabled:
+        like_writes.enqueue(recommendation_id, liked)
+        # Reloaded by the next read, the flush invalidates it again once committed
+        cache.invalidate(ids=[recommendation_id])
+        return dict(rec, liked=liked)
+    return rec.serialize()
+
+
 ######################################################################
 #  PATH: /recommendations/{id}/like
 ######################################################################
@@ -284,16 +900,7 @@ class LikeResource(Resource):
         """ Like a recommendation """
         app.logger.info("Request to like a Recommendation")
 
-        rec = Recommendation.find(recommendation_id)
-        if not rec:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Recommendation with id '{recommendation_id}' could not be found.",
-            )
-
-        rec.liked = True
-        rec.update()
-        return rec.serialize(), status.HTTP_200_OK
+        return set_liked(recommendation_id, True), status.HTTP_200_OK
 
 
 ######################################################################
@@ -311,13 +918,4 @@ class UnlikeResource(Resource):
         """ Unlike a recommendation """
         app.logger.info("Request to unlike a Recommendation")
 
-        rec = Recommendation.find(recommendation_id)
-        if not rec:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Recommendation with id '{recommendation_id}' could not be found.",
-            )
-
-        rec.liked = False
-        rec.update()
-        return rec.serialize(), status.HTTP_200_OK
+        return set_liked(recommendation_id, False), status.HTTP_200_OK
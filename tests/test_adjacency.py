@@ -0,0 +1,129 @@
+"""
+Test cases for the Adjacency Index
+
+"""
+from datetime import datetime, timedelta
+from unittest import TestCase
+from service.common.adjacency import AdjacencyArrays, AdjacencyIndex, merge_groups
+
+START = datetime(2023, 1, 1)
+
+
+class FakeApp:  # pylint: disable=too-few-public-methods
+    """ A Flask app with only a configuration """
+
+    def __init__(self, **config):
+        self.config = config
+
+
+class FakeTable:
+    """ The product_version and recommendation tables in memory """
+
+    def __init__(self):
+        self.versions = {}
+        self.edges = {}
+        self.clock = START
+        self.next_id = 1
+
+    def write(self, pid, *edges):
+        """ Replaces the edges of a product as (recommended_pid, type, liked, score) """
+        self.clock += timedelta(seconds=1)
+        version = self.versions.get(pid, (0, None))[0] + 1
+        self.versions[pid] = (version, self.clock)
+        self.edges[pid] = []
+        for recommended_pid, rec_type, liked, score in edges:
+            self.edges[pid].append((self.next_id, pid, recommended_pid, rec_type, liked, score))
+            self.next_id += 1
+
+    def load_versions(self, since):
+        """ Returns the (pid, version, updated_at) changed since a time """
+        return [
+            (pid, version, updated_at) for pid, (version, updated_at) in self.versions.items()
+            if since is None or updated_at >= since
+        ]
+
+    def load_edges(self, pids):
+        """ Returns the edges of the products ordered by pid and id """
+        pids = sorted(self.edges) if pids is None else pids
+        return [edge for pid in sorted(pids) for edge in self.edges.get(pid, [])]
+
+
+######################################################################
+#  A D J A C E N C Y   I N D E X   T E S T   C A S E S
+######################################################################
+class TestAdjacencyIndex(TestCase):
+    """ Adjacency Index Tests """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.table = FakeTable()
+        self.table.write(1, (2, "default", False, 1.0), (3, "accessory", True, 2.0), (4, "default", None, 0.5))
+        self.table.write(5, (6, "cross-sell", False, 0.0))
+        self.index = AdjacencyIndex()
+        self.index.init_app(FakeApp(ADJACENCY_INDEX=True), self.table.load_versions, self.table.load_edges)
+        self.index.start = lambda: None
+
+    def test_arrays(self):
+        """It should store the edges in CSR arrays per type"""
+        versions = {pid: version for pid, (version, _) in self.table.versions.items()}
+        versions[9] = 3
+        arrays = AdjacencyArrays.build(merge_groups(versions, self.table.load_edges(None)))
+        self.assertEqual(list(arrays.pids), [1, 5, 9])
+        self.assertEqual(list(arrays.types["default"].offsets), [0, 2, 2, 2])
+        self.assertEqual(list(arrays.types["cross-sell"].offsets), [0, 0, 1, 1])
+        version, edges = arrays.find(1)
+        self.assertEqual(version, 1)
+        self.assertEqual(edges, self.table.edges[1])
+        self.assertEqual(arrays.find(9), (3, []))
+        self.assertIsNone(arrays.find(2))
+        self.assertEqual(arrays.edge_count(), 4)
+        self.assertEqual(arrays.nbytes(), 3 * 4 + 3 * 8 + 3 * 4 * 8 + 4 * 17)
+
+    def test_lookup(self):
+        """It should answer from the index once loaded"""
+        self.assertIsNone(self.index.lookup(1))
+        self.index.refresh()
+        self.assertEqual(self.index.lookup(1), (1, self.table.edges[1]))
+        self.assertEqual(self.index.lookup(100), (0, []))
+
+        self.index.enabled = False
+        self.assertIsNone(self.index.lookup(1))
+
+    def test_incremental_refresh(self):
+        """It should only reload the products that changed"""
+        self.index.refresh()
+        self.table.write(1, (7, "default", False, 1.0))
+        self.table.write(8, (9, "up-sell", True, 1.0))
+        self.index.refresh()
+        self.assertEqual(set(self.index.snapshot.overlay), {1, 8})
+        self.assertEqual(self.index.lookup(1), (2, self.table.edges[1]))
+        self.assertEqual(self.index.lookup(8), (1, self.table.edges[8]))
+        self.assertEqual(self.index.lookup(5), (1, self.table.edges[5]))
+        self.assertEqual(self.index.snapshot.watermark, self.table.clock)
+
+        self.table.write(1)
+        self.index.refresh()
+        self.assertEqual(self.index.lookup(1), (3, []))
+
+    def test_compaction(self):
+        """It should merge a large overlay into new arrays"""
+        self.index.refresh()
+        for pid in range(100, 1102):
+            self.table.write(pid, (pid + 1, "default", False, 0.0))
+        self.table.write(5)
+        self.index.refresh()
+        self.assertEqual(self.index.snapshot.overlay, {})
+        self.assertEqual(len(self.index.snapshot.arrays.pids), 1004)
+        self.assertEqual(self.index.lookup(1100), (1, self.table.edges[1100]))
+        self.assertEqual(self.index.lookup(5), (2, []))
+        self.assertEqual(self.index.stats()["edges"], 3 + 1002)
+
+    def test_local_writes(self):
+        """It should send the products written locally to the database until reloaded"""
+        self.index.refresh()
+        self.index.invalidate(pids=[1])
+        self.assertIsNone(self.index.lookup(1))
+        self.table.write(1, (7, "default", False, 1.0))
+        self.index.refresh()
+        self.assertEqual(self.index.lookup(1), (2, self.table.edges[1]))
+        self.assertEqual(self.index.stats()["dirty"], 0)
@@ -0,0 +1,93 @@
+"""
+Test cases for the benchmark helpers
+
+"""
+import os
+import unittest
+from unittest import TestCase
+from benchmarks.bench import RssSampler, percentile, read_rss_kb, summarize, tree_rss_kb
+from benchmarks.startup import UNREACHABLE_DATABASE_URI, run_probe, summarize_runs
+from benchmarks.seed import generate, seed
+from service.models import ProductVersion, Recommendation
+from tests.utils import DatabaseTestCase
+
+
+######################################################################
+#  B E N C H M A R K   T E S T   C A S E S
+######################################################################
+class TestBenchmarks(TestCase):
+    """ Benchmark Helper Tests """
+
+    def test_percentile(self):
+        """It should return nearest-rank percentiles"""
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 0.50), 50)
+        self.assertEqual(percentile(samples, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_summarize(self):
+        """It should report latencies in milliseconds and the request rate"""
+        report = summarize("get", [0.002, 0.001, 0.003, 0.004], 1, 2.0)
+        self.assertEqual(report["requests"], 4)
+        self.assertEqual(report["errors"], 1)
+        self.assertEqual(report["rps"], 2.0)
+        self.assertEqual(report["p50_ms"], 2.0)
+        self.assertEqual(report["max_ms"], 4.0)
+        self.assertNotIn("rss_peak_kb", report)
+        report = summarize("get", [], 0, 0.0, {"rss_peak_kb": 10})
+        self.assertEqual((report["p50_ms"], report["rss_peak_kb"]), (None, 10))
+
+    def test_rss_sampler(self):
+        """It should report the RSS of the service at the start and end of a scenario and its peak"""
+        samples = iter([100, 150, 120])
+        sampler = RssSampler(lambda: next(samples), interval=3600).start()
+        sampler.samples.append(next(samples))
+        rss = sampler.stop()
+        self.assertEqual(rss, {"rss_start_kb": 100, "rss_end_kb": 120, "rss_peak_kb": 150, "rss_growth_kb": 20})
+        self.assertIsNone(RssSampler(lambda: None).start().stop()["rss_peak_kb"])
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "reads /proc")
+    def test_read_rss(self):
+        """It should read the RSS of a process and of its children from /proc"""
+        self.assertGreater(read_rss_kb(), 0)
+        self.assertGreaterEqual(tree_rss_kb(os.getpid()), read_rss_kb(os.getpid()))
+        self.assertIsNone(tree_rss_kb(2 ** 31))
+
+    def test_generate(self):
+        """It should generate Recommendations that never conflict"""
+        items = list(generate(95, fanout=10))
+        self.assertEqual(len(items), 95)
+        self.assertEqual(len({(item["pid"], item["recommended_pid"], item["type"]) for item in items}), 95)
+        self.assertEqual(max(item["pid"] for item in items), 10)
+
+    def test_summarize_runs(self):
+        """It should report the startup timings in milliseconds"""
+        runs = [{"import": 0.2, "first_request": 0.25, "process": 0.3, "status": 200}] * 3
+        report = summarize_runs(runs)
+        self.assertEqual(report["import"]["p50_ms"], 200.0)
+        self.assertEqual(report["first_request"]["max_ms"], 250.0)
+        self.assertEqual((report["runs"], report["statuses"]), (3, [200]))
+
+    def test_start_without_database(self):
+        """It should load the service and answer /health while the database is unreachable"""
+        timings = run_probe(dict(os.environ, DATABASE_URI=UNREACHABLE_DATABASE_URI))
+        self.assertEqual(timings["status"], 200)
+        self.assertLess(timings["import"], timings["process"])
+
+
+class TestSeed(DatabaseTestCase):
+    """ Benchmark Seeding Tests """
+
+    def test_seed(self):
+        """It should only delete the existing Recommendations when asked to"""
+        self.assertEqual(seed(25, fanout=10, chunk_size=10), range(1, 4))
+        self.assertEqual(len(Recommendation.all()), 25)
+        self.assertRaises(ValueError, seed, 5)
+        self.assertEqual(len(Recommendation.all()), 25)
+
+        version = ProductVersion.find_version(3)
+        self.assertEqual(seed(5, fanout=10, reset=True), range(1, 2))
+        self.assertEqual(len(Recommendation.all()), 5)
+        # The emptied products changed, so their caches and ETags do too
+        self.assertEqual(ProductVersion.find_version(3), version + 1)
@@ -0,0 +1,211 @@
+"""
+Test cases for the Recommendation Cache
+
+"""
+from unittest import TestCase
+from service.common.cache import MISSING, MemoryBackend, NullBackend, RecommendationCache, RedisBackend
+
+
+class FakeClock:  # pylint: disable=too-few-public-methods
+    """ A clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """ The subset of the redis client used by RedisBackend """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        """ Returns the value of a key """
+        return self.data.get(key)
+
+    def set(self, key, value, px=None, nx=False):  # pylint: disable=unused-argument, invalid-name
+        """ Sets the value of a key, only if it has none with nx """
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        """ Removes keys """
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        """ Increments a counter """
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def scan_iter(self, match):
+        """ Iterates over the keys matching a prefix """
+        return [key for key in list(self.data) if key.startswith(match.rstrip("*"))]
+
+
+class FakeRedisError(Exception):
+    """ Stands for redis.RedisError """
+
+
+class BrokenRedis:  # pylint: disable=too-few-public-methods
+    """ A redis client whose server is unreachable """
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise FakeRedisError(f"{name}: connection refused")
+        return fail
+
+
+class TestMemoryBackend(TestCase):
+    """ Test Cases for the in-process LRU """
+
+    def test_lru_eviction(self):
+        """It should evict the least recently used entries"""
+        backend = MemoryBackend(max_entries=2, ttl=10)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        self.assertEqual(backend.get("a"), 1)
+        backend.set("c", 3)
+        self.assertIs(backend.get("b"), MISSING)
+        self.assertEqual(backend.get("a"), 1)
+        self.assertEqual(backend.get("c"), 3)
+        self.assertEqual(len(backend), 2)
+
+    def test_ttl(self):
+        """It should expire entries after the TTL"""
+        clock = FakeClock()
+        backend = MemoryBackend(ttl=5, clock=clock)
+        backend.set("a", 1)
+        clock.now = 4.9
+        self.assertEqual(backend.get("a"), 1)
+        clock.now = 5.0
+        self.assertIs(backend.get("a"), MISSING)
+        self.assertEqual(len(backend), 0)
+
+    def test_delete_and_clear(self):
+        """It should delete and clear entries"""
+        backend = MemoryBackend()
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.delete("a", "unknown")
+        self.assertIs(backend.get("a"), MISSING)
+        backend.clear()
+        self.assertIs(backend.get("b"), MISSING)
+        self.assertNotEqual(backend.next_sequence(), backend.next_sequence())
+
+
+class TestRecommendationCache(TestCase):
+    """ Test Cases for the read-through cache """
+
+    def setUp(self):
+        self.cache = RecommendationCache(MemoryBackend())
+        self.loads = 0
+
+    def _loader(self, value):
+        def load():
+            self.loads += 1
+            return value
+        return load
+
+    def test_read_through(self):
+        """It should only call the loader on a miss"""
+        self.assertEqual(self.cache.get_recommendation(1, self._loader({"id": 1})), {"id": 1})
+        self.assertEqual(self.cache.get_recommendation(1, self._loader({"id": 2})), {"id": 1})
+        self.assertEqual(self.loads, 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_ratio"]), (1, 1, 0.5))
+
+    def test_not_found_is_not_cached(self):
+        """It should not cache a missing Recommendation"""
+        self.assertIsNone(self.cache.get_recommendation(1, self._loader(None)))
+        self.assertIsNone(self.cache.get_recommendation(1, self._loader(None)))
+        self.assertEqual(self.loads, 2)
+
+    def test_invalidate(self):
+        """It should invalidate a Recommendation and every list of its product"""
+        self.cache.get_recommendation(1, self._loader({"id": 1}))
+        self.cache.get_pid_list(7, ("default", None), self._loader([1]))
+        self.cache.get_pid_list(7, (None, True), self._loader([2]))
+        self.cache.get_pid_list(8, (None, None), self._loader([3]))
+        self.assertEqual(self.loads, 4)
+
+        self.cache.invalidate(ids=[1], pids=[7])
+        self.cache.get_recommendation(1, self._loader({"id": 1}))
+        self.cache.get_pid_list(7, ("default", None), self._loader([1]))
+        self.cache.get_pid_list(7, (None, True), self._loader([2]))
+        self.assertEqual(self.loads, 7)
+        self.assertEqual(self.cache.get_pid_list(8, (None, None), self._loader([4])), [3])
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+    def test_evicted_generation(self):
+        """It should never serve a stale list when the generation was evicted"""
+        self.cache.get_pid_list(7, (), self._loader([1]))
+        self.cache.invalidate(pids=[7])
+        self.cache.backend.delete("gen:7")
+        self.assertEqual(self.cache.get_pid_list(7, (), self._loader([2])), [2])
+
+    def test_stale_read(self):
+        """It should not cache a Recommendation or a list loaded before a write committed"""
+        def load_before_write(value):
+            def load():
+                self.cache.invalidate(ids=[1], pids=[7])
+                return value
+            return load
+
+        self.assertEqual(self.cache.get_recommendation(1, load_before_write({"liked": False})), {"liked": False})
+        self.assertEqual(self.cache.get_recommendation(1, self._loader({"liked": True})), {"liked": True})
+        self.assertEqual(self.cache.get_pid_list(7, (), load_before_write([1])), [1])
+        self.assertEqual(self.cache.get_pid_list(7, (), self._loader([2])), [2])
+
+    def test_concurrent_generation(self):
+        """It should keep the generation set by an invalidation while a reader creates one"""
+        self.assertEqual(self.cache.backend.add("gen:7", 5), 5)
+        self.assertEqual(self.cache.backend.add("gen:7", 6), 5)
+        self.assertEqual(NullBackend().add("gen:7", 6), 6)
+        client = FakeRedis()
+        backend = RedisBackend(client=client)
+        self.assertEqual((backend.add("gen:7", 5), backend.add("gen:7", 6)), (5, 5))
+
+    def test_null_backend(self):
+        """It should always call the loader when caching is disabled"""
+        cache = RecommendationCache(NullBackend())
+        cache.get_pid_list(7, (), self._loader([1]))
+        cache.get_pid_list(7, (), self._loader([1]))
+        cache.invalidate(ids=[1], pids=[7])
+        cache.clear()
+        self.assertEqual(self.loads, 2)
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_redis_backend(self):
+        """It should share the entries through Redis as JSON"""
+        client = FakeRedis()
+        cache = RecommendationCache(RedisBackend(client=client))
+        cache.get_recommendation(1, self._loader({"id": 1}))
+        self.assertEqual(client.get("recommendations:gen:rec:1"), "1")
+        self.assertEqual(client.get("recommendations:rec:1:1"), '{"id": 1}')
+        self.assertEqual(cache.get_recommendation(1, self._loader({"id": 2})), {"id": 1})
+        cache.invalidate(ids=[1], pids=[3])
+        self.assertEqual(cache.get_recommendation(1, self._loader({"id": 2})), {"id": 2})
+        self.assertEqual(client.get("recommendations:gen:3"), "2")
+        self.assertEqual(cache.stats()["entries"], 5)
+        cache.clear()
+        self.assertEqual(client.data, {})
+
+    def test_redis_unreachable(self):
+        """It should fall back to the loader and log when Redis fails"""
+        cache = RecommendationCache(RedisBackend(client=BrokenRedis(), errors=(FakeRedisError,)))
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            self.assertEqual(cache.get_recommendation(1, self._loader({"id": 1})), {"id": 1})
+            self.assertEqual(cache.get_pid_list(7, (), self._loader([1])), [1])
+            self.assertEqual(cache.get_pid_list(7, (), self._loader([2])), [2])
+            cache.invalidate(ids=[1], pids=[7])
+            cache.clear()
+            self.assertEqual(cache.stats()["entries"], 0)
+        self.assertIn("connection refused", logs.output[0])
+        self.assertEqual(self.loads, 3)
+        self.assertGreater(cache.backend.failures, 0)
@@ -5,7 +5,8 @@ import os
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.common.cli_commands import db_create, db_migrate
+from service.common.migrations import MigrationError
 
 
 class TestFlaskCLI(TestCase):
@@ -14,10 +15,42 @@ class TestFlaskCLI(TestCase):
     def setUp(self):
         self.runner = CliRunner()
 
+    @patch('service.common.cli_commands.migrations')
     @patch('service.common.cli_commands.db')
-    def test_db_create(self, db_mock):
+    def test_db_create(self, db_mock, migrations_mock):
         """It should call the db-create command"""
         db_mock.return_value = MagicMock()
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+            migrations_mock.stamp.assert_called_once_with(db_mock.engine)
+
+    @patch('service.common.cli_commands.migrations')
+    @patch('service.common.cli_commands.db')
+    def test_db_migrate(self, db_mock, migrations_mock):
+        """It should call the db-migrate command"""
+        migrations_mock.upgrade.return_value = [(1, "Add indexes")]
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_migrate)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Applied migration 1: Add indexes", result.output)
+            migrations_mock.upgrade.assert_called_once_with(db_mock.engine, dedupe=False)
+
+        migrations_mock.upgrade.return_value = []
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_migrate)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("up to date", result.output)
+
+    @patch('service.common.cli_commands.migrations')
+    @patch('service.common.cli_commands.db')
+    def test_db_migrate_refused(self, db_mock, migrations_mock):
+        """It should fail the db-migrate command when a migration refuses the data"""
+        migrations_mock.upgrade.side_effect = MigrationError("1 (pid, recommended_pid, type) are shared")
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_migrate)
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("Error: 1 (pid, recommended_pid, type) are shared", result.output)
+
+            result = self.runner.invoke(db_migrate, ["--dedupe"])
+            migrations_mock.upgrade.assert_called_with(db_mock.engine, dedupe=True)
@@ -0,0 +1,62 @@
+"""
+Test cases for the multi-hop Expansion
+
+"""
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.expansion import DEPTH_DECAY, LIKED_BOOST, TYPE_WEIGHTS, expand
+
+GRAPH = {
+    1: [(2, "frequently-together", False), (3, "default", True)],
+    2: [(4, "accessory", False), (1, "default", False), (3, "up-sell", False)],
+    3: [(4, "cross-sell", False), (5, "default", False)],
+    4: [(6, "accessory", False)],
+}
+
+
+def neighbors(pids):
+    """ Returns the edges of the products of GRAPH """
+    return {pid: GRAPH[pid] for pid in pids if pid in GRAPH}
+
+
+######################################################################
+#  E X P A N S I O N   T E S T   C A S E S
+######################################################################
+class TestExpansion(TestCase):
+    """ Expansion Tests """
+
+    def test_direct_recommendations(self):
+        """It should score the direct Recommendations by type and likes"""
+        result = expand(1, neighbors, depth=1, limit=10, budget=1.0)
+        self.assertEqual(result.recommendations, [
+            (2, TYPE_WEIGHTS["frequently-together"], 1, 1),
+            (3, TYPE_WEIGHTS["default"] * LIKED_BOOST, 1, 1),
+        ])
+        self.assertFalse(result.truncated)
+
+    def test_two_hops(self):
+        """It should sum the paths of the next hop, without the product or the products already found"""
+        result = expand(1, neighbors, depth=2, limit=10, budget=1.0)
+        found = {pid: (score, hop, via) for pid, score, hop, via in result.recommendations}
+        self.assertEqual(set(found), {2, 3, 4, 5})
+        self.assertEqual(found[3][1], 1)
+        via_2 = TYPE_WEIGHTS["frequently-together"] * TYPE_WEIGHTS["accessory"] * DEPTH_DECAY
+        via_3 = TYPE_WEIGHTS["default"] * LIKED_BOOST * TYPE_WEIGHTS["cross-sell"] * DEPTH_DECAY
+        self.assertAlmostEqual(found[4][0], via_2 + via_3)
+        self.assertEqual(found[4][1:], (2, 2))
+        self.assertEqual(result.visited, 7)
+
+        result = expand(1, neighbors, depth=3, limit=2, budget=1.0)
+        self.assertEqual([pid for pid, _, _, _ in result.recommendations], [2, 3])
+
+    def test_frontier_limit(self):
+        """It should only expand the best products of every hop"""
+        result = expand(1, neighbors, depth=3, limit=10, budget=1.0, frontier_limit=1)
+        self.assertEqual({pid for pid, _, _, _ in result.recommendations}, {2, 3, 4, 6})
+
+    def test_time_budget(self):
+        """It should return what it found when the time budget is spent"""
+        with patch("service.common.expansion.time.monotonic", side_effect=[0.0, 0.0, 5.0]):
+            result = expand(1, neighbors, depth=3, limit=10, budget=1.0)
+        self.assertTrue(result.truncated)
+        self.assertEqual({pid for pid, _, _, _ in result.recommendations}, {2, 3})
@@ -0,0 +1,43 @@
+"""
+Test cases for the Export encoders
+
+"""
+import csv
+import gzip
+import io
+import json
+from unittest import TestCase
+from service.common.export import csv_chunks, gzip_chunks, ndjson_chunks
+
+FIELDS = ("id", "name")
+ROWS = [(i, f"name-{i}") for i in range(1000)]
+
+
+class TestExport(TestCase):
+    """ Test Cases for the streaming encoders """
+
+    def test_ndjson_chunks(self):
+        """It should encode rows as NDJSON in bounded chunks"""
+        chunks = list(ndjson_chunks(iter(ROWS), FIELDS, chunk_size=1024))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) < 2048 for chunk in chunks))
+        lines = b"".join(chunks).decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{"id": i, "name": name} for i, name in ROWS])
+
+    def test_csv_chunks(self):
+        """It should encode rows as CSV with a header in bounded chunks"""
+        chunks = list(csv_chunks(iter(ROWS), FIELDS, chunk_size=1024))
+        self.assertGreater(len(chunks), 1)
+        reader = csv.reader(io.StringIO(b"".join(chunks).decode("utf-8")))
+        self.assertEqual(next(reader), list(FIELDS))
+        self.assertEqual([(int(i), name) for i, name in reader], ROWS)
+
+    def test_empty_export(self):
+        """It should encode an empty table"""
+        self.assertEqual(list(ndjson_chunks(iter([]), FIELDS)), [])
+        self.assertEqual(b"".join(csv_chunks(iter([]), FIELDS)), b"id,name\n")
+
+    def test_gzip_chunks(self):
+        """It should compress the chunks as a single gzip stream"""
+        chunks = [b"hello ", b"", b"world"]
+        self.assertEqual(gzip.decompress(b"".join(gzip_chunks(iter(chunks)))), b"hello world")
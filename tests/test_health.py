@@ -0,0 +1,90 @@
+"""
+Test cases for the Health Checks
+
+"""
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.health import HealthCheck
+from service.common.pool_stats import pool_stats
+from service.common.write_behind import like_writes
+
+
+class FakeClock:  # pylint: disable=too-few-public-methods
+    """ A clock moved by hand """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+POOL = {"size": 5, "max_overflow": 5, "checked_out": 1, "waiting": 0}
+
+
+######################################################################
+#  H E A L T H   C H E C K   T E S T   C A S E S
+######################################################################
+class TestHealthCheck(TestCase):
+    """ Health Check Tests """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.clock = FakeClock()
+        self.calls = 0
+        self.failure = None
+        self.health = HealthCheck(clock=self.clock)
+        self.health.check_database = self.check_database
+        self.pool = dict(POOL)
+        patcher = patch.object(pool_stats, "stats", lambda: self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check_database(self):
+        """ Counts the database checks """
+        self.calls += 1
+        if self.failure:
+            raise self.failure
+
+    def test_ready(self):
+        """It should be ready when the database answers"""
+        report = self.health.ready()
+        self.assertEqual(report["status"], "ready")
+        self.assertEqual(report["checks"]["database"]["status"], "up")
+        self.assertEqual(report["checks"]["pool"]["saturation"], 0.1)
+
+    def test_database_check_is_cached(self):
+        """It should only check the database again once the cached result expired"""
+        self.health.ready()
+        self.clock.now += 1
+        self.failure = OSError("connection refused")
+        self.assertEqual(self.health.ready()["status"], "ready")
+        self.assertEqual(self.calls, 1)
+
+        self.clock.now += 1
+        report = self.health.ready()
+        self.assertEqual(report["status"], "down")
+        self.assertEqual(report["checks"]["database"]["error"], "connection refused")
+        self.assertEqual(self.calls, 2)
+
+    def test_degraded_pool(self):
+        """It should be degraded while the pool is saturated, without checking the database"""
+        self.health.ready()
+        self.pool.update(checked_out=10, waiting=3)
+        self.clock.now += 5
+        report = self.health.ready()
+        self.assertEqual(report["status"], "degraded")
+        self.assertTrue(report["checks"]["pool"]["exhausted"])
+        self.assertEqual(report["checks"]["database"]["age_seconds"], 5)
+        self.assertEqual(self.calls, 1)
+
+        self.pool.update(checked_out=2, waiting=4)
+        self.assertEqual(self.health.ready()["checks"]["pool"]["status"], "saturated")
+
+    def test_degraded_queue(self):
+        """It should be degraded while too many likes wait for a flush"""
+        self.health.queue_depth = 2
+        with patch.object(like_writes, "pending", {1: True, 2: False}):
+            report = self.health.ready()
+        self.assertEqual(report["status"], "degraded")
+        self.assertEqual(report["checks"]["queues"]["like_write_behind"], 2)
@@ -0,0 +1,215 @@
+"""
+Test cases for the Log Handlers
+
+"""
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service.common import log_handlers
+from service.common.log_handlers import (
+    AsyncLogHandler, JsonFormatter, LogConfig, RequestIdFilter, SampledLogger, parse_sample_rates
+)
+
+
+def make_record(name="flask.app", level=logging.INFO, msg="Processing %s", args=("lookup",), **extra):
+    """ Returns a log record with the given extras """
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class ListHandler(logging.Handler):
+    """ Keeps the records it handles """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+######################################################################
+#  L O G   H A N D L E R S   T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """ Log Handlers Tests """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask("tests.log_app")
+        self.app.config.update(LOG_SAMPLE_RATES="flask.app.reads=0.5")
+
+    def tearDown(self):
+        """ This runs after each test """
+        shutil.rmtree(self.directory)
+        logging.getLogger(log_handlers.LOGGER).setLevel(logging.NOTSET)
+        logging.getLogger(log_handlers.READ_LOGGER).setLevel(logging.NOTSET)
+
+    def test_json_formatter(self):
+        """It should format a record as one JSON object with its extras"""
+        record = make_record(request_id="abc", query_stats={"sql_queries": 2})
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "flask.app")
+        self.assertEqual(entry["message"], "Processing lookup")
+        self.assertEqual(entry["request_id"], "abc")
+        self.assertEqual(entry["query_stats"], {"sql_queries": 2})
+        self.assertNotIn("args", entry)
+
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError:
+            record = logging.LogRecord("flask.app", logging.ERROR, __file__, 1, "failed", None, True)
+            record.exc_info = sys.exc_info()
+        self.assertIn("RuntimeError: boom", json.loads(JsonFormatter().format(record))["exception"])
+
+    def test_parse_sample_rates(self):
+        """It should parse the sample rates of the environment"""
+        self.assertEqual(parse_sample_rates(""), {})
+        self.assertEqual(parse_sample_rates("a=0.5, b.c=1"), {"a": 0.5, "b.c": 1.0})
+        self.assertRaises(ValueError, parse_sample_rates, "a=often")
+
+    def test_sampling(self):
+        """It should sample the records below WARNING of the configured loggers"""
+        config = LogConfig()
+        config.sample_rates = {"tests.reads": 0.5}
+        sampled = SampledLogger(logging.getLogger("tests.reads"), config)
+        with self.assertLogs("tests.reads", level=logging.INFO) as logs:
+            with patch("service.common.log_handlers.random.random", return_value=0.7):
+                sampled.info("dropped %s", 1)
+                sampled.warning("kept %s", 2)
+            with patch("service.common.log_handlers.random.random", return_value=0.2):
+                sampled.info("kept %s", 3)
+            config.sample_rates = {}
+            with patch("service.common.log_handlers.random.random", return_value=0.7):
+                sampled.info("kept %s", 4, extra={"query_stats": {}})
+        self.assertEqual([record.getMessage() for record in logs.records], ["kept 2", "kept 3", "kept 4"])
+        self.assertEqual(logs.records[-1].query_stats, {})
+        self.assertEqual(logs.records[0].module, "test_log_handlers")
+
+    def test_request_id(self):
+        """It should keep or generate the request id and add it to the records"""
+        records = []
+
+        @self.app.route("/")
+        def index():
+            record = make_record()
+            RequestIdFilter().filter(record)
+            records.append(record)
+            return "ok"
+
+        self.app.before_request(log_handlers.assign_request_id)
+        self.app.after_request(log_handlers.send_request_id)
+        client = self.app.test_client()
+
+        resp = client.get("/", headers={"X-Request-ID": "req-42"})
+        self.assertEqual(resp.headers["X-Request-ID"], "req-42")
+        self.assertEqual(records[-1].request_id, "req-42")
+        # An id that does not fit in a log line is replaced
+        resp = client.get("/", headers={"X-Request-ID": "bad id"})
+        self.assertEqual(len(resp.headers["X-Request-ID"]), 32)
+        self.assertEqual(records[-1].request_id, resp.headers["X-Request-ID"])
+
+        record = make_record()
+        RequestIdFilter().filter(record)
+        self.assertIsNone(record.request_id)
+
+    def test_async_handler(self):
+        """It should write the records from a background thread"""
+        target = ListHandler()
+        handler = AsyncLogHandler([target])
+        handler.handle(make_record(args=({"mutable": 1},)))
+        self.assertEqual(handler.pid, os.getpid())
+        handler.stop()
+        self.assertEqual(len(target.records), 1)
+        self.assertEqual(target.records[0].msg, "Processing {'mutable': 1}")
+        self.assertIsNone(target.records[0].args)
+
+        # A forked worker starts its own thread
+        handler.pid = -1
+        handler.handle(make_record())
+        self.assertEqual(handler.pid, os.getpid())
+        handler.stop()
+        self.assertEqual(len(target.records), 2)
+
+    def test_async_handler_drops_when_full(self):
+        """It should drop the records rather than wait for a full queue"""
+        handler = AsyncLogHandler([ListHandler()], maxsize=1)
+        # No writer thread takes the records off the queue
+        handler.pid = os.getpid()
+        handler.handle(make_record())
+        handler.handle(make_record())
+        self.assertEqual(handler.stats(), {"queued": 1, "dropped": 1})
+
+    def test_json_output(self):
+        """It should write one JSON line per record to the target handler"""
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(JsonFormatter())
+        handler = AsyncLogHandler([target])
+        handler.handle(make_record(request_id="r1"))
+        handler.stop()
+        self.assertEqual(json.loads(stream.getvalue())["request_id"], "r1")
+
+    def test_reload_config_file(self):
+        """It should apply the levels and rates of the config file until it is removed"""
+        path = os.path.join(self.directory, "logging.json")
+        self.app.config["LOG_CONFIG_FILE"] = path
+        config = LogConfig()
+        config.init_app(self.app, logging.INFO)
+        self.assertEqual(config.sample_rates, {"flask.app.reads": 0.5})
+
+        with open(path, "w", encoding="utf-8") as config_file:
+            json.dump({"level": "warning", "levels": {"flask.app.reads": "ERROR"}, "sample_rates": {"flask.app": 0.1}},
+                      config_file)
+        self.assertTrue(config.reload())
+        self.assertFalse(config.reload())
+        self.assertEqual(self.app.logger.level, logging.WARNING)
+        self.assertEqual(logging.getLogger(log_handlers.LOGGER).level, logging.WARNING)
+        self.assertEqual(logging.getLogger(log_handlers.READ_LOGGER).level, logging.ERROR)
+        self.assertEqual(config.sample_rates, {"flask.app.reads": 0.5, "flask.app": 0.1})
+        self.assertEqual(config.stats()["levels"], {"flask.app.reads": "ERROR"})
+
+        os.remove(path)
+        self.assertTrue(config.reload())
+        self.assertEqual(self.app.logger.level, logging.INFO)
+        self.assertEqual(logging.getLogger(log_handlers.READ_LOGGER).level, logging.NOTSET)
+        self.assertEqual(config.sample_rates, {"flask.app.reads": 0.5})
+
+    def test_bad_config_file(self):
+        """It should keep the current levels when the config file is not valid"""
+        path = os.path.join(self.directory, "logging.json")
+        with open(path, "w", encoding="utf-8") as config_file:
+            json.dump({"level": "LOUD"}, config_file)
+        self.app.config["LOG_CONFIG_FILE"] = path
+        config = LogConfig()
+        with self.assertLogs(self.app.logger, level=logging.WARNING):
+            config.init_app(self.app, logging.INFO)
+        self.assertEqual(logging.getLogger(log_handlers.LOGGER).level, logging.INFO)
+        # Reported once, until the file changes
+        self.assertFalse(config.try_reload())
+
+    def test_poll_config_file(self):
+        """It should pick up the changes of the config file in the background"""
+        path = os.path.join(self.directory, "logging.json")
+        self.app.config.update(LOG_CONFIG_FILE=path, LOG_CONFIG_POLL_SECONDS=0.01)
+        config = LogConfig()
+        config.init_app(self.app, logging.INFO)
+        config.start()
+        with open(path, "w", encoding="utf-8") as config_file:
+            json.dump({"level": "ERROR"}, config_file)
+        deadline = time.monotonic() + 5
+        while self.app.logger.level != logging.ERROR and time.monotonic() < deadline:
+            time.sleep(0.01)
+        config.pid = None
+        self.assertEqual(self.app.logger.level, logging.ERROR)
@@ -0,0 +1,113 @@
+"""
+Test cases for the Database Migrations
+
+"""
+from unittest.mock import patch
+from sqlalchemy import inspect, text
+from service.models import ProductVersion, Recommendation, db
+from service.common import migrations
+from tests.utils import DatabaseTestCase, make_recommendation
+
+
+######################################################################
+#  M I G R A T I O N   T E S T   C A S E S
+######################################################################
+class TestMigrations(DatabaseTestCase):
+    """ Test Cases for the schema migrations """
+
+    def tearDown(self):
+        """ This runs after each test """
+        super().tearDown()
+        for table in (Recommendation.__table__, ProductVersion.__table__):
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        migrations.stamp(db.engine)
+
+    def _index_names(self):
+        """ Returns the names of the indexes of the recommendation table """
+        return {index["name"] for index in inspect(db.engine).get_indexes("recommendation")}
+
+    def test_upgrade_is_idempotent(self):
+        """It should bring the database to the latest version only once"""
+        migrations.upgrade(db.engine)
+        self.assertEqual(migrations.upgrade(db.engine), [])
+        with db.engine.connect() as connection:
+            self.assertEqual(migrations.current_version(connection), migrations.head())
+
+    def _drop_indexes(self):
+        """ Drops the recommendation indexes and forgets every migration """
+        db.session.remove()
+        for index in Recommendation.__table__.indexes:
+            index.drop(db.engine, checkfirst=True)
+        with db.engine.begin() as connection:
+            migrations.schema_version.create(connection, checkfirst=True)
+            connection.execute(migrations.schema_version.delete())
+
+    def test_upgrade_adds_indexes(self):
+        """It should create the missing indexes, accepting the rows with a NULL in their key"""
+        self._drop_indexes()
+        make_recommendation(1, 2).create()
+        make_recommendation(1, 3).create()
+        for _ in range(2):
+            rec = make_recommendation(1, 4)
+            rec.pid = None
+            rec.create()
+
+        applied = migrations.upgrade(db.engine)
+        self.assertEqual([version for version, _ in applied], [version for version, _, _ in migrations.MIGRATIONS])
+        self.assertTrue({index.name for index in Recommendation.__table__.indexes} <= self._index_names())
+        self.assertEqual(len(Recommendation.all()), 4)
+
+    def test_upgrade_refuses_duplicates(self):
+        """It should list the duplicated Recommendations instead of deleting them"""
+        self._drop_indexes()
+        make_recommendation(1, 2).create()
+        make_recommendation(1, 2).create()
+        make_recommendation(1, 3).create()
+
+        with self.assertRaises(migrations.MigrationError) as context:
+            migrations.upgrade(db.engine)
+        self.assertIn("(1, 2, 'default') x 2", str(context.exception))
+        self.assertIn("--dedupe", str(context.exception))
+        self.assertEqual(len(Recommendation.all()), 3)
+        with db.engine.connect() as connection:
+            self.assertEqual(migrations.current_version(connection), 0)
+
+        with patch.object(migrations, "MAX_LISTED", 0):
+            with self.assertRaisesRegex(migrations.MigrationError, "and 1 more"):
+                migrations.upgrade(db.engine)
+
+        migrations.upgrade(db.engine, dedupe=True)
+        self.assertTrue({index.name for index in Recommendation.__table__.indexes} <= self._index_names())
+        self.assertEqual(sorted(rec.recommended_pid for rec in Recommendation.all()), [2, 3])
+
+    def test_upgrade_adds_columns(self):
+        """It should add the columns that an old table is missing"""
+        db.session.remove()
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE recommendation DROP COLUMN version"))
+            migrations.schema_version.create(connection, checkfirst=True)
+            connection.execute(migrations.schema_version.delete())
+            connection.execute(migrations.schema_version.insert().values(version=1, description="test"))
+
+        applied = migrations.upgrade(db.engine)
+        self.assertEqual(applied[0][0], 2)
+        columns = {column["name"] for column in inspect(db.engine).get_columns("recommendation")}
+        self.assertIn("version", columns)
+        make_recommendation(1, 2).create()
+        self.assertEqual(Recommendation.all()[0].version, 1)
+
+    def test_upgrade_adds_updated_at(self):
+        """It should add the updated_at watermark to an old product_version table"""
+        db.session.remove()
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_product_version_updated_at"))
+            connection.execute(text("ALTER TABLE product_version DROP COLUMN updated_at"))
+            connection.execute(migrations.schema_version.delete())
+            connection.execute(migrations.schema_version.insert().values(version=3, description="test"))
+
+        self.assertEqual([version for version, _ in migrations.upgrade(db.engine)], [4, 5])
+        columns = {column["name"] for column in inspect(db.engine).get_columns("product_version")}
+        self.assertIn("updated_at", columns)
+        make_recommendation(1, 2).create()
+        self.assertIsNotNone(ProductVersion.find_changes()[0][2])
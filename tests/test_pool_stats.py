@@ -0,0 +1,66 @@
+"""
+Test cases for the connection pool configuration and statistics
+
+"""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool, QueuePool
+from service.config import engine_options
+from service.common.pool_stats import PoolStats
+
+
+######################################################################
+#  P O O L   S T A T S   T E S T   C A S E S
+######################################################################
+class TestPoolStats(TestCase):
+    """ Pool Statistics Tests """
+
+    def test_engine_options_for_postgres(self):
+        """It should configure the pool and the statement timeout from the environment"""
+        env = {"DB_POOL_SIZE": "8", "DB_MAX_OVERFLOW": "2", "DB_STATEMENT_TIMEOUT_MS": "5000"}
+        with patch.dict(os.environ, env):
+            options = engine_options("postgresql://postgres@localhost/postgres")
+        self.assertEqual(options["pool_size"], 8)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"]["options"], "-c statement_timeout=5000")
+
+    def test_engine_options_null_pool(self):
+        """It should open a connection per checkout behind PgBouncer"""
+        with patch.dict(os.environ, {"DB_POOL_MODE": "null", "DB_POOL_PRE_PING": "false"}):
+            options = engine_options("postgresql://postgres@localhost/postgres")
+        self.assertIs(options["poolclass"], NullPool)
+        self.assertFalse(options["pool_pre_ping"])
+        self.assertNotIn("pool_size", options)
+
+    def test_engine_options_for_sqlite(self):
+        """It should leave the pool sizing of SQLite to its driver"""
+        options = engine_options("sqlite://")
+        self.assertNotIn("pool_size", options)
+        self.assertNotIn("connect_args", options)
+
+    def test_checkouts_are_counted(self):
+        """It should time every checkout, also after the engine is disposed"""
+        engine = create_engine("sqlite://", poolclass=QueuePool)
+        stats = PoolStats()
+        waits = []
+        stats.observers.append(waits.append)
+        stats.init_engine(engine)
+        stats.init_engine(engine)
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            self.assertEqual(stats.stats()["checked_out"], 1)
+        engine.dispose()
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+        counters = stats.stats()
+        self.assertEqual(counters["pool"], "QueuePool")
+        self.assertEqual(counters["checkouts"], 2)
+        self.assertEqual(counters["connects"], 2)
+        self.assertEqual(counters["checked_out"], 0)
+        self.assertEqual(counters["waiting"], 0)
+        self.assertEqual(len(waits), 2)
+        self.assertGreaterEqual(counters["wait_seconds_max"], counters["wait_seconds_avg"])
@@ -0,0 +1,96 @@
+"""
+Test cases for the Query Statistics
+
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask, g
+from sqlalchemy import create_engine, text
+from service.common import query_stats
+from service.common.query_stats import QueryBudgetExceeded, count_queries
+
+
+######################################################################
+#  Q U E R Y   S T A T S   T E S T   C A S E S
+######################################################################
+class TestQueryStats(TestCase):
+    """ Query Statistics Tests """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.engine = create_engine("sqlite://")
+        query_stats.init_engine(self.engine)
+        self.app = Flask(__name__)
+        self.app.testing = True
+        self.app.config.update(
+            QUERY_STATS_SAMPLE_RATE=0.0, QUERY_BUDGET=5, QUERY_REPEAT_THRESHOLD=3, QUERY_BUDGET_RAISE=False,
+        )
+        query_stats.init_app(self.app)
+
+        @self.app.route("/queries/<int:count>")
+        def run_queries(count):
+            with self.engine.connect() as conn:
+                for _ in range(count):
+                    conn.execute(text("SELECT 1"))
+            # Counted by the cursor events of metrics.py in the service
+            g.sql_queries = count
+            g.sql_seconds = 0.002
+            return "ok"
+
+        self.client = self.app.test_client()
+
+    def test_count_queries(self):
+        """It should return the statements sent inside the block"""
+        with count_queries(self.engine) as statements:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                conn.execute(text("SELECT 2"))
+        self.assertEqual(statements, ["SELECT 1", "SELECT 2"])
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT 3"))
+        self.assertEqual(len(statements), 2)
+
+    def test_unsampled_request(self):
+        """It should leave the requests within budget alone"""
+        resp = self.client.get("/queries/2")
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("Server-Timing", resp.headers)
+
+    def test_sampled_request(self):
+        """It should add a Server-Timing header to the sampled requests"""
+        self.app.config["QUERY_STATS_SAMPLE_RATE"] = 1.0
+        with self.assertLogs("flask.app", level=logging.INFO) as logs:
+            resp = self.client.get("/queries/2")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('db;dur=2.000;desc="2 queries"', resp.headers["Server-Timing"])
+        self.assertEqual(logs.records[0].levelno, logging.INFO)
+        self.assertEqual(logs.records[0].query_stats["sql_queries"], 2)
+
+    def test_debug_samples_every_request(self):
+        """It should add a Server-Timing header to every request in debug mode"""
+        self.app.debug = True
+        with self.assertLogs("flask.app", level=logging.INFO):
+            resp = self.client.get("/queries/1")
+        self.assertIn("Server-Timing", resp.headers)
+
+    def test_repeated_statement(self):
+        """It should warn about a statement repeated by a request"""
+        with patch("service.common.query_stats.random.random", return_value=0.5):
+            with self.assertLogs("flask.app", level=logging.WARNING) as logs:
+                resp = self.client.get("/queries/3")
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("Server-Timing", resp.headers)
+        stats = logs.records[0].query_stats
+        self.assertEqual(stats["repeated"], [{"statement": "SELECT 1", "count": 3}])
+
+    def test_over_budget(self):
+        """It should raise QueryBudgetExceeded when a request goes over its budget"""
+        self.app.config.update(QUERY_BUDGET_RAISE=True, QUERY_REPEAT_THRESHOLD=0)
+        with self.assertLogs("flask.app", level=logging.WARNING):
+            self.assertRaises(QueryBudgetExceeded, self.client.get, "/queries/6")
+        self.app.config["QUERY_BUDGET_RAISE"] = False
+        with self.assertLogs("flask.app", level=logging.WARNING) as logs:
+            resp = self.client.get("/queries/6")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(logs.records[0].query_stats["query_budget"], 5)
@@ -0,0 +1,145 @@
+"""
+Test cases for the Like Write-Behind
+
+"""
+import contextlib
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+from service.common.write_behind import LikeWriteBehind
+
+
+class FakeApp:  # pylint: disable=too-few-public-methods
+    """ A Flask app with only a configuration """
+
+    def __init__(self, **config):
+        self.config = config
+
+    @staticmethod
+    def app_context():
+        """ Returns an empty context """
+        return contextlib.nullcontext()
+
+
+######################################################################
+#  W R I T E   B E H I N D   T E S T   C A S E S
+######################################################################
+class TestLikeWriteBehind(TestCase):
+    """ Like Write-Behind Tests """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.directory = tempfile.mkdtemp()
+        self.applied = []
+        self.writes = self.make_writes()
+
+    def tearDown(self):
+        """ This runs after each test """
+        shutil.rmtree(self.directory)
+
+    def make_writes(self, **config):
+        """ Returns a write-behind journaling to the test directory """
+        config = {
+            "LIKE_WRITE_BEHIND": True,
+            "LIKE_JOURNAL_DIR": self.directory,
+            "LIKE_FLUSH_SECONDS": 3600,
+            "LIKE_FLUSH_SIZE": 1000,
+            **config,
+        }
+        writes = LikeWriteBehind()
+        writes.init_app(FakeApp(**config), lambda changes, likes: self.applied.append((changes, likes)))
+        return writes
+
+    def segments(self):
+        """ Returns the journal segments in the test directory """
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+
+    def test_coalesce_per_recommendation(self):
+        """It should apply only the last event of every Recommendation"""
+        self.writes.enqueue(1, True)
+        self.writes.enqueue(2, True)
+        self.writes.enqueue(1, False)
+        self.assertEqual(self.writes.stats()["pending"], 2)
+        self.assertEqual(self.writes.flush(), 2)
+        self.assertEqual(self.applied, [({1: False, 2: True}, {1: 1, 2: 1})])
+        self.assertEqual(self.writes.flush(), 0)
+        self.assertEqual(len(self.applied), 1)
+
+    def test_flush_removes_journal(self):
+        """It should keep the events in the journal until they are applied"""
+        lags = []
+        self.writes.observers.append(lags.append)
+        self.writes.enqueue(5, True)
+        with open(os.path.join(self.directory, self.segments()[0]), encoding="utf-8") as segment:
+            self.assertEqual(segment.read(), "5 1\n")
+        self.writes.flush()
+        # Only the new, empty segment is left
+        self.assertEqual(len(self.segments()), 1)
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, self.segments()[0])), 0)
+        self.assertEqual(len(lags), 1)
+        self.assertGreaterEqual(lags[0], 0)
+        stats = self.writes.stats()
+        self.assertEqual((stats["flushes"], stats["flushed"]), (1, 1))
+
+    def test_failed_flush_keeps_events(self):
+        """It should retry the events of a failed flush without overriding newer ones"""
+        def fail(changes, likes):
+            raise RuntimeError(f"database down for {changes} and {likes}")
+
+        self.writes.apply = fail
+        self.writes.enqueue(1, True)
+        self.writes.enqueue(2, True)
+        self.assertRaises(RuntimeError, self.writes.flush)
+        self.writes.enqueue(2, False)
+        self.writes.apply = lambda changes, likes: self.applied.append((changes, likes))
+        self.writes.flush()
+        self.assertEqual(self.applied, [({1: True, 2: False}, {1: 1, 2: 1})])
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_flush_on_size(self):
+        """It should flush in the background once enough Recommendations are pending"""
+        writes = self.make_writes(LIKE_FLUSH_SIZE=2)
+        writes.enqueue(1, True)
+        writes.enqueue(2, False)
+        deadline = time.monotonic() + 5
+        while not self.applied and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.applied, [({1: True, 2: False}, {1: 1})])
+
+    def test_recover_after_restart(self):
+        """It should apply the events journaled by a worker that exited"""
+        with open(os.path.join(self.directory, "likes-999999-00000001.log"), "w", encoding="utf-8") as segment:
+            segment.write("7 1\n8 1\n")
+        with open(os.path.join(self.directory, "likes-999999-00000002.log"), "w", encoding="utf-8") as segment:
+            segment.write("8 0\n9")
+        self.writes.start()
+        self.assertEqual(self.writes.flush(), 2)
+        self.assertEqual(self.applied, [({7: True, 8: False}, {7: 1, 8: 1})])
+        self.assertEqual(len(self.segments()), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "likes-999999.lock")))
+
+    def test_recover_own_leftovers(self):
+        """It should apply the events left by a previous write-behind of this process"""
+        self.writes.enqueue(3, True)
+        # The worker dies without flushing
+        self.writes._lock_file.close()  # pylint: disable=protected-access
+        self.writes.pending.clear()
+        self.writes.likes.clear()
+        writes = self.make_writes()
+        writes.enqueue(4, False)
+        writes.flush()
+        self.assertEqual(self.applied, [({3: True, 4: False}, {3: 1})])
+
+    def test_skip_live_workers(self):
+        """It should not adopt the journal of a running worker"""
+        path = os.path.join(self.directory, "likes-999998-00000001.log")
+        with open(path, "w", encoding="utf-8") as segment:
+            segment.write("7 1\n")
+        with open(os.path.join(self.directory, "likes-999998.lock"), "w", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.writes.start()
+        self.assertEqual(self.writes.flush(), 0)
+        self.assertTrue(os.path.exists(path))